@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Compares the cost of file_utils.compare_files with hashing both files end to end (former
+has_same_content), on pairs of files of the same size: identical, differing in the first
+block, differing in the last block, and on files of different sizes.
+
+Usage: benchmarks/compare_files.py [size_in_mib] [directory_1] [directory_2]
+Give a directory on the NAS as directory_2 to measure concurrent reads of files on
+different devices. Files are read from the page cache after the first round, so local
+results mostly measure CPU cost.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+sys.path.insert(1, str(Path(__file__).resolve().parents[1]))
+
+import phanas.file_utils  # noqa: E402
+
+_ROUNDS = 5
+
+
+def hash_both(file_1_path: Path, file_2_path: Path) -> bool:
+    hash_1 = phanas.file_utils.compute_hash(file_1_path)
+    return hash_1 == phanas.file_utils.compute_hash(file_2_path)
+
+
+def best_of(function, *args) -> float:
+    durations = []
+    for _ in range(_ROUNDS):
+        started_at = time.perf_counter()
+        function(*args)
+        durations.append(time.perf_counter() - started_at)
+    return min(durations)
+
+
+def write_file(file_path: Path, content: bytes):
+    with open(file_path, "wb") as f:
+        f.write(content)
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 64 * 1024 * 1024
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dir_1 = Path(sys.argv[2]) if len(sys.argv) > 2 else Path(temp_dir)
+        dir_2 = Path(sys.argv[3]) if len(sys.argv) > 3 else Path(temp_dir)
+        content = os.urandom(size)
+        reference = dir_1 / "phanas_benchmark_reference"
+        write_file(reference, content)
+
+        cases = {
+            "identical": content,
+            "first block differs": b"\0" + content[1:],
+            "last block differs": content[:-1] + b"\0",
+            "different size": content + b"\0",
+        }
+        print(f"{size // (1024 * 1024)} MiB files, best of {_ROUNDS} rounds")
+        print(f"{'case':<22}{'hash both':>12}{'compare':>12}{'speedup':>10}")
+        for name, other_content in cases.items():
+            other = dir_2 / "phanas_benchmark_other"
+            write_file(other, other_content)
+            try:
+                assert hash_both(reference, other) == phanas.file_utils.compare_files(
+                    reference, other
+                )
+                hash_s = best_of(hash_both, reference, other)
+                compare_s = best_of(phanas.file_utils.compare_files, reference, other)
+            finally:
+                other.unlink()
+            print(
+                f"{name:<22}{hash_s * 1000:>10.1f}ms{compare_s * 1000:>10.1f}ms"
+                f"{hash_s / compare_s:>9.1f}x"
+            )
+        reference.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Compares the latency of synchronizing two diverged KeePass databases with keepassxc-cli
+(two merge runs, as KeePass.__merge_keyfiles does) and with the in-process merge of
+phanas.kdbx_merge.
+
+Usage: benchmarks/kdbx_merge.py [entry_count]
+Requires pykeepass and keepassxc-cli (or the keepassxc snap). Databases are created with
+pykeepass's default KDF parameters, use a copy of a real keyfile for representative key
+derivation costs.
+"""
+
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+sys.path.insert(1, str(Path(__file__).resolve().parents[1]))
+
+import phanas.kdbx_merge  # noqa: E402
+
+_PASSWORD = "benchmark"
+_ROUNDS = 3
+
+
+def create_diverged_databases(directory: Path, entry_count: int) -> tuple[Path, Path]:
+    from pykeepass import create_database
+
+    local_path = directory / "local.kdbx"
+    database = create_database(str(local_path), password=_PASSWORD)
+    for i in range(entry_count):
+        database.add_entry(
+            database.root_group, f"entry {i}", f"user {i}", f"password {i}"
+        )
+    database.save()
+
+    remote_path = directory / "remote.kdbx"
+    shutil.copyfile(local_path, remote_path)
+    for path, side in ((local_path, "local"), (remote_path, "remote")):
+        database = phanas.kdbx_merge.PyKeePass(str(path), password=_PASSWORD)
+        database.add_entry(database.root_group, f"{side} entry", side, side)
+        database.save()
+    return local_path, remote_path
+
+
+def merge_with_cli(cli: str, local_path: Path, remote_path: Path):
+    for into_file, from_file in ((local_path, remote_path), (remote_path, local_path)):
+        subprocess.run(
+            [cli, "merge", "--same-credentials", str(into_file), str(from_file)],
+            input=_PASSWORD,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True,
+        )
+
+
+def merge_in_process(local_path: Path, remote_path: Path):
+    status, msg = phanas.kdbx_merge.merge(str(local_path), str(remote_path), _PASSWORD)
+    if not status:
+        raise RuntimeError(msg)
+
+
+def best_of(directory: Path, entry_count: int, function, *args) -> float:
+    durations = []
+    for _ in range(_ROUNDS):
+        local_path, remote_path = create_diverged_databases(directory, entry_count)
+        started_at = time.perf_counter()
+        function(*args, local_path, remote_path)
+        durations.append(time.perf_counter() - started_at)
+    return min(durations)
+
+
+def main():
+    if not phanas.kdbx_merge.is_available():
+        sys.exit("pykeepass is not installed")
+    cli = shutil.which("keepassxc.cli") or shutil.which("keepassxc-cli")
+    entry_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory = Path(temp_dir)
+        in_process_s = best_of(directory, entry_count, merge_in_process)
+        print(f"{entry_count} entries, best of {_ROUNDS} rounds")
+        print(f"in-process merge: {in_process_s * 1000:.0f}ms")
+        if cli:
+            cli_s = best_of(directory, entry_count, merge_with_cli, cli)
+            print(
+                f"{cli} merge x2: {cli_s * 1000:.0f}ms "
+                f"({cli_s / in_process_s:.1f}x slower)"
+            )
+        else:
+            print("keepassxc-cli not found, not compared")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,10 @@ import logging
 import os
 import phanas.nas
 import phanas.file_utils
+import phanas.logging
 import subprocess
 import sys
+import time
 
 from pathlib import Path
 from subprocess import PIPE
@@ -45,6 +47,12 @@ class AutoMountLogger(ABC):
         """ Error message"""
         pass
 
+    def drive_done(
+        self, drive: str, success: bool, duration_s: float, msg: str | None
+    ) -> None:
+        """Outcome of mounting a single drive, with the time it took"""
+        pass
+
 
 class DefaultAutMountLogger(AutoMountLogger):
     def __init__(self):
@@ -89,7 +97,7 @@ class AutoMount:
             return False
 
         automount_logger.transient_info("Connecting NAS drives...")
-        status, msg = self._connect_drives()
+        status, msg = self._connect_drives(automount_logger)
         if not status:
             automount_logger.error(msg)
             return False
@@ -169,14 +177,17 @@ class AutoMount:
 
         return True, None
 
-    def __connect_drives(self, nas, global_status, global_msg):
+    def __connect_drives(self, nas, global_status, global_msg, automount_logger):
         for drive in nas.drives():
-            status, msg = self.__connect_drive(nas, drive, drive)
+            start = time.monotonic()
+            with phanas.logging.log_context(drive=drive):
+                status, msg = self.__connect_drive(nas, drive, drive)
+            automount_logger.drive_done(drive, status, time.monotonic() - start, msg)
             if not status:
                 global_status = False
                 global_msg.append(msg)
 
-    def _connect_drives(self):
+    def _connect_drives(self, automount_logger):
         if not self.env.mount_dir_path.exists():
             self._logger.info(
                 "mount dir %s for user does not exist, creating it...",
@@ -188,7 +199,7 @@ class AutoMount:
 
         global_status = True
         global_msg = []
-        self.__connect_drives(self.nas, global_status, global_msg)
+        self.__connect_drives(self.nas, global_status, global_msg, automount_logger)
 
         return global_status, "\n".join(global_msg)
 
@@ -1,50 +1,133 @@
 import logging
 import os
+import re
 import select
+import sqlite3
 import subprocess
 import sys
+import time
 
 from datetime import datetime, date, timedelta
 from pathlib import Path
+from typing import Callable
 from io import StringIO
 
+import phanas.metrics
+from phanas.backup_scheduler import BackupScheduler
+from phanas.events import PHASE_BACKUP
+from phanas.job_runner import Job, job_runner
+from phanas.lease import run_leased
+from phanas.rsync_progress import (
+    RsyncProgress,
+    RsyncProgressParser,
+    append_run_totals,
+    is_progress2_line,
+)
+from phanas.snapshot_engine import SnapshotEngine
+
+from phanas.snapshot_history import SnapshotHistory
+from phanas.tree_index import ChangeSummary, TreeIndex
+
+_BACKUP_CONFIG_JSON_OBJECT_NAME = "backup"
+_JOBS_CONFIG_JSON_OBJECT_NAME = "jobs"
+_JOB_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+DEFAULT_TARGET = "nas"
+
 
 class Backup:
+    """
+    A backup job: either the single backup configured in the "backup" object, or one of
+    its named "jobs". Each named job has its own state file and indexes, suffixed with
+    its name.
+    """
+
     __logger = logging.getLogger("backup")
 
     __script_path = None
+    __snapshot_engine = None
 
     __STATE_FILE_HEADER = "# This file is generated, do not modify it"
     __script_dir = Path(sys.path[0])
-    __state_file_path = __script_dir / "state.phanas"
 
     __LAST_BACKUP_MAX_AGE_IN_DAYS = 4
     __LAST_BACKUP_DATE_FORMAT = "%Y-%m-%d"
     __LAST_BACKUP_TIMESTAMP_FORMAT = "{}_%H-%M-%S".format(__LAST_BACKUP_DATE_FORMAT)
     __LAST_BACKUP_LINE_PREFIX = "last_backup_date="
     __lastbackup_day = None
+    __lastbackup_timestamp = None
+
+    __CHANGE_DETECTION_MAX_AGE_IN_DAYS = 30
+    __CHANGED_FILES_THRESHOLD = 1000
+    __CHANGED_BYTES_THRESHOLD = 1024 * 1024 * 1024
+    __SCAN_WORKERS = 8
+    __tree_index = None
+    __change_detection_config = None
+    __change_summary = None
+    __scheduler = None
+    __skip_reason = None
+    __snapshot_history = None
+
+    def __init__(self, config, job: dict | None = None):
+        if job is not None:
+            backup_config = job
+            self.__job_name = job.get("name")
+            self.__target = job.get("target", DEFAULT_TARGET)
+        else:
+            backup_config = (
+                config.get(_BACKUP_CONFIG_JSON_OBJECT_NAME) if config else None
+            )
+            self.__job_name = None
+            self.__target = DEFAULT_TARGET
+
+        suffix = f"_{self.__job_name}" if self.__job_name else ""
+        self.__state_file_path = self.__script_dir / f"state{suffix}.phanas"
+        self.__index_file_path = (
+            self.__script_dir / ".index" / f"backup_sources{suffix}.sqlite"
+        )
+        self.__manifest_file_path = (
+            self.__script_dir / ".index" / f"snapshot_manifest{suffix}.sqlite"
+        )
+        self.__history_file_path = (
+            self.__script_dir / ".index" / f"snapshot_history{suffix}.sqlite"
+        )
 
-    def __init__(self, config):
-        self.__load_backupscript_path(config)
+        if not isinstance(backup_config, dict):
+            self.__logger.info(
+                "config does not contain %s", _BACKUP_CONFIG_JSON_OBJECT_NAME
+            )
+            backup_config = {}
+        if not self.__load_native_engine(backup_config):
+            self.__load_backupscript_path(backup_config)
         self.__load_lastbackup_date()
+        self.__load_change_detection(backup_config)
+        self.__load_schedule(backup_config)
+        self.__load_snapshot_history(backup_config)
 
-    def __load_backupscript_path(self, config):
-        backup_name = "backup"
-        script_path_name = "script_path"
+    def name(self) -> str:
+        return self.__job_name or _BACKUP_CONFIG_JSON_OBJECT_NAME
 
-        if not config:
-            self.__logger.info("no config")
-            return False
+    def job_id(self) -> str:
+        """Identifies the job in run history and NAS leases"""
+        if self.__job_name:
+            return f"{_BACKUP_CONFIG_JSON_OBJECT_NAME}_{self.__job_name}"
+        return _BACKUP_CONFIG_JSON_OBJECT_NAME
 
-        if not backup_name in config:
-            self.__logger.info("config does not contain %s", backup_name)
-            return False
+    def display_name(self) -> str:
+        return f"Backup {self.__job_name}" if self.__job_name else "Backup"
 
-        backup_config = config[backup_name]
-        if not isinstance(backup_config, dict) or not script_path_name in backup_config:
+    def target(self) -> str:
+        """
+        Where the job writes to, jobs with the same target do not run at the same time
+        """
+        return self.__target
+
+    def __load_backupscript_path(self, backup_config):
+        script_path_name = "script_path"
+
+        if not script_path_name in backup_config:
             self.__logger.info(
-                "'%s' is not an object or does not contain name '%s'",
-                backup_name,
+                "'%s' does not contain name '%s'",
+                self.name(),
                 script_path_name,
             )
             return False
@@ -63,11 +146,145 @@ class Backup:
             self.__logger.error("script %s is not executable", script_path)
             return False
 
-        self.__logger.info("backup script: %s", script_path)
+        self.__logger.info("%s script: %s", self.name(), script_path)
         self.__script_path = script_path
 
         return True
 
+    def __load_native_engine(self, backup_config):
+        native_name = "native"
+        sources_name = "sources"
+        destination_name = "destination"
+
+        if not native_name in backup_config:
+            return False
+
+        native_config = backup_config[native_name]
+        if (
+            not isinstance(native_config, dict)
+            or not sources_name in native_config
+            or not destination_name in native_config
+        ):
+            self.__logger.info(
+                "'%s' is not an object or does not contain names '%s' and '%s'",
+                native_name,
+                sources_name,
+                destination_name,
+            )
+            return False
+
+        sources = native_config[sources_name]
+        if not isinstance(sources, list) or not sources:
+            self.__logger.info("%s is not a list", sources_name)
+            return False
+        source_paths = [
+            Path(s).expanduser() for s in sources if isinstance(s, str) and s
+        ]
+        for source_path in source_paths:
+            if not source_path.is_dir():
+                self.__logger.error("source %s is not a directory", source_path)
+                return False
+
+        destination = native_config[destination_name]
+        if not isinstance(destination, str) or not destination:
+            self.__logger.info("%s is not a string", destination_name)
+            return False
+
+        self.__logger.info(
+            "native backup of %s to %s",
+            ", ".join(str(p) for p in source_paths),
+            destination,
+        )
+        self.__snapshot_engine = SnapshotEngine(
+            source_paths,
+            Path(destination),
+            self.__manifest_file_path,
+            excludes=native_config.get("excludes", []),
+            workers=native_config.get("workers", 4),
+            expiration_days=native_config.get("expiration_days"),
+        )
+
+        return True
+
+    def __load_change_detection(self, backup_config):
+        change_detection_name = "change_detection"
+        sources_name = "sources"
+
+        if not change_detection_name in backup_config:
+            return False
+
+        change_detection_config = backup_config[change_detection_name]
+        if (
+            not isinstance(change_detection_config, dict)
+            or not sources_name in change_detection_config
+        ):
+            self.__logger.info(
+                "'%s' is not an object or does not contain name '%s'",
+                change_detection_name,
+                sources_name,
+            )
+            return False
+
+        sources = change_detection_config[sources_name]
+        if not isinstance(sources, list) or not sources:
+            self.__logger.info("%s is not a list", sources_name)
+            return False
+
+        source_paths = [
+            Path(s).expanduser() for s in sources if isinstance(s, str) and s
+        ]
+        for source_path in source_paths:
+            if not source_path.is_dir():
+                self.__logger.error("source %s is not a directory", source_path)
+                return False
+
+        self.__logger.info(
+            "change detection on: %s", ", ".join(str(p) for p in source_paths)
+        )
+        self.__change_detection_config = change_detection_config
+        self.__tree_index = TreeIndex(
+            self.__index_file_path,
+            source_paths,
+            excludes=change_detection_config.get("excludes", []),
+        )
+
+        return True
+
+    def __load_schedule(self, backup_config):
+        schedule_name = "schedule"
+
+        if not schedule_name in backup_config:
+            return False
+
+        schedule_config = backup_config[schedule_name]
+        if not isinstance(schedule_config, dict):
+            self.__logger.info("'%s' is not an object", schedule_name)
+            return False
+
+        self.__scheduler = BackupScheduler(schedule_config)
+
+        return True
+
+    def __load_snapshot_history(self, backup_config):
+        snapshots_destination_name = "snapshots_destination"
+
+        native_config = backup_config.get("native")
+        destination = backup_config.get(snapshots_destination_name)
+        if destination is None and isinstance(native_config, dict):
+            destination = native_config.get("destination")
+        if destination is None:
+            return False
+
+        if not isinstance(destination, str) or not destination:
+            self.__logger.info("%s is not a string", snapshots_destination_name)
+            return False
+
+        self.__snapshot_history = SnapshotHistory(
+            Path(destination), self.__history_file_path
+        )
+
+        return True
+
     def __load_lastbackup_date(self):
         if not self.__state_file_path.is_file():
             return
@@ -83,14 +300,23 @@ class Backup:
 
             prefix_length = len(self.__LAST_BACKUP_LINE_PREFIX)
             lastbackup_day_str = line[prefix_length : prefix_length + len("2020-06-18")]
+            lastbackup_timestamp_str = line[
+                prefix_length : prefix_length + len("2020-06-18_09-32-45")
+            ]
 
             self.__lastbackup_day = datetime.strptime(
                 lastbackup_day_str, self.__LAST_BACKUP_DATE_FORMAT
             ).date()
+            self.__lastbackup_timestamp = datetime.strptime(
+                lastbackup_timestamp_str, self.__LAST_BACKUP_TIMESTAMP_FORMAT
+            )
             self.__logger.info("last backup day: %s", self.__lastbackup_day)
 
+    def last_backup_timestamp(self) -> datetime | None:
+        return self.__lastbackup_timestamp
+
     def should_backup(self):
-        if self.__script_path:
+        if self.__script_path or self.__snapshot_engine:
             return True
 
         return False
@@ -99,15 +325,112 @@ class Backup:
         if not self.__lastbackup_day:
             return False
 
+        if self.__scheduler:
+            # before scanning sources, which takes time
+            may_run, reason = self.__scheduler.may_run(self.__lastbackup_timestamp)
+            if not may_run:
+                self.__skip_reason = reason
+                self.__logger.info("backup scheduler: %s", self.__skip_reason)
+                return True
+
+        if self.__tree_index:
+            self.__scan_changes()
+            if not self.__tree_index.has_baseline():
+                self.__logger.info("no index of a previous backup")
+                return False
+
+        if self.__scheduler:
+            run, self.__skip_reason = self.__scheduler.decide(
+                self.__lastbackup_timestamp, self.__change_summary
+            )
+            self.__logger.info("backup scheduler: %s", self.__skip_reason)
+            return not run
+
+        if self.__tree_index:
+            return self.__can_skip_from_changes()
+
         threshold_day = date.today() - timedelta(
             days=self.__LAST_BACKUP_MAX_AGE_IN_DAYS
         )
         if self.__lastbackup_day < threshold_day:
             return False
 
+        self.__skip_reason = "recent enough"
         return True
 
-    def do_backup(self):
+    def __scan_changes(self):
+        self.__change_summary = self.__tree_index.scan(
+            workers=self.__change_detection_config.get("workers", self.__SCAN_WORKERS)
+        )
+
+    def __prepare_index_commit(self):
+        # sources are scanned before the backup, even when not needed to decide whether
+        # to skip it (eg. no previous backup), so that the index is committed as the
+        # baseline of the next run
+        if self.__tree_index and self.__change_summary is None:
+            self.__scan_changes()
+
+    def __commit_index(self):
+        if self.__tree_index and self.__change_summary is not None:
+            self.__tree_index.commit()
+
+    def __can_skip_from_changes(self):
+        """
+        Skips when nothing changed since the last backup, when few things changed and
+        the last backup is recent enough. Never skips when a lot changed or when the
+        last backup is older than the maximum age.
+        """
+        config = self.__change_detection_config
+        max_age_in_days = config.get(
+            "max_age_in_days", self.__CHANGE_DETECTION_MAX_AGE_IN_DAYS
+        )
+        if self.__lastbackup_day < date.today() - timedelta(days=max_age_in_days):
+            self.__logger.info("last backup older than %s days", max_age_in_days)
+            return False
+
+        changes = self.__change_summary
+        self.__skip_reason = str(changes)
+        if not changes.changed_files():
+            return True
+
+        if changes.changed_files() >= config.get(
+            "changed_files_threshold", self.__CHANGED_FILES_THRESHOLD
+        ) or changes.changed_bytes >= config.get(
+            "changed_bytes_threshold", self.__CHANGED_BYTES_THRESHOLD
+        ):
+            self.__logger.info("too many changes since last backup: %s", changes)
+            return False
+
+        threshold_day = date.today() - timedelta(
+            days=self.__LAST_BACKUP_MAX_AGE_IN_DAYS
+        )
+        return self.__lastbackup_day >= threshold_day
+
+    def skip_reason(self) -> str | None:
+        """Why the backup can be skipped, once can_skip() returned True"""
+        return self.__skip_reason
+
+    def snapshot_history(self) -> SnapshotHistory | None:
+        """
+        Index of the files of the backup snapshots, if the destination of the snapshots
+        is known
+        """
+        return self.__snapshot_history
+
+    def change_summary(self) -> ChangeSummary | None:
+        """
+        Changes in backup sources since the last backup, if change detection is
+        configured
+        """
+        return self.__change_summary
+
+    def do_backup(
+        self, progress_callback: Callable[[RsyncProgress], None] | None = None
+    ):
+        self.__prepare_index_commit()
+        if self.__snapshot_engine:
+            return self.__do_native_backup(progress_callback)
+
         command = [self.__script_path]
 
         proc = subprocess.Popen(
@@ -118,11 +441,20 @@ class Backup:
             universal_newlines=True,
         )
 
+        parser = RsyncProgressParser()
+
         def check_std(std, loglevel):
             while True:
                 output = std.readline()
                 if output:
-                    self.__logger.log(loglevel, output.strip())
+                    line = output.strip()
+                    # progress lines are frequent and only relevant while the script
+                    # runs
+                    self.__logger.log(
+                        logging.DEBUG if is_progress2_line(line) else loglevel, line
+                    )
+                    if parser.parse_line(line) and progress_callback:
+                        progress_callback(parser.progress)
                 else:
                     break
 
@@ -133,13 +465,42 @@ class Backup:
             check_io()
             proc.wait()
 
+        append_run_totals(
+            self.job_id(), parser.progress.to_totals(proc.returncode == 0)
+        )
         if proc.returncode != 0:
-            return False, "backup script had an error. Check the logs"
+            return False, f"{self.name()} script had an error. Check the logs"
+
+        self.__persist_backup_date()
+        self.__commit_index()
+        self.__update_snapshot_history()
+
+        return True, None
+
+    def __do_native_backup(self, progress_callback):
+        status, msg = self.__snapshot_engine.run(progress_callback=progress_callback)
+        if self.__snapshot_engine.progress:
+            append_run_totals(
+                self.job_id(), self.__snapshot_engine.progress.to_totals(status)
+            )
+        if not status:
+            return False, msg
 
         self.__persist_backup_date()
+        self.__commit_index()
+        self.__update_snapshot_history()
 
         return True, None
 
+    def __update_snapshot_history(self):
+        if not self.__snapshot_history:
+            return
+        try:
+            self.__snapshot_history.update()
+        except (OSError, sqlite3.Error) as e:
+            # backup succeeded, the index catches up on the next backup
+            self.__logger.error("can't update index of backup snapshots: %s", e)
+
     def __persist_backup_date(self):
         self.__logger.debug("writing to %s...", self.__state_file_path)
         add_header = False
@@ -153,18 +514,82 @@ class Backup:
             f.write(self.__LAST_BACKUP_LINE_PREFIX + timestamp + "\n")
 
 
+def backups(config) -> list[Backup]:
+    """
+    Backup jobs of the config: the named jobs of backup.jobs if any, otherwise the
+    single backup
+    """
+    logger = logging.getLogger("backup")
+    backup_config = config.get(_BACKUP_CONFIG_JSON_OBJECT_NAME) if config else None
+    if (
+        not isinstance(backup_config, dict)
+        or not _JOBS_CONFIG_JSON_OBJECT_NAME in backup_config
+    ):
+        return [Backup(config)]
+
+    jobs = backup_config[_JOBS_CONFIG_JSON_OBJECT_NAME]
+    if not isinstance(jobs, list):
+        logger.error("%s is not a list", _JOBS_CONFIG_JSON_OBJECT_NAME)
+        return []
+
+    result = []
+    names = set()
+    for job in jobs:
+        name = job.get("name") if isinstance(job, dict) else None
+        if not isinstance(name, str) or not _JOB_NAME_PATTERN.match(name):
+            logger.error(
+                "backup job %s has no name, or a name with other than letters, digits, - and _",
+                job,
+            )
+            continue
+        if name in names:
+            logger.error("backup job %s is defined more than once", name)
+            continue
+        names.add(name)
+        result.append(Backup(config, job))
+
+    return result
+
+
 def run(config):
     logger = logging.getLogger("backup")
     logger.info("Backup to Phanas started")
 
-    backup = Backup(config)
+    jobs = []
+    for backup in backups(config):
+        if not backup.should_backup():
+            logger.info("%s is not configured", backup.display_name())
+            continue
+        logger.info(
+            "%s could skip this run: %s", backup.display_name(), backup.can_skip()
+        )
+        jobs.append(
+            Job(
+                backup.name(),
+                backup.target(),
+                lambda b=backup: run_leased(
+                    config,
+                    b.job_id(),
+                    b.display_name(),
+                    b.target() == DEFAULT_TARGET,
+                    b.do_backup,
+                ),
+            )
+        )
 
-    if backup.should_backup():
-        logger.info("Auto backup could skip this run: {}".format(backup.can_skip()))
-        status, msg = backup.do_backup()
-        if not status:
-            logger.error(msg)
-    else:
-        logger.info("Backup is not configured")
+    if jobs:
+        start = time.monotonic()
+        results = job_runner(config).run(jobs)
+        for result in results:
+            if not result.success:
+                logger.error(result.msg)
+            elif result.msg:
+                logger.info(result.msg)
+        phanas.metrics.record_phase(
+            config,
+            PHASE_BACKUP,
+            all(result.success for result in results),
+            time.monotonic() - start,
+        )
 
     logger.info("Backup to Phanas done")
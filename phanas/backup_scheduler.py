@@ -0,0 +1,282 @@
+import fcntl
+import logging
+import re
+import subprocess
+import sys
+import time
+
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from phanas.events import PHASE_BACKUP
+from phanas.job_runner import Job, job_runner
+from phanas.lease import run_leased
+from phanas.tree_index import ChangeSummary
+
+_DEFAULT_INTERVAL_IN_DAYS = 4
+_DEFAULT_MAX_AGE_IN_DAYS = 14
+_DEFAULT_MIN_INTERVAL_IN_HOURS = 12
+_DEFAULT_IDLE_MINUTES = 5
+_DEFAULT_CHANGED_BYTES_REFERENCE = 1024 * 1024 * 1024
+_DEFAULT_CHECK_INTERVAL_IN_MINUTES = 10
+
+# NMMetered values, see
+# https://networkmanager.dev/docs/api/latest/nm-dbus-types.html#NMMetered
+_NM_METERED_YES = 1
+_NM_METERED_GUESS_YES = 3
+
+_logger = logging.getLogger("scheduler")
+
+
+class SystemConditions:
+    """
+    Reads the state of the desktop session and of the machine. Each method returns None
+    when the state can't be determined (eg. not a Gnome session, NetworkManager not
+    running).
+    """
+
+    @staticmethod
+    def _gdbus_call(
+        bus: str, dest: str, object_path: str, method: str, *args: str
+    ) -> str | None:
+        command = [
+            "gdbus",
+            "call",
+            bus,
+            "--dest",
+            dest,
+            "--object-path",
+            object_path,
+            "--method",
+            method,
+            *args,
+        ]
+        try:
+            p = subprocess.run(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+                timeout=5,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        if p.returncode != 0:
+            return None
+        return p.stdout
+
+    def idle_seconds(self) -> float | None:
+        output = self._gdbus_call(
+            "--session",
+            "org.gnome.Mutter.IdleMonitor",
+            "/org/gnome/Mutter/IdleMonitor/Core",
+            "org.gnome.Mutter.IdleMonitor.GetIdletime",
+        )
+        # such as "(uint64 123456,)", in milliseconds
+        match = re.search(r"(\d+)", output) if output else None
+        return int(match.group(1)) / 1000 if match else None
+
+    def on_ac_power(self) -> bool | None:
+        power_supplies = list(Path("/sys/class/power_supply").glob("*"))
+        mains = [p for p in power_supplies if self._read(p / "type") == "Mains"]
+        if not mains:
+            # no mains adapter reported: a desktop machine is always on AC power, unless
+            # it has a battery
+            has_battery = any(
+                self._read(p / "type") == "Battery" for p in power_supplies
+            )
+            return None if has_battery else True
+        return any(self._read(p / "online") == "1" for p in mains)
+
+    def is_metered(self) -> bool | None:
+        output = self._gdbus_call(
+            "--system",
+            "org.freedesktop.NetworkManager",
+            "/org/freedesktop/NetworkManager",
+            "org.freedesktop.DBus.Properties.Get",
+            "org.freedesktop.NetworkManager",
+            "Metered",
+        )
+        # such as "(<uint32 4>,)"
+        match = re.search(r"uint32 (\d+)", output) if output else None
+        if not match:
+            return None
+        return int(match.group(1)) in (_NM_METERED_YES, _NM_METERED_GUESS_YES)
+
+    @staticmethod
+    def _read(file_path: Path) -> str | None:
+        try:
+            return file_path.read_text().strip()
+        except OSError:
+            return None
+
+
+class BackupScheduler:
+    """
+    Decides whether a backup should run now.
+
+    A backup is due interval_in_days after the last one. This interval shrinks when a
+    lot changed in the backup sources and grows when little changed: it is divided by
+    the square root of the ratio of changed bytes to changed_bytes_reference, within
+    min_interval_in_hours and max_age_in_days. When nothing changed, no backup is due
+    before max_age_in_days.
+
+    A due backup only runs when the session is idle, on AC power and not on a metered
+    network, unless the last backup is older than max_age_in_days, in which case it runs
+    regardless.
+
+    may_run() tells beforehand whether a backup could run whatever changed, so that
+    backup sources are only scanned when needed by decide().
+    """
+
+    def __init__(
+        self, schedule_config: dict, conditions: SystemConditions | None = None
+    ):
+        self._interval = timedelta(
+            days=schedule_config.get("interval_in_days", _DEFAULT_INTERVAL_IN_DAYS)
+        )
+        self._max_age = timedelta(
+            days=schedule_config.get("max_age_in_days", _DEFAULT_MAX_AGE_IN_DAYS)
+        )
+        self._min_interval = timedelta(
+            hours=schedule_config.get(
+                "min_interval_in_hours", _DEFAULT_MIN_INTERVAL_IN_HOURS
+            )
+        )
+        self._idle_s = 60 * schedule_config.get("idle_minutes", _DEFAULT_IDLE_MINUTES)
+        self._require_ac_power = schedule_config.get("require_ac_power", True)
+        self._allow_metered = schedule_config.get("allow_metered", False)
+        self._changed_bytes_reference = schedule_config.get(
+            "changed_bytes_reference", _DEFAULT_CHANGED_BYTES_REFERENCE
+        )
+        self._conditions = conditions or SystemConditions()
+
+    def interval(self, changes: ChangeSummary | None) -> timedelta:
+        if changes is None:
+            return self._interval
+        if not changes.changed_files():
+            return self._max_age
+        ratio = max(changes.changed_bytes / self._changed_bytes_reference, 0.01)
+        return min(max(self._interval / ratio**0.5, self._min_interval), self._max_age)
+
+    def may_run(self, last_backup: datetime | None) -> tuple[bool, str | None]:
+        """Returns whether the backup could run now, and why not"""
+        if last_backup is None:
+            return True, None
+
+        now = datetime.now()
+        if now - last_backup >= self._max_age:
+            return True, None
+
+        not_before = last_backup + self._min_interval
+        if now < not_before:
+            return False, f"next backup not before {not_before:%Y-%m-%d %H:%M}"
+
+        waiting_for = self._waiting_for()
+        if waiting_for:
+            return False, waiting_for
+        return True, None
+
+    def decide(
+        self, last_backup: datetime | None, changes: ChangeSummary | None
+    ) -> tuple[bool, str]:
+        """Returns whether to run the backup now, and why"""
+        if last_backup is None:
+            return True, "no previous backup"
+
+        now = datetime.now()
+        if now - last_backup >= self._max_age:
+            return True, f"last backup older than {self._max_age.days} days"
+
+        due_at = last_backup + self.interval(changes)
+        if now < due_at:
+            return (
+                False,
+                f"{changes or 'recent enough'}, next backup due {due_at:%Y-%m-%d %H:%M}",
+            )
+
+        waiting_for = self._waiting_for()
+        if waiting_for:
+            return False, f"backup due, {waiting_for}"
+
+        return True, "backup due"
+
+    def _waiting_for(self) -> str | None:
+        idle_s = self._conditions.idle_seconds()
+        if idle_s is not None and idle_s < self._idle_s:
+            return "waiting for the session to be idle"
+        if self._require_ac_power and self._conditions.on_ac_power() is False:
+            return "waiting for AC power"
+        if not self._allow_metered and self._conditions.is_metered():
+            return "waiting for a non metered network"
+        return None
+
+
+def run(config):
+    """
+    Runs forever, checking every few minutes whether each backup job should run,
+    typically started with the session. Only one scheduler runs per user and clone
+    directory.
+    """
+    import phanas.backup
+    import phanas.metrics
+
+    logger = logging.getLogger("scheduler")
+    lock_file_path = Path(sys.path[0]) / ".scheduler.lock"
+    lock_file = open(lock_file_path, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.info("backup scheduler already running")
+        return
+
+    schedule_config = config.get("backup", {}).get("schedule", {}) if config else {}
+    check_interval_s = 60 * schedule_config.get(
+        "check_interval_minutes", _DEFAULT_CHECK_INTERVAL_IN_MINUTES
+    )
+    logger.info("Backup scheduler started")
+    while True:
+        backups = [
+            backup for backup in phanas.backup.backups(config) if backup.should_backup()
+        ]
+        if not backups:
+            logger.info("Backup is not configured")
+            return
+
+        jobs = []
+        for backup in backups:
+            if backup.can_skip():
+                logger.info(
+                    "no %s: %s", backup.display_name().lower(), backup.skip_reason()
+                )
+            else:
+                jobs.append(
+                    Job(
+                        backup.name(),
+                        backup.target(),
+                        lambda b=backup: run_leased(
+                            config,
+                            b.job_id(),
+                            b.display_name(),
+                            b.target() == phanas.backup.DEFAULT_TARGET,
+                            b.do_backup,
+                        ),
+                    )
+                )
+
+        if jobs:
+            start = time.monotonic()
+            results = job_runner(config).run(jobs)
+            for result in results:
+                if not result.success:
+                    logger.error(result.msg)
+                elif result.msg:
+                    logger.info(result.msg)
+            phanas.metrics.record_phase(
+                config,
+                PHASE_BACKUP,
+                all(result.success for result in results),
+                time.monotonic() - start,
+            )
+
+        time.sleep(check_interval_s)
@@ -0,0 +1,360 @@
+import logging
+import os
+import random
+import sqlite3
+import stat
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import phanas.file_utils
+from phanas.snapshot_engine import list_snapshots
+from phanas.tree_index import scan_trees
+
+_BACKUP_CONFIG_JSON_OBJECT_NAME = "backup"
+_VERIFY_CONFIG_JSON_OBJECT_NAME = "verify"
+_JOBS_CONFIG_JSON_OBJECT_NAME = "jobs"
+_NATIVE_CONFIG_JSON_OBJECT_NAME = "native"
+
+_DEFAULT_SAMPLE_SIZE = 200
+_DEFAULT_WORKERS = 4
+_REPORT_TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+_logger = logging.getLogger("verify")
+
+
+class Corruption:
+    def __init__(self, path: Path, reason: str):
+        self.path: Path = path
+        self.reason: str = reason
+
+    def __str__(self):
+        return f"{self.path}: {self.reason}"
+
+
+class BackupVerifier:
+    """
+    Verifies that files of the latest backup snapshot can be read and match the backed
+    up files.
+
+    A checksum index records the hash of every verified file by inode, so files hard
+    linked from a previous snapshot are not verified again, and one snapshot containing
+    each inode, to find it when sampled. Each run verifies files new or changed since
+    the last verification, plus a sample of already verified files (least recently
+    verified first), re-hashed to detect silent corruption.
+
+    A snapshot file is compared to its source only when the source did not change since
+    it was backed up (same size and modification time), otherwise its hash is only
+    recorded. Only regular files are hashed: symbolic links are compared to their source
+    by target, and other special files are ignored.
+    """
+
+    def __init__(
+        self,
+        destination_path: Path,
+        index_file_path: Path,
+        source_root: Path | None,
+        native_layout: bool,
+        sample_size: int = _DEFAULT_SAMPLE_SIZE,
+        workers: int = _DEFAULT_WORKERS,
+    ):
+        self._destination_path = destination_path
+        self._index_file_path = index_file_path
+        self._source_root = source_root
+        self._native_layout = native_layout
+        self._sample_size = sample_size
+        self._workers = workers
+        self.corruptions: list[Corruption] = []
+        self.verified_count: int = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        self._index_file_path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self._index_file_path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS checksums "
+            "(inode INTEGER PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT, path TEXT, verified_at REAL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS inode_paths (inode INTEGER PRIMARY KEY, snapshot TEXT, path TEXT)"
+        )
+        return connection
+
+    def _source_of(self, relative_path: str) -> Path | None:
+        if self._native_layout:
+            return Path("/") / relative_path
+        if self._source_root:
+            return self._source_root / relative_path
+        return None
+
+    def verify(self) -> tuple[bool, str | None]:
+        snapshots = list_snapshots(self._destination_path)
+        if not snapshots:
+            return False, f"no backup snapshot found in {self._destination_path}"
+        snapshot = snapshots[-1]
+        snapshot_path = self._destination_path / snapshot
+        _logger.info("verifying snapshot %s...", snapshot_path)
+
+        files = scan_trees([snapshot_path], workers=self._workers * 2)
+        with self._connect() as connection:
+            known = {
+                inode: (size, mtime_ns, sha256)
+                for inode, size, mtime_ns, sha256 in connection.execute(
+                    "SELECT inode, size, mtime_ns, sha256 FROM checksums"
+                )
+            }
+            new_files = [
+                (path, file_stat)
+                for path, file_stat in files.items()
+                if known.get(file_stat[2], (None, None))[0:2] != file_stat[0:2]
+            ]
+            self._forget_expired(connection, snapshots, snapshot, snapshot_path, files)
+            sampled = self._sample(connection)
+        connection.close()
+
+        _logger.info(
+            "%s new or changed files to verify, %s already verified files sampled",
+            len(new_files),
+            len(sampled),
+        )
+
+        def verify_new(entry) -> tuple | None:
+            path, (size, mtime_ns, inode) = entry
+            relative_path = os.path.relpath(path, snapshot_path)
+            source = self._source_of(relative_path)
+            try:
+                mode = os.lstat(path).st_mode
+            except OSError as e:
+                self._report_unreadable(Path(path), e)
+                return None
+            if stat.S_ISLNK(mode):
+                self._verify_link(Path(path), source, size, mtime_ns)
+                return None
+            if not stat.S_ISREG(mode):
+                return None
+
+            sha256 = self._hash(Path(path))
+            if sha256 is None:
+                return None
+            if source and self._is_unchanged(source, size, mtime_ns):
+                source_sha256 = self._hash(source, report=False)
+                if source_sha256 is not None and source_sha256 != sha256:
+                    self.corruptions.append(
+                        Corruption(Path(path), f"content differs from {source}")
+                    )
+                    return None
+            return inode, size, mtime_ns, sha256, relative_path, time.time()
+
+        missing_inodes = []
+
+        def verify_sampled(entry) -> tuple | None:
+            inode, size, mtime_ns, expected_sha256, sampled_snapshot, path = entry
+            file_path = self._destination_path / sampled_snapshot / path
+            try:
+                file_stat = os.lstat(file_path)
+            except OSError:
+                file_stat = None
+            if (
+                file_stat is None
+                or file_stat.st_ino != inode
+                or not stat.S_ISREG(file_stat.st_mode)
+            ):
+                # snapshot expired since the file was verified
+                missing_inodes.append(inode)
+                return None
+            sha256 = self._hash(file_path)
+            if sha256 is None:
+                return None
+            if sha256 != expected_sha256:
+                self.corruptions.append(
+                    Corruption(file_path, "content changed since last verification")
+                )
+                return None
+            return inode, size, mtime_ns, sha256, path, time.time()
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            verified_new = [r for r in executor.map(verify_new, new_files) if r]
+            verified_sampled = [r for r in executor.map(verify_sampled, sampled) if r]
+        verified = verified_new + verified_sampled
+        self.verified_count = len(verified)
+
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO checksums (inode, size, mtime_ns, sha256, path, verified_at) VALUES (?, ?, ?, ?, ?, ?)",
+                verified,
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO inode_paths (inode, snapshot, path) VALUES (?, ?, ?)",
+                ((r[0], snapshot, r[4]) for r in verified_new),
+            )
+            self._forget(connection, missing_inodes)
+        connection.close()
+
+        if self.corruptions:
+            return (
+                False,
+                f"{len(self.corruptions)} corrupted files in backup snapshot {snapshot}",
+            )
+        return True, None
+
+    def _sample(self, connection: sqlite3.Connection) -> list[tuple]:
+        """
+        Random sample among the least recently verified files, with a snapshot
+        containing them
+        """
+        candidates = connection.execute(
+            "SELECT c.inode, c.size, c.mtime_ns, c.sha256, p.snapshot, p.path FROM checksums c "
+            "JOIN inode_paths p ON p.inode = c.inode ORDER BY c.verified_at LIMIT ?",
+            (self._sample_size * 4,),
+        ).fetchall()
+        return random.sample(candidates, min(self._sample_size, len(candidates)))
+
+    @staticmethod
+    def _forget_expired(
+        connection: sqlite3.Connection,
+        snapshots: list[str],
+        snapshot: str,
+        snapshot_path: Path,
+        files: dict,
+    ):
+        """
+        Inodes of expired snapshots are moved to the verified snapshot when still in it,
+        forgotten otherwise, so that the index does not grow with the snapshots
+        """
+        relative_paths = {
+            file_stat[2]: os.path.relpath(path, snapshot_path)
+            for path, file_stat in files.items()
+        }
+        indexed = [
+            row[0]
+            for row in connection.execute("SELECT DISTINCT snapshot FROM inode_paths")
+        ]
+        gone_inodes = []
+        for expired in (s for s in indexed if s not in snapshots):
+            for (inode,) in connection.execute(
+                "SELECT inode FROM inode_paths WHERE snapshot = ?", (expired,)
+            ).fetchall():
+                if inode in relative_paths:
+                    connection.execute(
+                        "UPDATE inode_paths SET snapshot = ?, path = ? WHERE inode = ?",
+                        (snapshot, relative_paths[inode], inode),
+                    )
+                else:
+                    gone_inodes.append(inode)
+        BackupVerifier._forget(connection, gone_inodes)
+
+    @staticmethod
+    def _forget(connection: sqlite3.Connection, inodes: list[int]):
+        for table in ("checksums", "inode_paths"):
+            connection.executemany(
+                f"DELETE FROM {table} WHERE inode = ?", ((inode,) for inode in inodes)
+            )
+
+    def _verify_link(self, path: Path, source: Path | None, size: int, mtime_ns: int):
+        try:
+            target = os.readlink(path)
+        except OSError as e:
+            self._report_unreadable(path, e)
+            return
+        if not source or not self._is_unchanged(source, size, mtime_ns):
+            return
+        try:
+            source_target = os.readlink(source)
+        except OSError:
+            return
+        if source_target != target:
+            self.corruptions.append(
+                Corruption(path, f"link target differs from {source}")
+            )
+
+    def _hash(self, file_path: Path, report: bool = True) -> str | None:
+        try:
+            return phanas.file_utils.compute_hash(file_path)
+        except OSError as e:
+            if report:
+                self._report_unreadable(file_path, e)
+            else:
+                _logger.error("can't read %s: %s", file_path, e)
+            return None
+
+    def _report_unreadable(self, file_path: Path, e: OSError):
+        _logger.error("can't read %s: %s", file_path, e)
+        self.corruptions.append(Corruption(file_path, f"unreadable: {e}"))
+
+    @staticmethod
+    def _is_unchanged(source: Path, size: int, mtime_ns: int) -> bool:
+        try:
+            stats = source.stat(follow_symlinks=False)
+        except OSError:
+            return False
+        return stats.st_size == size and stats.st_mtime_ns == mtime_ns
+
+    def write_report(self, report_path: Path):
+        with open(report_path, "w") as f:
+            f.write(
+                f"Verification of {self._destination_path}: {self.verified_count} files verified\n"
+            )
+            f.write(f"{len(self.corruptions)} corrupted files\n")
+            for corruption in self.corruptions:
+                f.write(f"{corruption}\n")
+
+
+def run(config):
+    logger = logging.getLogger("verify")
+    logger.info("Backup verification started")
+
+    backup_config = config.get(_BACKUP_CONFIG_JSON_OBJECT_NAME) if config else None
+    backup_config = backup_config if isinstance(backup_config, dict) else {}
+    jobs = backup_config.get(_JOBS_CONFIG_JSON_OBJECT_NAME)
+    if isinstance(jobs, list):
+        for job in jobs:
+            if isinstance(job, dict) and isinstance(job.get("name"), str):
+                _verify(job, job["name"])
+    else:
+        _verify(backup_config, None)
+
+    logger.info("Backup verification done")
+
+
+def _verify(backup_config: dict, job_name: str | None):
+    logger = logging.getLogger("verify")
+    verify_config = backup_config.get(_VERIFY_CONFIG_JSON_OBJECT_NAME)
+    verify_config = verify_config if isinstance(verify_config, dict) else {}
+    native_config = backup_config.get(_NATIVE_CONFIG_JSON_OBJECT_NAME)
+    native_config = native_config if isinstance(native_config, dict) else {}
+    display_name = f"Backup {job_name}" if job_name else "Backup"
+
+    destination = verify_config.get(
+        "destination",
+        backup_config.get("snapshots_destination", native_config.get("destination")),
+    )
+    if not isinstance(destination, str) or not destination:
+        logger.error("%s verification is not configured", display_name)
+        return
+
+    suffix = f"_{job_name}" if job_name else ""
+    source_root = verify_config.get("source")
+    script_dir = Path(sys.path[0])
+    verifier = BackupVerifier(
+        Path(destination),
+        script_dir / ".index" / f"backup_checksums{suffix}.sqlite",
+        source_root=Path(source_root).expanduser() if source_root else None,
+        native_layout=bool(native_config) and "destination" not in verify_config,
+        sample_size=verify_config.get("sample_size", _DEFAULT_SAMPLE_SIZE),
+        workers=verify_config.get("workers", _DEFAULT_WORKERS),
+    )
+
+    status, msg = verifier.verify()
+    timestamp = datetime.today().strftime(_REPORT_TIMESTAMP_FORMAT)
+    report_path = script_dir / "logs" / f"{timestamp}_verify_report{suffix}.log"
+    verifier.write_report(report_path)
+    if not status:
+        logger.error("%s, see report %s", msg, report_path)
+    else:
+        logger.info(
+            "%s files verified, no corruption, see report %s",
+            verifier.verified_count,
+            report_path,
+        )
@@ -1,8 +1,29 @@
-from contextlib import closing
+import atexit
+import logging
+import threading
+
 from pathlib import Path
 from abc import ABC, abstractmethod
 
 import secretstorage
+import secretstorage.util
+
+_logger = logging.getLogger("credentials")
+
+# one connection to the Secret Service per process, opened on first use. Blocking D-Bus
+# connections are not thread safe: they are used with the lock held
+_dbus_lock = threading.RLock()
+_dbus_connection: secretstorage.DBusConnection | None = None
+
+
+def _get_dbus_connection() -> secretstorage.DBusConnection:
+    global _dbus_connection
+    with _dbus_lock:
+        if _dbus_connection is None:
+            _dbus_connection = secretstorage.dbus_init()
+            atexit.register(_dbus_connection.close)
+        return _dbus_connection
+
 
 
 def _mask_password(s: str) -> str | None:
@@ -21,6 +42,13 @@ class Credentials(ABC):
     def get_keyfile_password(self, keyfile_relative_path: str) -> str | None:
         pass
 
+    def collect_keyfile_passwords(self, keyfile_relative_paths: list[str]):
+        """
+        Makes the passwords of the keyfiles available before they are requested, asking
+        the user for the missing ones at once
+        """
+        pass
+
 
 class CredentialsProvider(ABC):
     @abstractmethod
@@ -103,6 +131,20 @@ class InputProvider(ABC):
     def get_password(self, prompt: str) -> str | None:
         pass
 
+    def get_passwords(self, prompts: dict[str, str]) -> dict[str, str]:
+        """
+        Passwords provided for each key of prompts, a key is missing when no password
+        was provided. Implementations able to ask for several passwords at once (eg. a
+        single dialog) should override it.
+        """
+        passwords = {}
+        for key, prompt in prompts.items():
+            password = self.get_password(prompt=prompt)
+            if password:
+                passwords[key] = password
+        return passwords
+
+
 class KeyringCredentialsProvider(CredentialsProvider):
     def __init__(self, input_provider: InputProvider):
         self._input_provider = input_provider
@@ -116,31 +158,72 @@ class KeyringCredentialsProvider(CredentialsProvider):
 
 
 class KeyringCredentials(Credentials):
+    """
+    Keyfile passwords stored in the default collection of the Secret Service. Items are
+    searched once, their secret is only read when the password of a keyfile is
+    requested, after all locked items were unlocked at once, so that the user is
+    prompted at most once.
+    """
+
     def __init__(self, input_provider: InputProvider):
         self._keyfile_passwords: dict[str, str] = {}
+        self._keyfile_items: dict[str, secretstorage.Item] = {}
+        self._collection: secretstorage.Collection | None = None
+        self._unlocked: bool = False
         self._base_attributes: dict[str, str] = {'application': 'phanas_desktop', 'type': 'keyfile'}
         self._password_encoding: str = "utf-8"
         self._input_provider: InputProvider = input_provider
 
     def initialize(self) -> str | None:
-        with closing(secretstorage.dbus_init()) as dbus_connection:
-            return self._load_existing_keyfile_passwords(dbus_connection)
-
-    def _load_existing_keyfile_passwords(self, dbus_connection: secretstorage.DBusConnection) -> str | None:
-        collection = secretstorage.get_default_collection(dbus_connection)
-        items = collection.search_items(self._base_attributes)
-        for item in items:
-            relative_path = item.get_attributes().get("relative_path")
-            password = item.get_secret().decode(self._password_encoding)
-            self._keyfile_passwords[relative_path] = password
+        with _dbus_lock:
+            self._collection = secretstorage.get_default_collection(
+                _get_dbus_connection()
+            )
+            for item in self._collection.search_items(self._base_attributes):
+                relative_path = item.get_attributes().get("relative_path")
+                self._keyfile_items.setdefault(relative_path, item)
+
+        return None
 
+    def _unlock(self) -> str | None:
+        if self._unlocked:
+            return None
+
+        locked_paths = [
+            item.item_path for item in self._keyfile_items.values() if item.is_locked()
+        ]
+        if self._collection.is_locked():
+            # new passwords are stored in the collection
+            locked_paths.append(self._collection.collection_path)
+        if locked_paths:
+            _logger.debug("unlocking %s object(s) of the keyring", len(locked_paths))
+            dismissed = secretstorage.util.unlock_objects(
+                _get_dbus_connection(), locked_paths
+            )
+            if dismissed:
+                return "Unlocking the keyring was dismissed"
+        self._unlocked = True
         return None
 
+    def _read_keyfile_password_from_keyring(self, relative_path: str) -> str | None:
+        item = self._keyfile_items.get(relative_path)
+        if item is None:
+            return None
+        with _dbus_lock:
+            msg = self._unlock()
+            if msg:
+                _logger.warning(msg)
+                return None
+            return item.get_secret().decode(self._password_encoding)
+
     def _store_keyfile_password_in_keyring(self, relative_path: str, password: str):
-        with closing(secretstorage.dbus_init()) as dbus_connection:
-            collection = secretstorage.get_default_collection(dbus_connection)
+        with _dbus_lock:
+            msg = self._unlock()
+            if msg:
+                _logger.warning("%s, password of '%s' not stored", msg, relative_path)
+                return
             item_attributes = {**self._base_attributes, "relative_path": relative_path}
-            collection.create_item(
+            self._keyfile_items[relative_path] = self._collection.create_item(
                 label=f"PhanNAS Desktop : keyfile password : {relative_path}",
                 attributes=item_attributes,
                 secret=password.encode(self._password_encoding),
@@ -154,7 +237,14 @@ class KeyringCredentials(Credentials):
         if password:
             return password
 
-        password = self._input_provider.get_password(prompt=f"Provide password for keyfile '{keyfile_relative_path}': ")
+        password = self._read_keyfile_password_from_keyring(keyfile_relative_path)
+        if password:
+            self._keyfile_passwords[keyfile_relative_path] = password
+            return password
+
+        password = self._input_provider.get_password(
+            prompt=self._prompt(keyfile_relative_path)
+        )
         if password:
             self._keyfile_passwords[keyfile_relative_path] = password
             self._store_keyfile_password_in_keyring(relative_path=keyfile_relative_path, password=password)
@@ -162,3 +252,29 @@ class KeyringCredentials(Credentials):
 
         return None
 
+    def collect_keyfile_passwords(self, keyfile_relative_paths: list[str]):
+        missing = []
+        for relative_path in keyfile_relative_paths:
+            if relative_path in self._keyfile_passwords:
+                continue
+            password = self._read_keyfile_password_from_keyring(relative_path)
+            if password:
+                self._keyfile_passwords[relative_path] = password
+            else:
+                missing.append(relative_path)
+        if not missing:
+            return
+
+        _logger.info("asking for the password of %s", ", ".join(missing))
+        passwords = self._input_provider.get_passwords(
+            {p: self._prompt(p) for p in missing}
+        )
+        for relative_path, password in passwords.items():
+            self._keyfile_passwords[relative_path] = password
+            self._store_keyfile_password_in_keyring(
+                relative_path=relative_path, password=password
+            )
+
+    @staticmethod
+    def _prompt(keyfile_relative_path: str) -> str:
+        return f"Provide password for keyfile '{keyfile_relative_path}': "
@@ -0,0 +1,253 @@
+import logging
+import threading
+import time
+
+from abc import ABC, abstractmethod
+
+PHASE_AUTOMOUNT = "automount"
+PHASE_KEYFILE_SYNC = "keyfile_sync"
+PHASE_NASCOPY = "nascopy"
+PHASE_BACKUP = "backup"
+
+
+class Event:
+    def __init__(self, phase: str):
+        self.phase: str = phase
+        self.timestamp: float = time.time()
+
+    def __str__(self):
+        attributes = ", ".join(
+            f"{k}={v}" for k, v in vars(self).items() if k not in ("phase", "timestamp")
+        )
+        return f"{type(self).__name__}({self.phase}: {attributes})"
+
+
+class PhaseStarted(Event):
+    def __init__(self, phase: str, description: str):
+        super().__init__(phase)
+        self.description: str = description
+
+
+class PhaseEnded(Event):
+    def __init__(
+        self, phase: str, success: bool, msg: str | None = None, skipped: bool = False
+    ):
+        super().__init__(phase)
+        self.success: bool = success
+        self.msg: str | None = msg
+        # the phase had nothing to do, eg. not configured
+        self.skipped: bool = skipped
+
+
+class Message(Event):
+    """
+    Informative message. A persistent message describes an achieved state, otherwise an
+    ongoing operation
+    """
+
+    def __init__(self, phase: str, msg: str, persistent: bool = False):
+        super().__init__(phase)
+        self.msg: str = msg
+        self.persistent: bool = persistent
+
+
+class WarningMessage(Event):
+    def __init__(self, phase: str, msg: str):
+        super().__init__(phase)
+        self.msg: str = msg
+
+
+class ErrorMessage(Event):
+    def __init__(self, phase: str, msg: str):
+        super().__init__(phase)
+        self.msg: str = msg
+
+
+class ItemProgress(Event):
+    """
+    Progress of a phase processing items (drives, keyfiles, files...), totals are None
+    when unknown
+    """
+
+    def __init__(
+        self,
+        phase: str,
+        item: str | None,
+        done_count: int,
+        total_count: int | None = None,
+        done_bytes: int | None = None,
+        total_bytes: int | None = None,
+        bytes_per_s: float | None = None,
+        eta_s: float | None = None,
+    ):
+        super().__init__(phase)
+        self.item: str | None = item
+        self.done_count: int = done_count
+        self.total_count: int | None = total_count
+        self.done_bytes: int | None = done_bytes
+        self.total_bytes: int | None = total_bytes
+        self.bytes_per_s: float | None = bytes_per_s
+        self.eta_s: float | None = eta_s
+
+    def fraction(self) -> float | None:
+        if self.total_bytes and self.done_bytes is not None:
+            return min(1.0, self.done_bytes / self.total_bytes)
+        if self.total_count:
+            return min(1.0, self.done_count / self.total_count)
+        return None
+
+    def describe(self) -> str:
+        text = (
+            f"{self.done_count}/{self.total_count}"
+            if self.total_count
+            else f"{self.done_count}"
+        )
+        if self.done_bytes is not None:
+            text += f" ({format_bytes(self.done_bytes)})"
+        if self.bytes_per_s is not None:
+            text += f", {self.bytes_per_s / 1024 / 1024:.1f} MB/s"
+        if self.eta_s is not None:
+            minutes, seconds = divmod(int(self.eta_s), 60)
+            text += f", ETA {minutes // 60}:{minutes % 60:02d}:{seconds:02d}"
+        if self.item:
+            text += f" {self.item}"
+        return text
+
+
+class ItemDone(Event):
+    def __init__(
+        self,
+        phase: str,
+        item: str,
+        success: bool,
+        duration_s: float | None = None,
+        msg: str | None = None,
+    ):
+        super().__init__(phase)
+        self.item: str = item
+        self.success: bool = success
+        self.duration_s: float | None = duration_s
+        self.msg: str | None = msg
+
+
+def format_bytes(size: int) -> str:
+    if size < 1024:
+        return f"{size} B"
+    value = float(size)
+    for unit in ["KB", "MB", "GB", "TB"]:
+        value /= 1024
+        if value < 1024 or unit == "TB":
+            break
+    return f"{value:.1f} {unit}"
+
+
+class EventSink(ABC):
+    @abstractmethod
+    def handle(self, event: Event) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+
+class LogSink(EventSink):
+    def __init__(self, logger: logging.Logger):
+        self._logger = logger
+
+    def handle(self, event: Event) -> None:
+        extra = {"phase": event.phase}
+        if isinstance(event, PhaseStarted):
+            self._logger.info(event.description, extra=extra)
+        elif isinstance(event, PhaseEnded):
+            if event.msg:
+                self._logger.log(
+                    logging.INFO if event.success else logging.ERROR,
+                    event.msg,
+                    extra=extra,
+                )
+        elif isinstance(event, Message):
+            self._logger.info(event.msg, extra=extra)
+        elif isinstance(event, WarningMessage):
+            self._logger.warning(event.msg, extra=extra)
+        elif isinstance(event, ErrorMessage):
+            self._logger.error(event.msg, extra=extra)
+        elif not isinstance(event, ItemProgress):
+            self._logger.debug("%s", event, extra=extra)
+
+
+class EventBus(EventSink):
+    """
+    Dispatches events to every registered sink, in order of registration. A failing sink
+    is logged and does not prevent the other sinks from receiving the event.
+    """
+
+    def __init__(self, sinks: list[EventSink] | None = None):
+        self._sinks: list[EventSink] = list(sinks) if sinks else []
+        # serializes events of concurrent phases, reentrant so that a sink may emit
+        self._lock = threading.RLock()
+        self._logger = logging.getLogger("events")
+
+    def add_sink(self, sink: EventSink) -> None:
+        with self._lock:
+            self._sinks.append(sink)
+
+    def handle(self, event: Event) -> None:
+        with self._lock:
+            for sink in self._sinks:
+                try:
+                    sink.handle(event)
+                except Exception:
+                    self._logger.exception("sink %s failed to handle %s", sink, event)
+
+    def emit(self, event: Event) -> None:
+        self.handle(event)
+
+    def flush(self) -> None:
+        with self._lock:
+            for sink in self._sinks:
+                sink.flush()
+
+
+class CoalescingSink(EventSink):
+    """
+    Forwards at most one ItemProgress event per phase every min_interval_s seconds to
+    the wrapped sink. Progress events received in between are held back, only the most
+    recent one is kept, and are flushed before any other event is forwarded so that
+    sinks always see the final progress of a phase.
+    """
+
+    def __init__(self, sink: EventSink, min_interval_s: float = 0.25):
+        self._sink = sink
+        self._min_interval_s = min_interval_s
+        self._last_forwarded: dict[str, float] = {}
+        self._pending: dict[str, ItemProgress] = {}
+        self._lock = threading.Lock()
+
+    def handle(self, event: Event) -> None:
+        with self._lock:
+            if isinstance(event, ItemProgress):
+                now = time.monotonic()
+                last_forwarded = self._last_forwarded.get(event.phase)
+                if (
+                    last_forwarded is not None
+                    and now - last_forwarded < self._min_interval_s
+                ):
+                    self._pending[event.phase] = event
+                    return
+                self._pending.pop(event.phase, None)
+                self._last_forwarded[event.phase] = now
+            else:
+                self._flush()
+
+            self._sink.handle(event)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+        self._sink.flush()
+
+    def _flush(self) -> None:
+        pending = list(self._pending.values())
+        self._pending.clear()
+        for event in pending:
+            self._sink.handle(event)
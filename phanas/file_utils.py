@@ -1,13 +1,41 @@
+import errno
 import hashlib
 import json
 import logging
 import os
+import shutil
 import stat
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from phanas.hash_cache import HashCache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 __logger = logging.getLogger("file_utils")
+__hash_cache = None
+
+_COMPARE_BLOCK_SIZE = 1024 * 1024
+_COPY_BLOCK_SIZE = 1024 * 1024
+# ioctl sharing the extents of a file with another one, from linux/fs.h
+_FICLONE = 0x40049409
+# copy_file_range is not supported between these files, the copy is streamed
+_COPY_FILE_RANGE_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EINVAL,
+    errno.EBADF,
+}
+
+COPY_METHOD_REFLINK = "reflink"
+COPY_METHOD_COPY_FILE_RANGE = "copy_file_range"
+COPY_METHOD_STREAM = "stream"
 
 
 def read_config_file():
@@ -72,10 +100,163 @@ def make_readonly(file_path):
 
 
 def has_same_content(file_1_path, file_2_path):
-    return __compute_hash(file_1_path) == __compute_hash(file_2_path)
+    """
+    Compares files, using the hash cache for files unchanged since they were last hashed
+    """
+    return compare_files(file_1_path, file_2_path, hash_cache=_get_hash_cache())
+
+
+def cached_hash(file_path):
+    return _get_hash_cache().get_hash(file_path, compute_hash)
+
+
+def _get_hash_cache() -> HashCache:
+    global __hash_cache
+    if __hash_cache is None:
+        __hash_cache = HashCache(Path(sys.path[0]) / ".index" / "hash_cache.sqlite")
+    return __hash_cache
+
+
+def compare_files(
+    file_1_path, file_2_path, hash_cache: HashCache | None = None
+) -> bool:
+    """
+    Whether both files have the same content, from the cheapest check to the most
+    expensive: same inode, different sizes, cached hashes (with hash_cache), then
+    reading both files block by block up to the first difference. Files on different
+    devices (eg. local disk and NAS) are read concurrently.
+
+    With hash_cache, hashes of identical files are computed while reading them and
+    cached.
+    """
+    stat_1 = os.stat(file_1_path)
+    stat_2 = os.stat(file_2_path)
+    if (stat_1.st_dev, stat_1.st_ino) == (stat_2.st_dev, stat_2.st_ino):
+        return True
+    if stat_1.st_size != stat_2.st_size:
+        return False
+
+    if hash_cache:
+        hash_1 = hash_cache.lookup(file_1_path, stat_1)
+        hash_2 = hash_cache.lookup(file_2_path, stat_2)
+        if hash_1 and hash_2:
+            return hash_1 == hash_2
+        # only read the file whose hash is not cached
+        if hash_1:
+            return hash_1 == hash_cache.get_hash(file_2_path, compute_hash)
+        if hash_2:
+            return hash_2 == hash_cache.get_hash(file_1_path, compute_hash)
+
+    file_hash_1 = hashlib.sha256() if hash_cache else None
+    file_hash_2 = hashlib.sha256() if hash_cache else None
+    same = _compare_blocks(
+        file_1_path,
+        file_2_path,
+        concurrent=stat_1.st_dev != stat_2.st_dev,
+        hashes=(file_hash_1, file_hash_2),
+    )
+    if same and hash_cache:
+        hash_cache.store(file_1_path, stat_1, file_hash_1.hexdigest())
+        hash_cache.store(file_2_path, stat_2, file_hash_2.hexdigest())
+    return same
+
+
+def _compare_blocks(file_1_path, file_2_path, concurrent: bool, hashes: tuple) -> bool:
+    with open(file_1_path, "rb") as f1, open(file_2_path, "rb") as f2:
+        if not concurrent:
+            while True:
+                block_1 = f1.read(_COMPARE_BLOCK_SIZE)
+                block_2 = f2.read(_COMPARE_BLOCK_SIZE)
+                if block_1 != block_2:
+                    return False
+                if not block_1:
+                    return True
+                _update_hashes(hashes, block_1, block_2)
+
+        # read next block of file 2 in another thread while reading and comparing blocks
+        # of file 1
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_block_2 = executor.submit(f2.read, _COMPARE_BLOCK_SIZE)
+            while True:
+                block_1 = f1.read(_COMPARE_BLOCK_SIZE)
+                block_2 = next_block_2.result()
+                if block_1 != block_2:
+                    return False
+                if not block_1:
+                    return True
+                next_block_2 = executor.submit(f2.read, _COMPARE_BLOCK_SIZE)
+                _update_hashes(hashes, block_1, block_2)
+
+
+def _update_hashes(hashes: tuple, block_1: bytes, block_2: bytes):
+    hash_1, hash_2 = hashes
+    if hash_1:
+        hash_1.update(block_1)
+        hash_2.update(block_2)
+
+
+def copy_file(source_path, target_path) -> str:
+    """
+    Copies the content of source to target (created or truncated) and returns how it was
+    copied.
+
+    Files on the same filesystem are copied as a reflink (the copy shares the extents of
+    the source) or else with copy_file_range, which let filesystems such as CIFS copy
+    server-side: no byte goes through this host. Other files, or when the filesystem
+    supports neither, are streamed.
+    """
+    with open(source_path, "rb") as source, open(target_path, "wb") as target:
+        source_stat = os.fstat(source.fileno())
+        if source_stat.st_dev == os.fstat(target.fileno()).st_dev:
+            if _reflink(source, target):
+                return COPY_METHOD_REFLINK
+            if _copy_file_range(source, target, source_stat.st_size):
+                return COPY_METHOD_COPY_FILE_RANGE
+
+        shutil.copyfileobj(source, target, _COPY_BLOCK_SIZE)
+        return COPY_METHOD_STREAM
+
+
+def _reflink(source, target) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+        return True
+    except OSError as e:
+        __logger.debug("can't reflink %s to %s: %s", source.name, target.name, e)
+        return False
+
+
+def _copy_file_range(source, target, size: int) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    offset = 0
+    try:
+        while True:
+            # the size may change while copying, copy until the end of the file
+            copied = os.copy_file_range(
+                source.fileno(),
+                target.fileno(),
+                max(size - offset, _COPY_BLOCK_SIZE),
+                offset,
+                offset,
+            )
+            if copied == 0:
+                return True
+            offset += copied
+    except OSError as e:
+        if e.errno not in _COPY_FILE_RANGE_UNSUPPORTED_ERRNOS:
+            raise
+        __logger.debug(
+            "can't copy_file_range %s to %s: %s", source.name, target.name, e
+        )
+        # restart from scratch with a streamed copy
+        target.truncate(0)
+        return False
 
 
-def __compute_hash(file_path):
+def compute_hash(file_path):
     # from https://nitratine.net/blog/post/how-to-hash-files-in-python/
     BLOCK_SIZE = 65536
     file_hash = hashlib.sha256()
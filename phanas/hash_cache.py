@@ -0,0 +1,129 @@
+import logging
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+from typing import Callable
+
+_DEFAULT_MAX_ENTRIES = 10000
+# a file modified this recently may be modified again within the resolution of its
+# modification time, without its size nor modification time changing: its hash is not
+# cached
+_MIN_AGE_S = 2.0
+
+_logger = logging.getLogger("hash_cache")
+
+
+class HashCache:
+    """
+    Persistent cache of the hashes of files, so that unchanged files are not read again,
+    which matters for files on the NAS.
+
+    A hash is cached by absolute path, and used only while the size, modification time
+    and change time (which can't be set by programs, unlike the modification time) of
+    the file are those of when it was hashed. Not by device and inode: the device of
+    files on the NAS changes each time the share is mounted. The hash of a file modified while
+    hashing it or very recently is not cached. The least recently used hashes are
+    evicted beyond max_entries.
+    """
+
+    def __init__(self, index_file_path: Path, max_entries: int = _DEFAULT_MAX_ENTRIES):
+        self._index_file_path = index_file_path
+        self._max_entries = max_entries
+
+    def _connect(self) -> sqlite3.Connection:
+        self._index_file_path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self._index_file_path, timeout=10)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS path_hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            "ctime_ns INTEGER, sha256 TEXT, used_at REAL)"
+        )
+        return connection
+
+    def get_hash(self, file_path: Path, compute_hash: Callable[[Path], str]) -> str:
+        """
+        Hash of the file from the cache, computed with compute_hash when missing or out
+        of date
+        """
+        before = os.stat(file_path)
+        sha256 = self.lookup(file_path, before)
+        if sha256:
+            return sha256
+
+        sha256 = compute_hash(file_path)
+        self.store(file_path, before, sha256)
+        return sha256
+
+    def lookup(self, file_path: Path, file_stat: os.stat_result) -> str | None:
+        """Cached hash of the file, if any and up to date with file_stat"""
+        key = self._key_of(file_path)
+        cached_sha256 = None
+        try:
+            with self._connect() as connection:
+                row = connection.execute(
+                    "SELECT size, mtime_ns, ctime_ns, sha256 FROM path_hashes WHERE path = ?",
+                    (key,),
+                ).fetchone()
+                if row and tuple(row[0:3]) == self._stat_of(file_stat):
+                    cached_sha256 = row[3]
+                    connection.execute(
+                        "UPDATE path_hashes SET used_at = ? WHERE path = ?",
+                        (time.time(), key),
+                    )
+            connection.close()
+        except sqlite3.Error as e:
+            _logger.error("can't read hash cache %s: %s", self._index_file_path, e)
+        if cached_sha256:
+            _logger.debug("hash of %s from cache", file_path)
+        return cached_sha256
+
+    def store(self, file_path: Path, before: os.stat_result, sha256: str):
+        """
+        Caches the hash of the file, computed from its content as of before (its stat
+        before hashing it)
+        """
+        try:
+            after = os.stat(file_path)
+        except OSError:
+            return
+        if self._stat_of(after) != self._stat_of(before):
+            _logger.debug("%s changed while hashing it, hash not cached", file_path)
+            return
+        if time.time() - max(before.st_mtime_ns, before.st_ctime_ns) / 1e9 < _MIN_AGE_S:
+            _logger.debug("%s modified too recently, hash not cached", file_path)
+            return
+
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO path_hashes (path, size, mtime_ns, ctime_ns, sha256, used_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        self._key_of(file_path),
+                        *self._stat_of(before),
+                        sha256,
+                        time.time(),
+                    ),
+                )
+                self._evict(connection)
+            connection.close()
+        except sqlite3.Error as e:
+            _logger.error("can't write hash cache %s: %s", self._index_file_path, e)
+
+    @staticmethod
+    def _key_of(file_path: Path) -> str:
+        return os.path.abspath(file_path)
+
+    @staticmethod
+    def _stat_of(file_stat: os.stat_result) -> tuple[int, int, int]:
+        return file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ctime_ns
+
+    def _evict(self, connection: sqlite3.Connection):
+        count = connection.execute("SELECT COUNT(*) FROM path_hashes").fetchone()[0]
+        if count <= self._max_entries:
+            return
+        connection.execute(
+            "DELETE FROM path_hashes WHERE rowid IN (SELECT rowid FROM path_hashes ORDER BY used_at LIMIT ?)",
+            (count - self._max_entries,),
+        )
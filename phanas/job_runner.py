@@ -0,0 +1,105 @@
+import contextvars
+import logging
+import time
+
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable
+
+_JOBS_CONFIG_JSON_OBJECT_NAME = "jobs"
+_DEFAULT_MAX_PARALLEL = 2
+_DEFAULT_MAX_PER_TARGET = 1
+
+_logger = logging.getLogger("job_runner")
+
+
+class Job:
+    def __init__(
+        self, name: str, target: str, run: Callable[[], tuple[bool, str | None]]
+    ):
+        self.name: str = name
+        self.target: str = target
+        self.run: Callable[[], tuple[bool, str | None]] = run
+
+
+class JobResult:
+    def __init__(self, job: Job, success: bool, msg: str | None, duration_s: float):
+        self.job: Job = job
+        self.success: bool = success
+        self.msg: str | None = msg
+        self.duration_s: float = duration_s
+
+
+class JobRunner:
+    """
+    Runs jobs in parallel, at most max_parallel at once and at most max_per_target at
+    once on the same target (eg. a disk or the NAS), so that jobs on independent targets
+    overlap while jobs on the same target are serialized. Jobs are started in the given
+    order, skipping jobs whose target is busy.
+    """
+
+    def __init__(
+        self,
+        max_parallel: int = _DEFAULT_MAX_PARALLEL,
+        max_per_target: int = _DEFAULT_MAX_PER_TARGET,
+    ):
+        self._max_parallel = max(1, max_parallel)
+        self._max_per_target = max(1, max_per_target)
+
+    def run(
+        self, jobs: list[Job], on_done: Callable[[JobResult], None] | None = None
+    ) -> list[JobResult]:
+        """Runs all jobs, returns their results in the order of jobs"""
+        pending = list(jobs)
+        running: dict[Future, Job] = {}
+        running_per_target: Counter = Counter()
+        results: dict[Job, JobResult] = {}
+
+        with ThreadPoolExecutor(max_workers=self._max_parallel) as executor:
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= self._max_parallel:
+                        break
+                    if running_per_target[job.target] >= self._max_per_target:
+                        continue
+                    pending.remove(job)
+                    running_per_target[job.target] += 1
+                    _logger.info("starting job %s on %s", job.name, job.target)
+                    # jobs log within the context of the caller (eg. its phase)
+                    running[
+                        executor.submit(
+                            contextvars.copy_context().run, self._run_job, job
+                        )
+                    ] = job
+
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    running_per_target[job.target] -= 1
+                    result = future.result()
+                    results[job] = result
+                    if on_done:
+                        on_done(result)
+
+        return [results[job] for job in jobs]
+
+    @staticmethod
+    def _run_job(job: Job) -> JobResult:
+        started_at = time.time()
+        try:
+            success, msg = job.run()
+        except Exception as e:
+            _logger.exception("job %s failed", job.name)
+            success, msg = False, f"{job.name} failed: {e}"
+        duration_s = time.time() - started_at
+        _logger.info("job %s done in %.1fs, success: %s", job.name, duration_s, success)
+        return JobResult(job, success, msg, duration_s)
+
+
+def job_runner(config) -> JobRunner:
+    jobs_config = config.get(_JOBS_CONFIG_JSON_OBJECT_NAME) if config else None
+    jobs_config = jobs_config if isinstance(jobs_config, dict) else {}
+    return JobRunner(
+        max_parallel=jobs_config.get("max_parallel", _DEFAULT_MAX_PARALLEL),
+        max_per_target=jobs_config.get("max_per_target", _DEFAULT_MAX_PER_TARGET),
+    )
@@ -0,0 +1,362 @@
+import copy
+import logging
+import shutil
+
+from datetime import datetime, timezone
+
+try:
+    from lxml import etree
+    from pykeepass import PyKeePass
+    from pykeepass.entry import Entry
+    from pykeepass.exceptions import (
+        CredentialsError,
+        HeaderChecksumError,
+        PayloadChecksumError,
+    )
+except ImportError:
+    PyKeePass = None
+
+_logger = logging.getLogger("kdbx_merge")
+
+# time of elements without it, such as groups of older databases without location time
+_NO_TIME = datetime.min.replace(tzinfo=timezone.utc)
+
+
+class MergeNotSupported(Exception):
+    """
+    The databases use features the in-process merge does not handle, keepassxc-cli must
+    merge them
+    """
+
+
+def is_available() -> bool:
+    return PyKeePass is not None
+
+
+def merge(
+    local_file: str,
+    remote_file: str,
+    password: str,
+    logger: logging.LoggerAdapter | None = None,
+) -> tuple[bool, str | None]:
+    """
+    Merges two KeePass databases in-process, the same way as "keepassxc-cli merge" run
+    both ways, and writes the merged database to both files.
+
+    Each database is decrypted once: its key is derived once, and reused to encrypt the
+    merged database (both files share the credentials). The key of the local database is
+    tried first on the remote one, which succeeds when both files still have the same
+    KDF seed, such as after a previous synchronization.
+
+    Unlike keepassxc-cli, the custom data of the databases (Meta/CustomData) is not
+    merged, and histories are not trimmed to Meta/HistoryMaxItems.
+
+    Raises MergeNotSupported, before writing anything, when an entry to merge has
+    attachments or the databases can't be opened in-process.
+    """
+    logger = logger or _logger
+    try:
+        local = PyKeePass(local_file, password=password)
+        remote = _open_with_key_of(remote_file, password, local)
+    except CredentialsError:
+        return False, f"Invalid password for keyfile '{local_file}' or '{remote_file}'"
+    except Exception as e:
+        raise MergeNotSupported(f"can't open databases in-process: {e}") from e
+
+    changes = _merge_into(local, remote)
+    logger.info("%s changes merged from remote into local", changes)
+    # same header and KDF seed as when opened: the key derived to open it is reused to
+    # encrypt it
+    local.save(transformed_key=getattr(local, "transformed_key", None))
+    shutil.copyfile(local_file, remote_file)
+
+    return True, None
+
+
+def _open_with_key_of(file_path: str, password: str, other: "PyKeePass") -> "PyKeePass":
+    transformed_key = getattr(other, "transformed_key", None)
+    if transformed_key:
+        try:
+            return PyKeePass(file_path, transformed_key=transformed_key)
+        except (CredentialsError, HeaderChecksumError, PayloadChecksumError):
+            _logger.debug("%s has another KDF seed, deriving its key", file_path)
+    return PyKeePass(file_path, password=password)
+
+
+def _merge_into(target: "PyKeePass", source: "PyKeePass") -> int:
+    """
+    Merges source into target, with the semantics of KeePassXC's synchronization:
+    entries and groups are matched by UUID, the most recent location of an entry or
+    group wins (eg. moved to the recycle bin), the most recently modified version of an
+    entry wins and the other versions are kept in its history, and the most recently
+    modified name and properties of a group win. Entries and groups missing in target
+    are added, then the deletions of both databases are applied, unless the entry or
+    group was modified after it was deleted, or the group still has children.
+    """
+    target_root = target.tree.getroot()
+    source_root = source.tree.getroot()
+    changes = _merge_custom_icons(target_root, source_root)
+
+    merge = _Merge(target, source)
+    changes += merge.merge_group(target.root_group._element, source.root_group._element)
+    changes += merge.merge_deletions()
+
+    return changes
+
+
+class _Merge:
+    """Elements of the target database by UUID, updated while merging"""
+
+    def __init__(self, target: "PyKeePass", source: "PyKeePass"):
+        self._target = target
+        self._source = source
+        target_root = target.tree.getroot()
+        self._groups = {_uuid(g): g for g in target_root.iter("Group")}
+        self._entries = {_uuid(e): e for e in target_root.findall(".//Group/Entry")}
+
+    def merge_group(self, target_group, source_group) -> int:
+        """Merges the children of source_group into target_group, recursively"""
+        changes = 0
+        for source_element in source_group.findall("Entry"):
+            if source_element.find(".//Binary") is not None:
+                # attachments refer to the binaries of their database, by index
+                title = Entry(element=source_element, kp=self._source).title
+                raise MergeNotSupported(f"entry {title} has attachments")
+            entry_uuid = _uuid(source_element)
+            target_element = self._entries.get(entry_uuid)
+            if target_element is None:
+                target_element = copy.deepcopy(source_element)
+                _add_child(target_group, target_element)
+                self._entries[entry_uuid] = target_element
+                changes += 1
+                continue
+            changes += self._merge_location(
+                target_element, source_element, target_group
+            )
+            changes += self._merge_entry(target_element, source_element)
+
+        for source_child in source_group.findall("Group"):
+            group_uuid = _uuid(source_child)
+            target_child = self._groups.get(group_uuid)
+            if target_child is None:
+                target_child = copy.deepcopy(source_child)
+                for child in target_child.findall("Group") + target_child.findall(
+                    "Entry"
+                ):
+                    target_child.remove(child)
+                _add_child(target_group, target_child)
+                self._groups[group_uuid] = target_child
+                changes += 1
+            else:
+                changes += self._merge_location(
+                    target_child, source_child, target_group
+                )
+                target_mtime, source_mtime = self._mtimes(target_child, source_child)
+                if source_mtime > target_mtime:
+                    # eg. renamed
+                    _copy_group_data(target_child, source_child)
+                    changes += 1
+            changes += self.merge_group(target_child, source_child)
+
+        return changes
+
+    def _merge_location(self, target_element, source_element, target_parent) -> int:
+        """Moves target_element to target_parent when moved there more recently"""
+        if target_element.getparent() is target_parent:
+            return 0
+        source_location_time = _time(self._source, source_element, "LocationChanged")
+        if source_location_time <= _time(
+            self._target, target_element, "LocationChanged"
+        ):
+            return 0
+        if target_element is target_parent or target_element in set(
+            target_parent.iterancestors()
+        ):
+            # group moved into one of its children in the other database
+            return 0
+
+        target_element.getparent().remove(target_element)
+        _add_child(target_parent, target_element)
+        location_changed = target_element.find("Times/LocationChanged")
+        if location_changed is not None:
+            location_changed.text = self._target._encode_time(source_location_time)
+        return 1
+
+    def _merge_entry(self, target_element, source_element) -> int:
+        target_mtime, source_mtime = self._mtimes(target_element, source_element)
+        if source_mtime > target_mtime:
+            newer = copy.deepcopy(source_element)
+            _merge_histories(
+                newer, target_element, Entry(element=newer, kp=self._target)
+            )
+            # location was merged separately
+            _copy_text(newer, target_element, "Times/LocationChanged")
+            target_element.getparent().replace(target_element, newer)
+            self._entries[_uuid(newer)] = newer
+            return 1
+        return _merge_histories(
+            target_element,
+            source_element,
+            Entry(element=target_element, kp=self._target),
+            include_current=source_mtime < target_mtime,
+        )
+
+    def _mtimes(self, target_element, source_element) -> tuple[datetime, datetime]:
+        return (
+            _time(self._target, target_element, "LastModificationTime"),
+            _time(self._source, source_element, "LastModificationTime"),
+        )
+
+    def merge_deletions(self) -> int:
+        """
+        Applies the deletions of both databases to target, keeping the earliest deletion
+        time of each object, and records those applied or still pending (objects absent
+        from target)
+        """
+        deletions = {}
+        for kp in (self._target, self._source):
+            for deleted_object in kp.tree.getroot().findall(
+                "Root/DeletedObjects/DeletedObject"
+            ):
+                object_uuid = deleted_object.findtext("UUID")
+                deletion_time = kp._decode_time(deleted_object.findtext("DeletionTime"))
+                if (
+                    object_uuid not in deletions
+                    or deletion_time < deletions[object_uuid]
+                ):
+                    deletions[object_uuid] = deletion_time
+
+        changes = 0
+        root_group = self._target.root_group._element
+        # entries first, then groups from the deepest, so that a group is deleted only
+        # once its children are
+        elements = [self._entries[u] for u in deletions if u in self._entries] + sorted(
+            (self._groups[u] for u in deletions if u in self._groups),
+            key=lambda g: -len(list(g.iterancestors())),
+        )
+        for element in elements:
+            object_uuid = _uuid(element)
+            if (
+                element is root_group
+                or _time(self._target, element, "LastModificationTime")
+                > deletions[object_uuid]
+                or (
+                    element.tag == "Group"
+                    and (
+                        element.find("Entry") is not None
+                        or element.find("Group") is not None
+                    )
+                )
+            ):
+                # modified after it was deleted, or group with children not deleted
+                del deletions[object_uuid]
+                continue
+            element.getparent().remove(element)
+            (self._entries if element.tag == "Entry" else self._groups).pop(object_uuid)
+            changes += 1
+
+        target_root = self._target.tree.getroot()
+        deleted_objects = target_root.find("Root/DeletedObjects")
+        if deleted_objects is None:
+            deleted_objects = etree.SubElement(
+                target_root.find("Root"), "DeletedObjects"
+            )
+        deleted_objects.clear()
+        for object_uuid, deletion_time in deletions.items():
+            deleted_object = etree.SubElement(deleted_objects, "DeletedObject")
+            etree.SubElement(deleted_object, "UUID").text = object_uuid
+            etree.SubElement(deleted_object, "DeletionTime").text = (
+                self._target._encode_time(deletion_time)
+            )
+
+        return changes
+
+
+def _merge_histories(
+    element, other_element, entry: "Entry", include_current: bool = True
+) -> int:
+    """
+    Adds to the history of element the versions of other_element (history and,
+    optionally, current) it lacks
+    """
+    history = element.find("History")
+    if history is None:
+        history = etree.SubElement(element, "History")
+
+    known = {_mtime_text(e) for e in history.findall("Entry")} | {_mtime_text(element)}
+    versions = list(other_element.findall("History/Entry"))
+    if include_current:
+        current = copy.deepcopy(other_element)
+        current_history = current.find("History")
+        if current_history is not None:
+            current.remove(current_history)
+        versions.append(current)
+
+    added = 0
+    for version in versions:
+        if _mtime_text(version) in known:
+            continue
+        history.append(copy.deepcopy(version))
+        known.add(_mtime_text(version))
+        added += 1
+    if added:
+        # KeePassXC keeps history oldest first
+        history[:] = sorted(history, key=lambda e: Entry(element=e, kp=entry._kp).mtime)
+    return added
+
+
+def _merge_custom_icons(target_root, source_root) -> int:
+    target_icons = target_root.find("Meta/CustomIcons")
+    if target_icons is None:
+        target_icons = etree.SubElement(target_root.find("Meta"), "CustomIcons")
+    known = {icon.findtext("UUID") for icon in target_icons.findall("Icon")}
+    added = 0
+    for icon in source_root.findall("Meta/CustomIcons/Icon"):
+        if icon.findtext("UUID") not in known:
+            target_icons.append(copy.deepcopy(icon))
+            added += 1
+    return added
+
+
+def _add_child(parent, element):
+    # entries of a group come before its groups
+    if element.tag == "Entry":
+        first_group = parent.find("Group")
+        if first_group is not None:
+            first_group.addprevious(element)
+            return
+    parent.append(element)
+
+
+def _copy_group_data(target_group, source_group):
+    """Replaces the properties of target_group with those of source_group"""
+    location_changed = target_group.find("Times/LocationChanged")
+    children = [c for c in target_group if c.tag in ("Group", "Entry")]
+    target_group.clear()
+    for child in source_group:
+        if child.tag not in ("Group", "Entry"):
+            target_group.append(copy.deepcopy(child))
+    target_group.extend(children)
+    # location was merged separately
+    new_location_changed = target_group.find("Times/LocationChanged")
+    if location_changed is not None and new_location_changed is not None:
+        new_location_changed.text = location_changed.text
+
+
+def _copy_text(element, other_element, path: str):
+    other = other_element.find(path)
+    if other is not None and element.find(path) is not None:
+        element.find(path).text = other.text
+
+
+def _time(kp: "PyKeePass", element, name: str) -> datetime:
+    text = element.findtext(f"Times/{name}")
+    return kp._decode_time(text) if text else _NO_TIME
+
+
+def _uuid(element) -> str | None:
+    return element.findtext("UUID") if element is not None else None
+
+
+def _mtime_text(element) -> str | None:
+    return element.findtext("Times/LastModificationTime")
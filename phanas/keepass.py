@@ -1,20 +1,36 @@
+import contextlib
 import logging
 import os
-from itertools import chain
 
 import getpass
 import phanas.automount
 import phanas.file_utils
+import phanas.kdbx_merge
+import phanas.metrics
 import phanas.nas
 import shutil
 import socket
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
-from datetime import datetime, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from itertools import chain
 from pathlib import Path
+from typing import NamedTuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
+from phanas.keyfile_backup_index import BackupPair, KeyfileBackupIndex
+from phanas.object_store import ObjectStore
+from phanas.retention import RetentionPolicy
+from phanas.events import PHASE_KEYFILE_SYNC
 from phanas.credentials import Credentials, CredentialsProvider, FileCredentialsProvider, KeyringCredentialsProvider, \
     InputProvider
 
@@ -24,16 +40,75 @@ _MD5SUM = "md5sum"
 
 _KEEPASS_CONFIG_JSON_OBJECT_NAME = "keepass"
 _KEYFILES_CONFIG_JSON_OBJECT_NAME = "keyfiles"
+_WORKERS_CONFIG_JSON_OBJECT_NAME = "workers"
+_DEFAULT_WORKERS = 4
+_MERGE_ENGINE_CONFIG_JSON_OBJECT_NAME = "merge_engine"
+_MERGE_ENGINE_AUTO = "auto"
+_MERGE_ENGINE_CLI = "cli"
+_RETENTION_CONFIG_JSON_OBJECT_NAME = "retention"
 
 _BACKUP_DATE_FORMAT = "%Y-%m-%d"
 _BACKUP_TIMESTAMP_FORMAT = f"{_BACKUP_DATE_FORMAT}_%H-%M-%S"
-_BACKUP_EXPIRATION_IN_DAYS = 60
+_DEFAULT_RETENTION = RetentionPolicy(keep_all_days=60)
+# backups of keyfiles no longer configured, and legacy backups at the root of the backup
+# directory, are indexed as orphans: they expire after this age, whatever the retention
+# policy
+_UNINDEXED_BACKUP_EXPIRATION_IN_DAYS = 60
+# backups are deleted, and the backup index updated, by batches
+_BACKUP_DELETION_BATCH_SIZE = 20
+_PREFETCH_ATTEMPTS = 3
+
+# what changed in a keyfile since its latest synchronization, as classified by
+# KeePass._classify_keyfile
+_UNCHANGED = "unchanged"
+_LOCAL_CHANGED = "local changed"
+_REMOTE_CHANGED = "remote changed"
+_BOTH_CHANGED = "both changed"
 
 _KEYFILE_DIR_NAME = "keys"
 _SYNC_BACKUP_DIR_NAME = "_sync_backup"
+# keyfile backups are references to keyfiles stored by content in the objects directory
+# of the backup directory
+_OBJECTS_DIR_NAME = "objects"
+_BACKUP_REF_SUFFIX = ".ref"
 
 _logger = logging.getLogger("keepass")
 
+
+class _KeyfileLoggerAdapter(logging.LoggerAdapter):
+    """
+    Prefixes messages with the keyfile they are about, as keyfiles are synchronized
+    concurrently
+    """
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}
+        return f"[{self.extra['keyfile']}] {msg}", kwargs
+
+
+class KeyfileSync(NamedTuple):
+    """What to do with a keyfile, decided before synchronizing"""
+
+    keyfile: "KeyFile"
+    change: str
+    reason: str | None
+    # copy of the remote keyfile in the temp directory, taken while planning, and stat
+    # of the remote keyfile it is a copy of
+    remote_copy_path: Path
+    remote_stat: os.stat_result
+
+
+class _RemoteKeyfileChanged(Exception):
+    """The remote keyfile changed since it was copied to the temp directory"""
+
+
+class SyncPlan(NamedTuple):
+    keyfile_syncs: tuple[KeyfileSync, ...]
+
+    def to_sync(self) -> tuple[KeyfileSync, ...]:
+        return tuple(s for s in self.keyfile_syncs if s.change != _UNCHANGED)
+
+
 class KeyFile:
     def __init__(self, relative_path:str, local_path:Path, remote_path:Path):
         self.relative_path: str = relative_path
@@ -41,7 +116,6 @@ class KeyFile:
         self.parent_name: str = relative_path.split("/")[0]
         self.local_path: Path = local_path
         self.remote_path: Path = remote_path
-
     def local_file_exists(self) -> bool:
         return self.local_path.is_file()
 
@@ -54,6 +128,7 @@ class KeyFile:
     def __str__(self):
         return f"Keyfile({self.relative_path}: {self.parent_name}, {self.name}, local_path='{self.local_path}', remote_path='{self.remote_path}')"
 
+
 # Changes compared to previous code
 # *
 # Changes compared to previous behavior
@@ -66,7 +141,6 @@ class KeyFile:
 class KeePass:
     __keyfile_password = None
 
-
     def __init__(self, config, credentials_provider: CredentialsProvider | None = None):
         self._keepass_config: dict = {}
         if _KEEPASS_CONFIG_JSON_OBJECT_NAME in config and isinstance(config.get(_KEEPASS_CONFIG_JSON_OBJECT_NAME), dict):
@@ -87,6 +161,7 @@ class KeePass:
         # from https://stackoverflow.com/a/31867043
         script_dir = Path(sys.path[0])
         self._temp_dir_path = script_dir / ".tmp"
+        self._lock_file_path = script_dir / ".keepass.lock"
 
         self._credentials_file_path = script_dir / ".kpx_phanas"
         if credentials_provider:
@@ -94,12 +169,17 @@ class KeePass:
         else:
             self.credentials_provider = FileCredentialsProvider(self._credentials_file_path)
         self._credentials: Credentials | None = None
+        self._credentials_future: Future | None = None
 
         self._legacy_keyfile: KeyFile | None = None
         self._keyfiles: list[KeyFile] | None = None
         self._load_keyfiles()
 
         self._linux_user_sync_backup_dir_path: Path | None = None
+        self._backup_index: KeyfileBackupIndex | None = None
+        self._backup_objects: ObjectStore | None = None
+        self._run_timestamp: str | None = None
+        self._retention_thread: threading.Thread | None = None
 
         self._keepassxc_cli: Path | None = None
         self._md5sum: Path | None = None
@@ -139,25 +219,111 @@ class KeePass:
     def should_synch_keyfiles(self):
         return self._keyfiles and any([s.remote_file_exists() for s in self._keyfiles])
 
-    def do_sync(self) -> tuple[bool, str | None]:
-        status, msg = self._check_prerequisites()
+    def keyfiles(self) -> list[KeyFile]:
+        return list(self._keyfiles or [])
+
+    def preload_credentials(self):
+        """
+        Loads credentials, asking for the missing keyfile passwords, in the background
+        so that it happens while the NAS drives are mounted rather than once the
+        synchronization starts.
+        """
+        if self._credentials_future is not None or not self._keyfiles:
+            return
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="credentials")
+        self._credentials_future = executor.submit(self._load_credentials)
+        executor.shutdown(wait=False)
+
+    def _load_credentials(self) -> tuple[Credentials | None, str | None]:
+        credentials, msg = self.credentials_provider.load_credentials()
+        if msg:
+            return None, msg
+        if not credentials.is_legacy_credentials_file():
+            credentials.collect_keyfile_passwords(
+                [keyfile.relative_path for keyfile in self._keyfiles]
+            )
+        return credentials, None
+
+    @contextlib.contextmanager
+    def _sync_lock(self):
+        """
+        Only one process synchronizes keyfiles, or deletes their backups, at a time (eg.
+        login and --keepass-watch)
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_file_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def do_sync(
+        self, relative_paths: list[str] | None = None
+    ) -> tuple[bool, str | None]:
+        """Synchronizes all keyfiles, or only those of relative_paths"""
+        with self._sync_lock():
+            status, msg = self._do_sync(relative_paths)
         if not status:
             return False, f"Can't synchronize keyfiles\n{msg}"
 
-        status, msg = self._sync_files()
+        return True, None
+
+    def _do_sync(self, relative_paths: list[str] | None) -> tuple[bool, str | None]:
+        status, msg = self._check_prerequisites()
         if not status:
-            return False, f"Can't synchronize keyfiles\n{msg}"
+            return False, msg
 
-        return True, None
+        keyfiles = [
+            k
+            for k in self._keyfiles
+            if relative_paths is None or k.relative_path in relative_paths
+        ]
+        prefetches: dict[KeyFile, Future] = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self._workers()) as executor:
+                # remote keyfiles are copied to the temp directory while the other
+                # prerequisites are checked
+                prefetches = {
+                    keyfile: executor.submit(self._prefetch_remote_keyfile, keyfile)
+                    for keyfile in keyfiles
+                }
+
+                status, msg = self._check_keyfile_prerequisites(executor, prefetches)
+                if status:
+                    plan = self._plan_sync(executor, prefetches)
+                    status, msg = self._sync_files(executor, plan)
+                    self._start_backup_retention()
+        finally:
+            self._discard_prefetched(prefetches)
+
+        return status, msg
+
+    def _workers(self) -> int:
+        return max(
+            1,
+            self._keepass_config.get(
+                _WORKERS_CONFIG_JSON_OBJECT_NAME, _DEFAULT_WORKERS
+            ),
+        )
 
     def _check_prerequisites(self) -> tuple[bool, str | None]:
         # keepassxc-cli is installed
         self._keepassxc_cli = shutil.which(_KEEPASSXC_CLI_SNAP)
         if self._keepassxc_cli is None:
             self._keepassxc_cli = shutil.which(_KEEPASSXC_CLI)
-        if self._keepassxc_cli is None:
-            return False, f"Neither {_KEEPASSXC_CLI} nor {_KEEPASSXC_CLI_SNAP} is installed"
-        _logger.info("keepassxc-cli found: %s", self._keepassxc_cli)
+        if self._keepassxc_cli is None and not self._in_process_merge():
+            return (
+                False,
+                f"Neither {_KEEPASSXC_CLI} nor {_KEEPASSXC_CLI_SNAP} is installed",
+            )
+        _logger.info(
+            "keepassxc-cli found: %s, in-process merge: %s",
+            self._keepassxc_cli,
+            self._in_process_merge(),
+        )
 
         # md5 is installed
         self._md5sum = shutil.which(_MD5SUM)
@@ -174,12 +340,56 @@ class KeePass:
             return False, f"{self._sys_drive_path} is not a directory"
         if not os.path.ismount(self._sys_drive_path):
             return False, f"{self._sys_drive_path} is not mounted"
-        # remote key dir is a directory
-        if not self._remote_keyfile_dir_path.is_dir():
-            return False, f"{self._remote_keyfile_dir_path} is not a directory"
 
-        # Credentials can be loaded
-        credentials, msg = self.credentials_provider.load_credentials()
+        # temp dir and local dir either do not exist (we'll create it) or are
+        # directories
+        if self._temp_dir_path.exists() and not self._temp_dir_path.is_dir():
+            return False, f"'{self._temp_dir_path}' is not a directory"
+        if self._local_dir_path.exists() and not self._local_dir_path.is_dir():
+            return False, f"'{self._local_dir_path}' is not a directory"
+
+        # local keyfiles directory exist
+        if not self._local_dir_path.exists() or not self._local_dir_path.is_dir():
+            return False, f"{self._local_dir_path} does not exist or is not a directory"
+
+        # linux username is resolved
+        if not self._linux_username:
+            return False, "linux username could not be resolved"
+
+        if not self._temp_dir_path.exists():
+            _logger.info("%s does not exists, creating it...", self._temp_dir_path)
+            self._temp_dir_path.mkdir()
+
+        self._linux_user_sync_backup_dir_path = (
+            self._remote_keyfile_dir_path
+            / _SYNC_BACKUP_DIR_NAME
+            / self._hostname
+            / self._linux_username
+        )
+        self._backup_index = KeyfileBackupIndex(self._linux_user_sync_backup_dir_path)
+        self._backup_objects = ObjectStore(
+            self._linux_user_sync_backup_dir_path / _OBJECTS_DIR_NAME, suffix=".kdbx"
+        )
+
+        return True, None
+
+    def _check_keyfile_prerequisites(
+        self, executor: ThreadPoolExecutor, prefetches: dict[KeyFile, Future]
+    ) -> tuple[bool, str | None]:
+        # directories on the NAS are checked concurrently with loading credentials,
+        # which may wait for the user
+        remote_keyfile_dir_is_dir = executor.submit(
+            self._remote_keyfile_dir_path.is_dir
+        )
+        backup_dir_is_dir = executor.submit(
+            self._linux_user_sync_backup_dir_path.is_dir
+        )
+
+        # Credentials can be loaded, unless already preloaded
+        if self._credentials_future is not None:
+            credentials, msg = self._credentials_future.result()
+        else:
+            credentials, msg = self._load_credentials()
         if msg:
             return False, msg
         _logger.debug("credentials: %s", credentials)
@@ -209,158 +419,535 @@ class KeePass:
                 "{how_to_migrate_message}"
             )
 
-        # linux username is resolved
-        if not self._linux_username:
-            return False, "linux username could not be resolved"
-
-        # local keyfiles directory exist
-        if not self._local_dir_path.exists() or not self._local_dir_path.is_dir():
-            return False, f"{self._local_dir_path} does not exist or is not a directory"
-
-        # remote keyfiles exist
-        for keyfile in self._keyfiles:
-            if not keyfile.remote_path.is_file():
-                return False, f"{keyfile.remote_path} does not exist"
-
-        self._linux_user_sync_backup_dir_path = (
-                self._remote_keyfile_dir_path / _SYNC_BACKUP_DIR_NAME / self._hostname / self._linux_username
-        )
+        # remote key dir is a directory
+        if not remote_keyfile_dir_is_dir.result():
+            return False, f"{self._remote_keyfile_dir_path} is not a directory"
 
         # require backup directory for current host and linux username to exist
         # as a safety to not trigger and run unwanted for a new username
-        if not self._linux_user_sync_backup_dir_path.is_dir():
+        if not backup_dir_is_dir.result():
             return False, f"{self._linux_user_sync_backup_dir_path} is not a directory. Create it to enable keyfile sync."
 
-        # temp dir and local dir either do not exist (we'll create it) or are directories
-        if self._temp_dir_path.exists() and not self._temp_dir_path.is_dir():
-            return False, f"'{self._temp_dir_path}' is not a directory"
-        if self._local_dir_path.exists() and not self._local_dir_path.is_dir():
-            return False, f"'{self._local_dir_path}' is not a directory"
-
-        # remote keyfiles exist
-        for keyfile in self._keyfiles:
-            # remote keyfile exists
-            if not keyfile.remote_file_exists():
-                return False, "{} is not a file".format(keyfile.remote_path)
+        # remote keyfiles exist: they have been copied to the temp directory
+        for keyfile, prefetch in prefetches.items():
+            try:
+                if prefetch.result() is None:
+                    return False, f"{keyfile.remote_path} does not exist"
+            except OSError as e:
+                return False, f"Can't read {keyfile.remote_path}: {e}"
 
         return True, None
 
-    def _sync_files(self) -> tuple[bool, str | None]:
-        need_sync, msg = self._need_sync()
-        if not need_sync:
-            _logger.info(f"Keyfiles do not need sync%s", msg if msg else "")
-            return True, None
-        elif msg:
-            _logger.info(f"Keyfiles need sync%s", msg)
+    def _prefetch_remote_keyfile(
+        self, keyfile: KeyFile
+    ) -> tuple[Path, os.stat_result] | None:
+        """
+        Copies the remote keyfile to the temp directory, returns the copy and the stat
+        of the remote keyfile it is a copy of, None when it does not exist
+        """
+        fd, temp_path = tempfile.mkstemp(
+            dir=self._temp_dir_path, prefix=f"{keyfile.name}.nas."
+        )
+        os.close(fd)
+        try:
+            for _ in range(_PREFETCH_ATTEMPTS):
+                remote_stat = os.stat(keyfile.remote_path)
+                phanas.file_utils.copy_file(keyfile.remote_path, temp_path)
+                if self._same_stat(os.stat(keyfile.remote_path), remote_stat):
+                    return Path(temp_path), remote_stat
+                _logger.info(
+                    "%s changed while copying it, copying it again...",
+                    keyfile.remote_path,
+                )
+            raise OSError(f"{keyfile.remote_path} keeps changing")
+        except BaseException as e:
+            os.unlink(temp_path)
+            if isinstance(e, FileNotFoundError):
+                return None
+            raise
 
-        if not self._temp_dir_path.exists():
-            _logger.info("%s does not exists, creating it...", self._temp_dir_path)
-            self._temp_dir_path.mkdir()
+    @staticmethod
+    def _same_stat(stat_1: os.stat_result, stat_2: os.stat_result) -> bool:
+        return (stat_1.st_size, stat_1.st_mtime_ns) == (
+            stat_2.st_size,
+            stat_2.st_mtime_ns,
+        )
+
+    @staticmethod
+    def _discard_prefetched(prefetches: dict[KeyFile, Future]):
+        for prefetch in prefetches.values():
+            if prefetch.exception() is None and prefetch.result() is not None:
+                remote_copy_path, _ = prefetch.result()
+                remote_copy_path.unlink(missing_ok=True)
+
+    def _plan_sync(
+        self, executor: ThreadPoolExecutor, prefetches: dict[KeyFile, Future]
+    ) -> SyncPlan:
+        """
+        Classifies all keyfiles concurrently, against the copies of the remote keyfiles
+        """
+        keyfiles = list(prefetches)
+        keyfile_syncs = tuple(
+            executor.map(
+                lambda keyfile: self._plan_keyfile_sync(
+                    keyfile, *prefetches[keyfile].result()
+                ),
+                keyfiles,
+            )
+        )
+        for keyfile_sync in keyfile_syncs:
+            _logger.info(
+                "keyfile '%s': %s%s",
+                keyfile_sync.keyfile.relative_path,
+                keyfile_sync.change,
+                f" ({keyfile_sync.reason})" if keyfile_sync.reason else "",
+            )
+        return SyncPlan(keyfile_syncs=keyfile_syncs)
+
+    def _plan_keyfile_sync(
+        self, keyfile: KeyFile, remote_copy_path: Path, remote_stat: os.stat_result
+    ) -> KeyfileSync:
+        change, reason = self._classify_keyfile(
+            keyfile=keyfile, remote_copy_path=remote_copy_path
+        )
+        return KeyfileSync(
+            keyfile=keyfile,
+            change=change,
+            reason=reason,
+            remote_copy_path=remote_copy_path,
+            remote_stat=remote_stat,
+        )
+
+    def _sync_files(
+        self, executor: ThreadPoolExecutor, plan: SyncPlan
+    ) -> tuple[bool, str | None]:
+        keyfile_syncs = plan.to_sync()
+        if not keyfile_syncs:
+            _logger.info("Keyfiles do not need sync")
+            return True, None
 
         success, msg = self._prepare_for_backup()
         if not success:
             return False, msg
 
-        for keyfile in self._keyfiles:
-            need_sync, _ = self._keyfile_need_sync(keyfile)
-            if need_sync:
-                success, msg = self._sync_files_of_keyfile(keyfile)
-                if not success:
-                    return False, msg
+        keyfiles_to_sync = [s.keyfile for s in keyfile_syncs]
+        self._run_timestamp = self._new_run_timestamp(keyfiles_to_sync)
+        _logger.info(
+            "synchronizing %s keyfiles with %s workers...",
+            len(keyfiles_to_sync),
+            self._workers(),
+        )
+        results = list(executor.map(self._sync_files_of_keyfile_safely, keyfile_syncs))
+
+        failures = [
+            f"{keyfile.relative_path}: {msg}"
+            for keyfile, (success, msg) in zip(keyfiles_to_sync, results)
+            if not success
+        ]
+        if failures:
+            synchronized_count = len(keyfiles_to_sync) - len(failures)
+            if synchronized_count:
+                failures.append(f"{synchronized_count} other keyfiles synchronized")
+            return False, "\n".join(failures)
 
         return True, None
 
-    def _sync_files_of_keyfile(self, keyfile) -> tuple[bool, str | None]:
-        # backup local and remote keyfiles
-        status, msg = self._backup_keyfiles(keyfile=keyfile)
-        if not status:
-            return False, msg
+    def _new_run_timestamp(self, keyfiles: list[KeyFile]) -> str:
+        """
+        Timestamp of the backups of all keyfiles synchronized by this run, such that no
+        backup exists with this timestamp yet (eg. previous run in the same second)
+        """
+        while True:
+            timestamp = datetime.today().strftime(_BACKUP_TIMESTAMP_FORMAT)
+            if not any(
+                (
+                    self._linux_user_sync_backup_dir_path
+                    / keyfile.parent_name
+                    / f"{timestamp}_{side}_{keyfile.name}{suffix}"
+                ).exists()
+                for keyfile in keyfiles
+                for side in ("local", "nas")
+                # legacy backups are full copies, without suffix
+                for suffix in (_BACKUP_REF_SUFFIX, "")
+            ):
+                return timestamp
+            time.sleep(1)
+
+    def _sync_files_of_keyfile_safely(
+        self, keyfile_sync: KeyfileSync
+    ) -> tuple[bool, str | None]:
+        logger = _KeyfileLoggerAdapter(
+            _logger, {"keyfile": keyfile_sync.keyfile.relative_path}
+        )
+        try:
+            success, msg = self._sync_files_of_keyfile(keyfile_sync, logger)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.exception("synchronization failed")
+            success, msg = False, str(e)
+        logger.info("synchronization %s", "done" if success else f"failed: {msg}")
+        return success, msg
+
+    def _sync_files_of_keyfile(
+        self, keyfile_sync: KeyfileSync, logger: logging.LoggerAdapter
+    ) -> tuple[bool, str | None]:
+        keyfile = keyfile_sync.keyfile
+        # copies of the remote keyfile taken here, the one taken while planning is
+        # discarded by _do_sync
+        remote_copies: list[Path] = []
+        try:
+            if self._remote_changed(keyfile_sync):
+                # eg. by another host while waiting for passwords
+                logger.info(
+                    "%s changed since planning, planning again", keyfile.remote_path
+                )
+                prefetched = self._refetch_remote_keyfile(keyfile, remote_copies)
+                if prefetched is None:
+                    return False, f"{keyfile.remote_path} no longer exists"
+                keyfile_sync = self._plan_keyfile_sync(keyfile, *prefetched)
+                if keyfile_sync.change == _UNCHANGED:
+                    return True, None
+
+            # backup local and remote keyfiles
+            status, msg = self._backup_keyfiles(
+                keyfile_sync=keyfile_sync, logger=logger
+            )
+            if not status:
+                return False, msg
+
+            for _ in range(_PREFETCH_ATTEMPTS):
+                try:
+                    return self._apply_keyfile_sync(keyfile_sync, logger)
+                except _RemoteKeyfileChanged:
+                    # its new content is merged rather than overwritten
+                    logger.info(
+                        "%s changed while synchronizing, merging it",
+                        keyfile.remote_path,
+                    )
+                    prefetched = self._refetch_remote_keyfile(keyfile, remote_copies)
+                    if prefetched is None:
+                        return False, f"{keyfile.remote_path} no longer exists"
+                    remote_copy_path, remote_stat = prefetched
+                    keyfile_sync = keyfile_sync._replace(
+                        change=_BOTH_CHANGED,
+                        reason="remote keyfile changed while synchronizing",
+                        remote_copy_path=remote_copy_path,
+                        remote_stat=remote_stat,
+                    )
+            return False, f"{keyfile.remote_path} keeps changing"
+        finally:
+            for remote_copy in remote_copies:
+                remote_copy.unlink(missing_ok=True)
+
+    def _remote_changed(self, keyfile_sync: KeyfileSync) -> bool:
+        """Whether the remote keyfile changed since it was copied to the temp directory"""
+        try:
+            remote_stat = os.stat(keyfile_sync.keyfile.remote_path)
+        except FileNotFoundError:
+            return True
+        return not self._same_stat(remote_stat, keyfile_sync.remote_stat)
+
+    def _refetch_remote_keyfile(
+        self, keyfile: KeyFile, remote_copies: list[Path]
+    ) -> tuple[Path, os.stat_result] | None:
+        prefetched = self._prefetch_remote_keyfile(keyfile)
+        if prefetched is not None:
+            remote_copies.append(prefetched[0])
+        return prefetched
+
+    def _apply_keyfile_sync(
+        self, keyfile_sync: KeyfileSync, logger: logging.LoggerAdapter
+    ) -> tuple[bool, str | None]:
+        """
+        Writes the up to date keyfile to both sides. Raises _RemoteKeyfileChanged,
+        before writing the remote keyfile, when it changed since it was copied.
+        """
+        keyfile = keyfile_sync.keyfile
+        remote_copy = keyfile_sync.remote_copy_path
+
+        # only one side changed since the latest synchronization: it is the up to date
+        # keyfile, no merge needed
+        if keyfile_sync.change == _LOCAL_CHANGED:
+            return self._copy_verified(
+                keyfile.local_path,
+                keyfile.remote_path,
+                logger,
+                target_stat=keyfile_sync.remote_stat,
+            )
+        if keyfile_sync.change == _REMOTE_CHANGED:
+            return self._copy_verified(remote_copy, keyfile.local_path, logger)
 
-        # create local temp copies of remote file and local file
+        # create local temp copy of local file, the copy of remote file was taken while
+        # planning
         with tempfile.NamedTemporaryFile(dir=self._temp_dir_path) as local_copy:
-            with tempfile.NamedTemporaryFile(dir=self._temp_dir_path) as remote_copy:
-                _logger.info("temp files: local '%s' => '%s', remote '%s' => '%s'",
-                             keyfile.local_path, local_copy.name, keyfile.remote_path, remote_copy.name)
-
-                shutil.copyfile(keyfile.local_path, local_copy.name)
-                shutil.copyfile(keyfile.remote_path, remote_copy.name)
-
-                # sync remote to local and the other way around
-                _logger.info("merging local keyfile into remote...")
-                success, msg = self.__merge_keyfiles(keyfile=keyfile, from_file=remote_copy.name, into_file=local_copy.name)
-                if not success:
-                    # TODO remove backups to avoid preventing new attempt to synchronize
-                    return False, msg
-                _logger.info("merging remote keyfile into local...")
-                success, msg = self.__merge_keyfiles(keyfile=keyfile, from_file=local_copy.name, into_file=remote_copy.name)
-                if not success:
-                    # TODO remove backups to avoid preventing new attempt to synchronize
-                    return False, msg
-
-                # overwrite remote and local with up to date file
-                shutil.copy(remote_copy.name, keyfile.remote_path)
-                _logger.info("%s synchronized", keyfile.remote_path)
-                shutil.copy(local_copy.name, keyfile.local_path)
-                _logger.info("%s synchronized", keyfile.local_path)
-
-                # TODO remove merge marker file (requires function to get the marker file path, tricky...)
-
-        return True, None
-
-    def _keyfile_need_sync(self, keyfile:KeyFile) -> tuple[bool, str | None]:
-        # if local keyfile doesn't exist, need to sync
-        if not keyfile.local_file_exists():
-            return True, f"{keyfile.local_path} does not exist"
+            logger.info(
+                "temp files: local '%s' => '%s', remote '%s' => '%s'",
+                keyfile.local_path,
+                local_copy.name,
+                keyfile.remote_path,
+                remote_copy,
+            )
 
-        latest_local_backup_path, local_timestamp = self._get_latest_backup(keyfile=keyfile, local=True)
-        latest_remote_backup_path, remote_timestamp = self._get_latest_backup(keyfile=keyfile, local=False)
+            shutil.copyfile(keyfile.local_path, local_copy.name)
+
+            if self._in_process_merge():
+                password = self._credentials.get_keyfile_password(
+                    keyfile_relative_path=keyfile.relative_path
+                )
+                try:
+                    logger.info("merging local and remote keyfiles in-process...")
+                    success, msg = phanas.kdbx_merge.merge(
+                        local_copy.name, str(remote_copy), password, logger
+                    )
+                    if not success:
+                        return False, msg
+                    return self._copy_back(keyfile_sync, local_copy.name, logger)
+                except phanas.kdbx_merge.MergeNotSupported as e:
+                    if not self._keepassxc_cli:
+                        return (
+                            False,
+                            f"Can't merge keyfile '{keyfile.relative_path}': {e}",
+                        )
+                    logger.info("%s, falling back to %s", e, self._keepassxc_cli)
+
+            # sync remote to local and the other way around
+            logger.info("merging local keyfile into remote...")
+            success, msg = self.__merge_keyfiles(
+                keyfile=keyfile,
+                logger=logger,
+                from_file=str(remote_copy),
+                into_file=local_copy.name,
+            )
+            if not success:
+                # TODO remove backups to avoid preventing new attempt to synchronize
+                return False, msg
+            logger.info("merging remote keyfile into local...")
+            success, msg = self.__merge_keyfiles(
+                keyfile=keyfile,
+                logger=logger,
+                from_file=local_copy.name,
+                into_file=str(remote_copy),
+            )
+            if not success:
+                # TODO remove backups to avoid preventing new attempt to synchronize
+                return False, msg
+
+            return self._copy_back(keyfile_sync, local_copy.name, logger)
+
+    def _copy_back(
+        self,
+        keyfile_sync: KeyfileSync,
+        local_copy: str,
+        logger: logging.LoggerAdapter,
+    ) -> tuple[bool, str | None]:
+        keyfile = keyfile_sync.keyfile
+        if self._remote_changed(keyfile_sync):
+            raise _RemoteKeyfileChanged(keyfile.remote_path)
+        # overwrite remote and local with up to date file
+        shutil.copy(keyfile_sync.remote_copy_path, keyfile.remote_path)
+        logger.info("%s synchronized", keyfile.remote_path)
+        shutil.copy(local_copy, keyfile.local_path)
+        logger.info("%s synchronized", keyfile.local_path)
+
+        # TODO remove merge marker file (requires function to get the marker file path,
+        # tricky...)
 
-        # if either backup is missing, need to sync
-        if latest_local_backup_path is None or latest_remote_backup_path is None:
-            return True, "Either local backup or remote backup is missing"
+        return True, None
 
-        # if backups don't have same timestamp, need to sync
-        if not local_timestamp == remote_timestamp:
-            return (
-                True,
-                f"Latest backup of remote ({latest_remote_backup_path.name}) doesn't have the same timestamp "
-                f"as latest backup of local ({latest_local_backup_path.name})"
+    @staticmethod
+    def _copy_verified(
+        source_path: Path,
+        target_path: Path,
+        logger: logging.LoggerAdapter,
+        target_stat: os.stat_result | None = None,
+    ) -> tuple[bool, str | None]:
+        """
+        Replaces target with a copy of source, only once the copy is verified to be
+        identical to source. Raises _RemoteKeyfileChanged when target no longer has
+        target_stat.
+        """
+        temp_path = target_path.with_name(f".{target_path.name}.phanas-tmp")
+
+        try:
+            copy_method = phanas.file_utils.copy_file(source_path, temp_path)
+            logger.info(
+                "%s copied to %s (%s copy)", source_path, temp_path, copy_method
             )
+            if not phanas.file_utils.compare_files(source_path, temp_path):
+                return (
+                    False,
+                    f"copy of '{source_path}' to '{target_path}' differs from the original",
+                )
+            shutil.copymode(target_path, temp_path)
+            if target_stat is not None and not KeePass._same_stat(
+                os.stat(target_path), target_stat
+            ):
+                raise _RemoteKeyfileChanged(target_path)
+            os.replace(temp_path, target_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+        logger.info("%s synchronized", target_path)
 
-        # TODO if merge marker file exists, return true
+        return True, None
 
-        # if content of local keyfile changed since last backup, need to sync
-        if not phanas.file_utils.has_same_content(latest_local_backup_path, keyfile.local_path):
-            return True, f"local keyfile '{keyfile.relative_path}' content changed"
+    def _in_process_merge(self) -> bool:
+        """
+        Whether to merge keyfiles in-process rather than with keepassxc-cli
+        (keepass.merge_engine). Opt-in, the in-process merge does not merge the custom
+        data of databases nor trims histories as keepassxc-cli does
+        """
+        engine = self._keepass_config.get(
+            _MERGE_ENGINE_CONFIG_JSON_OBJECT_NAME, _MERGE_ENGINE_CLI
+        )
+        return engine == _MERGE_ENGINE_AUTO and phanas.kdbx_merge.is_available()
+
+    def _classify_keyfile(
+        self, keyfile: KeyFile, remote_copy_path: Path
+    ) -> tuple[str, str | None]:
+        """
+        What changed in the keyfile since its latest synchronization, and why, from its
+        latest backup pair. The remote keyfile is read from its copy in the temp
+        directory.
+
+        Backups are taken before synchronizing, so a side is unchanged since the latest
+        synchronization when it still has the content of either backup: its own (the
+        synchronization kept it) or the other side's (it was overwritten with it).
+        """
+        # if local keyfile doesn't exist, remote keyfile is copied to local
+        if not keyfile.local_file_exists():
+            return _REMOTE_CHANGED, f"{keyfile.local_path} does not exist"
 
-        # if content of remote keyfile changed since last backup, need to sync
-        if not phanas.file_utils.has_same_content(latest_remote_backup_path, keyfile.remote_path):
-            return True, f"remote keyfile '{keyfile.relative_path}' content changed"
+        if phanas.file_utils.has_same_content(keyfile.local_path, remote_copy_path):
+            return _UNCHANGED, None
 
-        return False, None
+        backup_pair, msg = self._get_latest_backup_pair(keyfile=keyfile)
+        # if backups are missing or inconsistent, what changed is unknown
+        if backup_pair is None:
+            return _BOTH_CHANGED, msg
 
-    def _need_sync(self) -> tuple[bool, str | None]:
-        for keyfile in self._keyfiles:
-            need_sync, msg = self._keyfile_need_sync(keyfile=keyfile)
-            if need_sync:
-                return True, msg
+        # TODO if merge marker file exists, return both changed
+
+        backup_hashes = backup_pair.hashes()
+        local_changed = (
+            phanas.file_utils.cached_hash(keyfile.local_path) not in backup_hashes
+        )
+        remote_changed = (
+            phanas.file_utils.compute_hash(remote_copy_path) not in backup_hashes
+        )
+        if local_changed and not remote_changed:
+            return (
+                _LOCAL_CHANGED,
+                f"local keyfile '{keyfile.relative_path}' content changed",
+            )
+        if remote_changed and not local_changed:
+            return (
+                _REMOTE_CHANGED,
+                f"remote keyfile '{keyfile.relative_path}' content changed",
+            )
+        return (
+            _BOTH_CHANGED,
+            f"local and remote keyfile '{keyfile.relative_path}' contents differ",
+        )
 
-        return False, None
+    def _get_latest_backup_pair(
+        self, keyfile: KeyFile
+    ) -> tuple[BackupPair | None, str | None]:
+        history = self._backup_history(keyfile=keyfile)
+        if not history:
+            return None, "Either local backup or remote backup is missing"
 
-    def _get_latest_backup(self, keyfile: KeyFile, local: bool) -> tuple[Path, datetime]:
-        max_date = None
-        latest_backup_path = None
-        pattern = f"{keyfile.parent_name}/*_{"local" if local else "nas"}_{keyfile.name}"
-        _logger.debug(f"Looking for files matching pattern '{pattern} in {self._linux_user_sync_backup_dir_path}...")
-        for file in self._linux_user_sync_backup_dir_path.glob(pattern):
-            timestamp = self._read_timestamp_from_backup_file(file)
-            if max_date is None or max_date < timestamp:
-                max_date = timestamp
-                latest_backup_path = file
+        latest_backup_pair = history[-1]
+        if not latest_backup_pair.is_complete():
+            return (
+                None,
+                f"Latest backup of keyfile '{keyfile.relative_path}' ({latest_backup_pair.timestamp}) "
+                f"has no {"local" if latest_backup_pair.local_backup is None else "remote"} keyfile",
+            )
 
-        return latest_backup_path, max_date
+        return latest_backup_pair, None
+
+    def _backup_history(self, keyfile: KeyFile) -> list[BackupPair]:
+        """
+        Backup pairs of the keyfile from the backup index, which is rebuilt from the
+        backup directory when it has no entry for the keyfile or the latest backups no
+        longer exist
+        """
+        history = self._backup_index.history(keyfile.relative_path)
+        if history is not None:
+            if not history or all(
+                (self._linux_user_sync_backup_dir_path / b).is_file()
+                for b in history[-1].backups()
+            ):
+                return history
+            _logger.info(
+                "%s of keyfile '%s' no longer exists, rebuilding index",
+                history[-1],
+                keyfile.relative_path,
+            )
 
-    def __merge_keyfiles(self, keyfile: KeyFile, into_file: str, from_file: str):
+        history = self._scan_backups(keyfile=keyfile)
+        self._backup_index.set_history(keyfile.relative_path, history)
+        return history
+
+    def _scan_backups(self, keyfile: KeyFile) -> list[BackupPair]:
+        backup_pairs: dict[str, BackupPair] = {}
+        for side in ("local", "nas"):
+            # references to the object store, and full copies taken by previous versions
+            for suffix in (_BACKUP_REF_SUFFIX, ""):
+                pattern = f"{keyfile.parent_name}/*_{side}_{keyfile.name}{suffix}"
+                _logger.debug(
+                    f"Looking for files matching pattern '{pattern} in {self._linux_user_sync_backup_dir_path}..."
+                )
+                for file in self._linux_user_sync_backup_dir_path.glob(pattern):
+                    try:
+                        timestamp = self._read_timestamp_from_backup_file(
+                            file
+                        ).strftime(_BACKUP_TIMESTAMP_FORMAT)
+                    except ValueError:
+                        continue
+                    if file.name != f"{timestamp}_{side}_{keyfile.name}{suffix}":
+                        continue
+                    backup_pair = backup_pairs.setdefault(
+                        timestamp,
+                        BackupPair(
+                            timestamp=timestamp, local_backup=None, nas_backup=None
+                        ),
+                    )
+                    setattr(
+                        backup_pair,
+                        f"{side}_backup",
+                        str(file.relative_to(self._linux_user_sync_backup_dir_path)),
+                    )
+                    if suffix:
+                        # hashes of all references are known, to not delete objects
+                        # still referenced
+                        setattr(backup_pair, f"{side}_sha256", file.read_text().strip())
+
+        history = sorted(backup_pairs.values(), key=lambda p: p.timestamp)
+        # only the latest pair is compared to the keyfiles
+        if history and history[-1].is_complete():
+            latest_backup_pair = history[-1]
+            if latest_backup_pair.local_sha256 is None:
+                latest_backup_pair.local_sha256 = phanas.file_utils.compute_hash(
+                    self._linux_user_sync_backup_dir_path
+                    / latest_backup_pair.local_backup
+                )
+            if latest_backup_pair.nas_sha256 is None:
+                latest_backup_pair.nas_sha256 = phanas.file_utils.compute_hash(
+                    self._linux_user_sync_backup_dir_path
+                    / latest_backup_pair.nas_backup
+                )
+        _logger.info(
+            "%s backups of keyfile '%s' found", len(history), keyfile.relative_path
+        )
+        return history
+
+    def __merge_keyfiles(
+        self,
+        keyfile: KeyFile,
+        logger: logging.LoggerAdapter,
+        into_file: str,
+        from_file: str,
+    ):
         command = [
             self._keepassxc_cli,
             "merge",
@@ -369,7 +956,7 @@ class KeePass:
             from_file,
         ]
 
-        _logger.info("Running command: %s", command)
+        logger.info("Running command: %s", command)
         proc = subprocess.Popen(
             command,
             stdin=subprocess.PIPE,
@@ -379,8 +966,8 @@ class KeePass:
         )
         password = self._credentials.get_keyfile_password(keyfile_relative_path=keyfile.relative_path)
         outs, errs = proc.communicate(input=password)
-        _logger.info("*********** output ***********\n%s", outs)
-        _logger.info("***********  errs  ***********\n%s", errs)
+        logger.info("*********** output ***********\n%s", outs)
+        logger.info("***********  errs  ***********\n%s", errs)
 
         if proc.returncode != 0:
             if "Des identifiants invalides ont été fournis" in errs:
@@ -388,12 +975,7 @@ class KeePass:
             return False, "Merge command '{}' failed, check the logs".format(" ".join(command))
         return True, None
 
-
     def _prepare_for_backup(self) -> tuple[bool, str | None]:
-        status, msg = self._expire_old_backups()
-        if not status:
-            return False, msg
-
         # sync backup directory exists or we create it
         for d in [
             self._linux_user_sync_backup_dir_path.parents[1],
@@ -414,12 +996,17 @@ class KeePass:
             if not dir_path.is_dir():
                 return False, f"{dir_path} is not a directory"
         else:
-            dir_path.mkdir()
+            # keyfiles synchronized concurrently may share a directory
+            dir_path.mkdir(exist_ok=True)
 
         return True, None
 
-    def _backup_keyfiles(self, keyfile: KeyFile) -> tuple[bool, str | None]:
-        timestamp = datetime.today().strftime(_BACKUP_TIMESTAMP_FORMAT)
+    def _backup_keyfiles(
+        self, keyfile_sync: KeyfileSync, logger: logging.LoggerAdapter
+    ) -> tuple[bool, str | None]:
+        keyfile = keyfile_sync.keyfile
+        remote_copy_path = keyfile_sync.remote_copy_path
+        timestamp = self._run_timestamp
         keyfile_backup_dir = self._linux_user_sync_backup_dir_path / keyfile.parent_name
 
         # make sure local and backup dir for this keyfile exist
@@ -429,46 +1016,251 @@ class KeePass:
         if not keyfile.local_keyfile_directory().exists() or not keyfile.local_path.exists():
             # When local keyfile directory and/or local keyfile do not exist, create them as exact copy of remote
             keyfile.local_keyfile_directory().mkdir(exist_ok=True)
-            shutil.copyfile(src=keyfile.remote_path, dst=keyfile.local_path, follow_symlinks=False)
+            shutil.copyfile(
+                src=remote_copy_path, dst=keyfile.local_path, follow_symlinks=False
+            )
 
         status, msg = self._make_sure_is_directory(keyfile.local_keyfile_directory())
         if not status:
             return False, msg
 
-        remote_keyfile_backup_path = keyfile_backup_dir / f"{timestamp}_nas_{keyfile.name}"
-        local_keyfile_backup_path = keyfile_backup_dir / f"{timestamp}_local_{keyfile.name}"
+        remote_keyfile_backup_path = (
+            keyfile_backup_dir / f"{timestamp}_nas_{keyfile.name}{_BACKUP_REF_SUFFIX}"
+        )
+        local_keyfile_backup_path = (
+            keyfile_backup_dir / f"{timestamp}_local_{keyfile.name}{_BACKUP_REF_SUFFIX}"
+        )
 
         if remote_keyfile_backup_path.exists() or local_keyfile_backup_path.exists():
             return False, f"backup file '{remote_keyfile_backup_path}' or '{local_keyfile_backup_path}' already exists"
 
-        _logger.info("remote keyfile backup for %s is %s", keyfile.relative_path, remote_keyfile_backup_path)
-        _logger.info("local keyfile backup for %s is %s", keyfile.relative_path, local_keyfile_backup_path)
+        # make sure previous backups are indexed, for retention
+        self._backup_history(keyfile=keyfile)
+
+        # the remote keyfile is hashed from its copy in the temp directory and, unless
+        # already stored, copied server-side from the NAS when it did not change since
+        # it was copied
+        remote_sha256 = phanas.file_utils.compute_hash(remote_copy_path)
+        if self._same_stat(os.stat(keyfile.remote_path), keyfile_sync.remote_stat):
+            self._backup_keyfile(
+                keyfile.remote_path,
+                remote_keyfile_backup_path,
+                logger,
+                sha256=remote_sha256,
+                source_stat=keyfile_sync.remote_stat,
+            )
+        else:
+            logger.info(
+                "%s changed since planning, backing up its copy", keyfile.remote_path
+            )
+            self._backup_keyfile(
+                remote_copy_path,
+                remote_keyfile_backup_path,
+                logger,
+                sha256=remote_sha256,
+            )
+        local_sha256 = self._backup_keyfile(
+            keyfile.local_path, local_keyfile_backup_path, logger
+        )
 
-        shutil.copyfile(src=keyfile.remote_path, dst=remote_keyfile_backup_path, follow_symlinks=False)
-        shutil.copyfile(src=keyfile.local_path, dst=local_keyfile_backup_path, follow_symlinks=False)
-        phanas.file_utils.make_readonly(remote_keyfile_backup_path)
-        phanas.file_utils.make_readonly(local_keyfile_backup_path)
+        self._backup_index.add(
+            keyfile.relative_path,
+            BackupPair(
+                timestamp=timestamp,
+                local_backup=str(
+                    local_keyfile_backup_path.relative_to(
+                        self._linux_user_sync_backup_dir_path
+                    )
+                ),
+                nas_backup=str(
+                    remote_keyfile_backup_path.relative_to(
+                        self._linux_user_sync_backup_dir_path
+                    )
+                ),
+                local_sha256=local_sha256,
+                nas_sha256=remote_sha256,
+            ),
+        )
 
         return True, None
 
-    def _expire_old_backups(self) -> tuple[bool, str | None]:
-        if not self._linux_user_sync_backup_dir_path.is_dir():
-            return True, None
-
-        # iter over legacy backups and then backups in subdirectories
-        for file in chain(self._linux_user_sync_backup_dir_path.glob("*.kdbx"), self._linux_user_sync_backup_dir_path.glob("*/*.kdbx")):
-            day = self._read_day_from_backup_file(file)
-            threshold_day = datetime.today() - timedelta(days=_BACKUP_EXPIRATION_IN_DAYS)
-            if day < threshold_day:
-                _logger.info("deleting old backup %s...", file)
-                file.unlink()
+    def _backup_keyfile(
+        self,
+        source_path: Path,
+        backup_ref_path: Path,
+        logger: logging.LoggerAdapter,
+        sha256: str | None = None,
+        source_stat: os.stat_result | None = None,
+    ) -> str:
+        """
+        Stores the keyfile in the object store, unless identical to a previous backup,
+        and references it
+        """
+        sha256, copy_method = self._backup_objects.put(
+            source_path, sha256=sha256, source_stat=source_stat
+        )
+        logger.info(
+            "keyfile backup %s is %s (%s)",
+            backup_ref_path.name,
+            self._backup_objects.path_of(sha256).name,
+            f"stored with {copy_method} copy" if copy_method else "already stored",
+        )
+        with open(backup_ref_path, "w") as f:
+            f.write(f"{sha256}\n")
+        phanas.file_utils.make_readonly(backup_ref_path)
+        return sha256
+
+    def _retention_policy(self) -> RetentionPolicy:
+        return RetentionPolicy.from_config(
+            self._keepass_config.get(_RETENTION_CONFIG_JSON_OBJECT_NAME),
+            _DEFAULT_RETENTION,
+        )
 
-        return True, None
+    def _start_backup_retention(self):
+        """
+        Deletes expired backups in a background thread, the synchronization does not
+        wait for it
+        """
+        if self._retention_thread and self._retention_thread.is_alive():
+            return
+        self._retention_thread = threading.Thread(
+            target=self._apply_backup_retention, name="keyfile-backup-retention"
+        )
+        self._retention_thread.start()
+
+    def _apply_backup_retention(self):
+        with self._sync_lock():
+            self._apply_backup_retention_locked()
+
+    def _apply_backup_retention_locked(self):
+        policy = self._retention_policy()
+        now = datetime.today()
+        _logger.info("applying %s to keyfile backups...", policy)
+        try:
+            # all keyfiles are indexed first, so that objects still referenced by any
+            # keyfile are not deleted
+            histories = {
+                keyfile: self._backup_history(keyfile=keyfile)
+                for keyfile in self._keyfiles
+            }
+            self._backup_index.forget_others({k.relative_path for k in histories})
+            if self._backup_index.orphans() is None:
+                # once, when the index is rebuilt or was written by a previous version
+                self._backup_index.set_orphans(
+                    self._scan_orphan_backups(
+                        {b for h in histories.values() for p in h for b in p.backups()}
+                    )
+                )
+            self._expire_orphan_backups(now)
+            for keyfile, history in histories.items():
+                if not history:
+                    continue
+                by_timestamp = {
+                    datetime.strptime(p.timestamp, _BACKUP_TIMESTAMP_FORMAT): p
+                    for p in history
+                }
+                expired = [
+                    by_timestamp[t]
+                    for t in sorted(policy.expired(list(by_timestamp), now))
+                ]
+                for i in range(0, len(expired), _BACKUP_DELETION_BATCH_SIZE):
+                    if not self._delete_backups(
+                        keyfile, expired[i : i + _BACKUP_DELETION_BATCH_SIZE]
+                    ):
+                        break
+        except (OSError, ValueError):
+            _logger.exception("retention of keyfile backups failed")
+            return
+        _logger.info("retention of keyfile backups applied")
+
+    def _scan_orphan_backups(self, indexed: set[str]) -> dict[str, str | None]:
+        """
+        Backups in the backup directory not in indexed, such as backups of keyfiles no
+        longer configured and legacy backups at its root, with the hash they reference
+        """
+        backup_dir_path = self._linux_user_sync_backup_dir_path
+        _logger.info("looking for backups of no keyfile in %s...", backup_dir_path)
+        orphans = {}
+        for file in chain(
+            backup_dir_path.glob("*.kdbx"),
+            backup_dir_path.glob("*/*.kdbx"),
+            backup_dir_path.glob(f"*/*.kdbx{_BACKUP_REF_SUFFIX}"),
+        ):
+            backup = str(file.relative_to(backup_dir_path))
+            if file.parent.name == _OBJECTS_DIR_NAME or backup in indexed:
+                continue
+            orphans[backup] = (
+                file.read_text().strip()
+                if file.name.endswith(_BACKUP_REF_SUFFIX)
+                else None
+            )
+        _logger.info("%s backups of no keyfile found", len(orphans))
+        return orphans
+
+    def _expire_orphan_backups(self, now: datetime):
+        """
+        Deletes the backups of no keyfile older than
+        _UNINDEXED_BACKUP_EXPIRATION_IN_DAYS, whatever the retention policy
+        """
+        threshold_day = (
+            now - timedelta(days=_UNINDEXED_BACKUP_EXPIRATION_IN_DAYS)
+        ).date()
+        deleted = {}
+        try:
+            for backup, sha256 in self._backup_index.orphans().items():
+                try:
+                    day = self._read_day_from_backup_file(Path(backup))
+                except ValueError:
+                    continue
+                if day >= threshold_day:
+                    continue
+                _logger.info("deleting old backup %s...", backup)
+                (self._linux_user_sync_backup_dir_path / backup).unlink(missing_ok=True)
+                deleted[backup] = sha256
+        finally:
+            if deleted:
+                self._backup_index.remove_orphans(set(deleted))
+                self._delete_unreferenced_objects(
+                    {h for h in deleted.values() if h is not None}
+                )
+
+    def _delete_backups(self, keyfile: KeyFile, backup_pairs: list[BackupPair]) -> bool:
+        deleted = set()
+        try:
+            for backup_pair in backup_pairs:
+                for backup in backup_pair.backups():
+                    _logger.info("deleting old backup %s...", backup)
+                    (self._linux_user_sync_backup_dir_path / backup).unlink(
+                        missing_ok=True
+                    )
+                deleted.add(backup_pair.timestamp)
+        except OSError as e:
+            _logger.error(
+                "can't delete old backups of keyfile '%s': %s", keyfile.relative_path, e
+            )
+        if deleted:
+            self._backup_index.remove(keyfile.relative_path, deleted)
+            self._delete_unreferenced_objects(
+                set().union(
+                    *(p.hashes() for p in backup_pairs if p.timestamp in deleted)
+                )
+            )
+        return len(deleted) == len(backup_pairs)
+
+    def _delete_unreferenced_objects(self, deleted_hashes: set[str]):
+        """
+        Deletes the objects of deleted backups, unless referenced by the index (backups
+        of keyfiles and orphans)
+        """
+        referenced = self._backup_index.referenced_hashes()
+        for sha256 in deleted_hashes - referenced:
+            _logger.info("deleting unreferenced backup object %s...", sha256)
+            self._backup_objects.delete(sha256)
 
     @staticmethod
-    def _read_day_from_backup_file(file_path) -> datetime:
-        day_str = file_path.stem[0 : len("2020-06-18")]
-        return datetime.strptime(day_str, _BACKUP_DATE_FORMAT)
+    def _read_day_from_backup_file(file_path) -> date:
+        day_str = file_path.name[0 : len("2020-06-18")]
+        return datetime.strptime(day_str, _BACKUP_DATE_FORMAT).date()
 
     @staticmethod
     def _read_timestamp_from_backup_file(file_path) -> datetime:
@@ -483,7 +1275,11 @@ def run(config, input_provider: InputProvider):
     keepass = KeePass(config=config, credentials_provider=KeyringCredentialsProvider(input_provider=input_provider))
 
     if keepass.should_synch_keyfiles():
+        start = time.monotonic()
         status, msg = keepass.do_sync()
+        phanas.metrics.record_phase(
+            config, PHASE_KEYFILE_SYNC, status, time.monotonic() - start
+        )
         if not status:
             logger.error("Sync failed: %s", msg)
     else:
@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import threading
+
+from pathlib import Path
+
+_INDEX_FILE_NAME = "index.phanas"
+# backups of no configured keyfile (eg. removed from the configuration, or legacy
+# backups), not a relative path of keyfile, which has a directory
+_ORPHANS_KEY = "orphans"
+
+_logger = logging.getLogger("keyfile_backup_index")
+
+
+class BackupPair:
+    """
+    Backups of the local and remote copies of a keyfile taken by the same
+    synchronization
+    """
+
+    def __init__(
+        self,
+        timestamp: str,
+        local_backup: str | None,
+        nas_backup: str | None,
+        local_sha256: str | None = None,
+        nas_sha256: str | None = None,
+    ):
+        self.timestamp: str = timestamp
+        # paths relative to the backup directory of the host and user, None when the
+        # synchronization failed before backing up that side
+        self.local_backup: str | None = local_backup
+        self.nas_backup: str | None = nas_backup
+        # known for references to the object store and for the latest pair, older full
+        # copies of keyfiles taken by previous versions are not hashed
+        self.local_sha256: str | None = local_sha256
+        self.nas_sha256: str | None = nas_sha256
+
+    def is_complete(self) -> bool:
+        return self.local_backup is not None and self.nas_backup is not None
+
+    def backups(self) -> list[str]:
+        return [b for b in (self.local_backup, self.nas_backup) if b is not None]
+
+    def hashes(self) -> set[str]:
+        return {h for h in (self.local_sha256, self.nas_sha256) if h is not None}
+
+    def __str__(self):
+        return f"BackupPair({self.timestamp}, local={self.local_backup}, nas={self.nas_backup})"
+
+
+class KeyfileBackupIndex:
+    """
+    Backup pairs of each keyfile, oldest first, stored as a JSON file in the backup
+    directory of the host and user, so that the backup directory on the NAS is not
+    listed on each synchronization.
+
+    The file is loaded once and rewritten atomically on each update. An unreadable file
+    is treated as empty, the history of keyfiles is then rebuilt by the caller from the
+    backup directory.
+
+    Backups of no configured keyfile (orphans) are indexed too, with the hash they
+    reference, so that they are expired without listing the backup directory.
+    """
+
+    def __init__(self, backup_dir_path: Path):
+        self._index_file_path = backup_dir_path / _INDEX_FILE_NAME
+        # keyfiles are synchronized concurrently, and old backups deleted in the
+        # background
+        self._lock = threading.Lock()
+        self._histories: dict[str, list[BackupPair]] | None = None
+        # None until the backup directory is scanned for orphans
+        self._orphans: dict[str, str | None] | None = None
+
+    def history(self, relative_path: str) -> list[BackupPair] | None:
+        """Backup pairs of the keyfile, oldest first, None when the index has none"""
+        with self._lock:
+            history = self._loaded_histories().get(relative_path)
+            return list(history) if history is not None else None
+
+    def set_history(self, relative_path: str, pairs: list[BackupPair]):
+        with self._lock:
+            self._loaded_histories()[relative_path] = sorted(
+                pairs, key=lambda p: p.timestamp
+            )
+            # eg. keyfile configured again
+            for backup in (b for p in pairs for b in p.backups()):
+                if self._orphans is not None:
+                    self._orphans.pop(backup, None)
+            self._save()
+
+    def add(self, relative_path: str, pair: BackupPair):
+        with self._lock:
+            history = self._loaded_histories().setdefault(relative_path, [])
+            history.append(pair)
+            history.sort(key=lambda p: p.timestamp)
+            self._save()
+
+    def remove(self, relative_path: str, timestamps: set[str]):
+        with self._lock:
+            history = self._loaded_histories().get(relative_path, [])
+            history[:] = [p for p in history if p.timestamp not in timestamps]
+            self._save()
+
+    def forget_others(self, relative_paths: set[str]):
+        """
+        Forgets the keyfiles not in relative_paths (eg. no longer configured), whose
+        backups become orphans, expired by age
+        """
+        with self._lock:
+            histories = self._loaded_histories()
+            others = [p for p in histories if p not in relative_paths]
+            if not others:
+                return
+            for relative_path in others:
+                for pair in histories.pop(relative_path):
+                    if self._orphans is None:
+                        # found when scanning for orphans
+                        continue
+                    for backup, sha256 in (
+                        (pair.local_backup, pair.local_sha256),
+                        (pair.nas_backup, pair.nas_sha256),
+                    ):
+                        if backup is not None:
+                            self._orphans[backup] = sha256
+            self._save()
+
+    def orphans(self) -> dict[str, str | None] | None:
+        """
+        Backups of no configured keyfile, with the hash they reference (None for full
+        copies), None when the backup directory was not scanned for them yet
+        """
+        with self._lock:
+            self._loaded_histories()
+            return dict(self._orphans) if self._orphans is not None else None
+
+    def set_orphans(self, orphans: dict[str, str | None]):
+        with self._lock:
+            self._loaded_histories()
+            self._orphans = dict(orphans)
+            self._save()
+
+    def remove_orphans(self, backups: set[str]):
+        with self._lock:
+            self._loaded_histories()
+            for backup in backups:
+                self._orphans.pop(backup, None)
+            self._save()
+
+    def referenced_hashes(self) -> set[str]:
+        """Hashes of all the backups in the index, of all keyfiles and orphans"""
+        with self._lock:
+            return {
+                h
+                for pairs in self._loaded_histories().values()
+                for p in pairs
+                for h in p.hashes()
+            } | {h for h in (self._orphans or {}).values() if h is not None}
+
+    def _loaded_histories(self) -> dict[str, list[BackupPair]]:
+        if self._histories is None:
+            self._histories, self._orphans = self._load()
+        return self._histories
+
+    def _load(
+        self,
+    ) -> tuple[dict[str, list[BackupPair]], dict[str, str | None] | None]:
+        try:
+            with open(self._index_file_path, "r") as f:
+                content = json.load(f)
+            orphans = content.pop(_ORPHANS_KEY, None)
+            histories = {
+                relative_path: [BackupPair(**pair) for pair in pairs]
+                for relative_path, pairs in content.items()
+                # any other format is rebuilt
+                if isinstance(pairs, list)
+            }
+            return histories, orphans if isinstance(orphans, dict) else None
+        except FileNotFoundError:
+            _logger.info("%s does not exist, it will be rebuilt", self._index_file_path)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            _logger.warning(
+                "can't read %s, it will be rebuilt: %s", self._index_file_path, e
+            )
+        return {}, None
+
+    def _save(self):
+        histories = {
+            relative_path: [vars(p) for p in pairs]
+            for relative_path, pairs in self._histories.items()
+        }
+        if self._orphans is not None:
+            histories[_ORPHANS_KEY] = self._orphans
+        content = json.dumps(histories, indent=2)
+        # write then rename, so that a partial index is never read
+        temp_path = self._index_file_path.with_name(
+            f".{self._index_file_path.name}.tmp"
+        )
+        with open(temp_path, "w") as f:
+            f.write(content)
+        os.replace(temp_path, self._index_file_path)
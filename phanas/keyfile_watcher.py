@@ -0,0 +1,293 @@
+import ctypes
+import ctypes.util
+import fcntl
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from pathlib import Path
+
+import phanas.keepass
+import phanas.metrics
+from phanas.credentials import InputProvider, KeyringCredentialsProvider
+from phanas.events import PHASE_KEYFILE_SYNC
+
+_KEEPASS_CONFIG_JSON_OBJECT_NAME = "keepass"
+_WATCH_CONFIG_JSON_OBJECT_NAME = "watch"
+_DEBOUNCE_SECONDS_NAME = "debounce_seconds"
+_REMOTE_CHECK_INTERVAL_NAME = "remote_check_interval_minutes"
+
+_DEFAULT_DEBOUNCE_SECONDS = 5
+_DEFAULT_REMOTE_CHECK_INTERVAL_IN_MINUTES = 5
+# a failed synchronization is retried after this delay, doubled after each failure
+_MIN_RETRY_SECONDS = 30
+_MAX_RETRY_SECONDS = 3600
+
+# from linux/inotify.h
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+_EVENT_HEADER = struct.Struct("iIII")
+
+_logger = logging.getLogger("keyfile_watcher")
+
+
+class Inotify:
+    """Minimal inotify binding, through ctypes"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"can't watch {path}: {os.strerror(errno)}")
+        return wd
+
+    def read_events(self, timeout_s: float) -> list[tuple[int, int, str]]:
+        """Events (watch descriptor, mask, name) received within timeout_s"""
+        readable, _, _ = select.select([self._fd], [], [], max(0.0, timeout_s))
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset : offset + name_length].rstrip(b"\0")
+            offset += name_length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _NoInputProvider(InputProvider):
+    """
+    Keyfiles are synchronized in the background: passwords missing from the keyring are
+    not asked for
+    """
+
+    def get_password(self, prompt: str) -> str | None:
+        return None
+
+
+class KeyfileWatcher:
+    """
+    Synchronizes a keyfile shortly after its local copy is written (eg. a password is
+    saved in KeePassXC), and when its remote copy changed (eg. by another machine),
+    which is checked periodically from its size and modification time only.
+
+    Directories of local keyfiles are watched rather than keyfiles themselves, as
+    KeePassXC saves a keyfile by replacing it. Events are debounced: a keyfile is
+    synchronized once it was not written for debounce_seconds. A failed synchronization
+    is retried with an increasing delay.
+    """
+
+    def __init__(self, config, input_provider: InputProvider | None = None):
+        self._config = config
+        self._input_provider = input_provider or _NoInputProvider()
+        keepass_config = (
+            config.get(_KEEPASS_CONFIG_JSON_OBJECT_NAME)
+            if isinstance(config, dict)
+            else None
+        )
+        keepass_config = keepass_config if isinstance(keepass_config, dict) else {}
+        watch_config = keepass_config.get(_WATCH_CONFIG_JSON_OBJECT_NAME)
+        watch_config = watch_config if isinstance(watch_config, dict) else {}
+        self._debounce_s: float = watch_config.get(
+            _DEBOUNCE_SECONDS_NAME, _DEFAULT_DEBOUNCE_SECONDS
+        )
+        self._remote_check_interval_s: float = 60 * watch_config.get(
+            _REMOTE_CHECK_INTERVAL_NAME, _DEFAULT_REMOTE_CHECK_INTERVAL_IN_MINUTES
+        )
+
+        self._keyfiles = {k.relative_path: k for k in self._new_keepass().keyfiles()}
+        self._inotify: Inotify | None = None
+        self._watched_dirs: dict[int, Path] = {}
+        # (local, remote) size and modification time of each keyfile after its latest
+        # synchronization
+        self._known_stats: dict[str, tuple] = {}
+        # time of the latest write of each local keyfile not synchronized yet
+        self._pending: dict[str, float] = {}
+        # (failure count, time of the next attempt) of each keyfile whose latest
+        # synchronization failed
+        self._retries: dict[str, tuple[int, float]] = {}
+
+    def _new_keepass(self) -> phanas.keepass.KeePass:
+        # a new instance for each synchronization, so that the backup index is read
+        # again: another process (eg. the synchronization at login) may have updated it
+        return phanas.keepass.KeePass(
+            config=self._config,
+            credentials_provider=KeyringCredentialsProvider(
+                input_provider=self._input_provider
+            ),
+        )
+
+    def run(self):
+        if not self._keyfiles:
+            _logger.info("Keyfile synchronization is not configured")
+            return
+
+        self._inotify = Inotify()
+        try:
+            self._sync(list(self._keyfiles))
+            next_remote_check = time.monotonic() + self._remote_check_interval_s
+            while True:
+                now = time.monotonic()
+                deadlines = (
+                    [next_remote_check]
+                    + [t + self._debounce_s for t in self._pending.values()]
+                    + [t for _, t in self._retries.values()]
+                )
+                self._handle_events(self._inotify.read_events(min(deadlines) - now))
+
+                now = time.monotonic()
+                due = [
+                    p for p, t in self._pending.items() if now - t >= self._debounce_s
+                ]
+                due += [
+                    p
+                    for p, (_, t) in self._retries.items()
+                    if now >= t and p not in due
+                ]
+                if now >= next_remote_check:
+                    # directories created since the latest check
+                    self._watch_local_dirs()
+                    # keyfiles whose synchronization failed wait for their retry
+                    due += [
+                        p
+                        for p in self._keyfiles
+                        if p not in due
+                        and p not in self._retries
+                        and self._remote_changed(p)
+                    ]
+                    next_remote_check = now + self._remote_check_interval_s
+                for relative_path in due:
+                    self._pending.pop(relative_path, None)
+                due = [p for p in due if self._changed(p)]
+                if due:
+                    self._sync(due)
+        finally:
+            self._inotify.close()
+
+    def _handle_events(self, events: list[tuple[int, int, str]]):
+        for wd, mask, name in events:
+            if mask & _IN_Q_OVERFLOW:
+                _logger.warning("inotify events lost, checking all keyfiles")
+                self._pending.update({p: time.monotonic() for p in self._keyfiles})
+                continue
+            if mask & _IN_IGNORED:
+                # directory deleted, watched again once created again
+                self._watched_dirs.pop(wd, None)
+                continue
+            directory = self._watched_dirs.get(wd)
+            if directory is None:
+                continue
+            for relative_path, keyfile in self._keyfiles.items():
+                if keyfile.local_path == directory / name:
+                    _logger.debug("%s written", keyfile.local_path)
+                    self._pending[relative_path] = time.monotonic()
+
+    def _watch_local_dirs(self):
+        watched = set(self._watched_dirs.values())
+        for keyfile in self._keyfiles.values():
+            directory = keyfile.local_keyfile_directory()
+            if directory in watched or not directory.is_dir():
+                continue
+            try:
+                wd = self._inotify.add_watch(
+                    directory, _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+                )
+            except OSError as e:
+                # eg. ENOSPC when the limit of inotify watches is reached: tried again
+                # later, the remote check still synchronizes the keyfile meanwhile
+                _logger.error("%s", e)
+                continue
+            self._watched_dirs[wd] = directory
+            watched.add(directory)
+            _logger.info("watching %s", directory)
+
+    def _sync(self, relative_paths: list[str]):
+        _logger.info("synchronizing %s...", ", ".join(relative_paths))
+        keepass = self._new_keepass()
+        start = time.monotonic()
+        status, msg = keepass.do_sync(relative_paths=relative_paths)
+        phanas.metrics.record_phase(
+            self._config, PHASE_KEYFILE_SYNC, status, time.monotonic() - start
+        )
+        if status:
+            _logger.info("%s synchronized", ", ".join(relative_paths))
+            for relative_path in relative_paths:
+                self._known_stats[relative_path] = self._stats(relative_path)
+                self._retries.pop(relative_path, None)
+        else:
+            _logger.error("Sync failed: %s", msg)
+            # keyfiles synchronized together are retried together
+            for relative_path in relative_paths:
+                self._known_stats.pop(relative_path, None)
+                failures = self._retries.get(relative_path, (0, 0))[0] + 1
+                delay_s = min(
+                    _MIN_RETRY_SECONDS * 2 ** (failures - 1), _MAX_RETRY_SECONDS
+                )
+                self._retries[relative_path] = (failures, time.monotonic() + delay_s)
+                _logger.info(
+                    "synchronization of %s retried in %ss", relative_path, delay_s
+                )
+        self._watch_local_dirs()
+
+    def _stats(self, relative_path: str) -> tuple:
+        keyfile = self._keyfiles[relative_path]
+        return self._stat(keyfile.local_path), self._stat(keyfile.remote_path)
+
+    @staticmethod
+    def _stat(file_path: Path) -> tuple[int, int] | None:
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def _changed(self, relative_path: str) -> bool:
+        # the synchronization itself writes the local keyfile
+        return self._stats(relative_path) != self._known_stats.get(relative_path)
+
+    def _remote_changed(self, relative_path: str) -> bool:
+        known = self._known_stats.get(relative_path)
+        remote_stat = self._stat(self._keyfiles[relative_path].remote_path)
+        # remote keyfile not reachable (eg. NAS offline): checked again later
+        return remote_stat is not None and (known is None or remote_stat != known[1])
+
+
+def run(config):
+    """
+    Runs forever, synchronizing keyfiles as they change, typically started with the
+    session. Only one watcher runs per user and clone directory.
+    """
+    lock_file_path = Path(sys.path[0]) / ".keyfile_watcher.lock"
+    lock_file = open(lock_file_path, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        _logger.info("keyfile watcher already running")
+        return
+
+    _logger.info("Keyfile watcher started")
+    KeyfileWatcher(config).run()
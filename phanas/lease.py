@@ -0,0 +1,259 @@
+import getpass
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+from pathlib import Path
+from typing import Callable
+
+import phanas.automount
+import phanas.nas
+
+_COORDINATION_CONFIG_JSON_OBJECT_NAME = "coordination"
+_MAX_HEAVY_JOBS_NAME = "max_heavy_jobs"
+_LEASE_DURATION_NAME = "lease_duration_minutes"
+_MAX_WAIT_NAME = "max_wait_minutes"
+
+_DEFAULT_MAX_HEAVY_JOBS = 1
+_DEFAULT_LEASE_DURATION_IN_MINUTES = 30
+_DEFAULT_MAX_WAIT_IN_MINUTES = 10
+_POLL_INTERVAL_IN_SECONDS = 20
+
+_LEASE_DIR_NAME = "_leases"
+_LEASE_FILE_SUFFIX = ".lease"
+
+_STATE_WAITING = "waiting"
+_STATE_ACTIVE = "active"
+
+_logger = logging.getLogger("lease")
+
+
+class Lease:
+    def __init__(
+        self, holder: str, job: str, state: str, requested_at: float, expires_at: float
+    ):
+        self.holder: str = holder
+        self.job: str = job
+        self.state: str = state
+        self.requested_at: float = requested_at
+        self.expires_at: float = expires_at
+
+    def is_expired(self, now: float) -> bool:
+        return self.expires_at < now
+
+    def sort_key(self) -> tuple[float, str, str]:
+        return self.requested_at, self.holder, self.job
+
+    def to_json(self) -> str:
+        return json.dumps(vars(self))
+
+    @staticmethod
+    def from_file(file_path: Path) -> "Lease | None":
+        try:
+            with open(file_path, "r") as f:
+                return Lease(**json.load(f))
+        except (OSError, ValueError, TypeError) as e:
+            # lease file being written, deleted by its owner or corrupted
+            _logger.debug("ignoring lease file %s: %s", file_path, e)
+            return None
+
+    def __str__(self):
+        return f"{self.job} of {self.holder}"
+
+
+class NasLease:
+    """
+    Caps how many heavy jobs (backup, NAS copy) run against the NAS at once, across
+    hosts and users.
+
+    Each job waiting for or holding a lease has a file in the sys drive. Lease files
+    expire so that a crashed holder can't block other hosts. Waiting jobs are served in
+    order of request. The lease of a running job is renewed in the background until it
+    is released.
+    """
+
+    def __init__(self, config, job: str):
+        self._job = job
+        self._holder = f"{getpass.getuser()}@{socket.gethostname()}"
+
+        coordination_config = (
+            config.get(_COORDINATION_CONFIG_JSON_OBJECT_NAME) if config else None
+        )
+        if not isinstance(coordination_config, dict):
+            coordination_config = {}
+        self._max_heavy_jobs: int = coordination_config.get(
+            _MAX_HEAVY_JOBS_NAME, _DEFAULT_MAX_HEAVY_JOBS
+        )
+        self._lease_duration_s: float = 60 * coordination_config.get(
+            _LEASE_DURATION_NAME, _DEFAULT_LEASE_DURATION_IN_MINUTES
+        )
+        self._max_wait_s: float = 60 * coordination_config.get(
+            _MAX_WAIT_NAME, _DEFAULT_MAX_WAIT_IN_MINUTES
+        )
+
+        sys_drive_path = (
+            phanas.automount.Env().mount_dir_path / phanas.nas.Nas().drive_sys()
+        )
+        self._lease_dir_path: Path = sys_drive_path / _LEASE_DIR_NAME
+        self._lease_file_path: Path = self._lease_dir_path / (
+            f"{self._holder.replace('@', '_')}_{job}{_LEASE_FILE_SUFFIX}"
+        )
+
+        self._lease: Lease | None = None
+        self._stop_renewal = threading.Event()
+        self._renewal_thread: threading.Thread | None = None
+
+    def acquire(
+        self, on_wait: Callable[[str], None] | None = None
+    ) -> tuple[bool, str | None]:
+        """
+        Waits for the job's turn to run. Returns False with a message when the job has
+        to be deferred. When the lease directory is not available, the job is allowed to
+        run without coordination.
+        """
+        status, msg = self._make_sure_lease_dir_exists()
+        if not status:
+            _logger.warning("running %s without coordination: %s", self._job, msg)
+            return True, None
+
+        now = time.time()
+        self._lease = Lease(
+            self._holder, self._job, _STATE_WAITING, now, now + self._lease_duration_s
+        )
+        try:
+            status, msg = self._wait_for_turn(now + self._max_wait_s, on_wait)
+            if status:
+                self._lease.state = _STATE_ACTIVE
+                self._write_lease()
+        except OSError as e:
+            # eg. NAS full, read-only or share dropped
+            status, msg = False, f"can't write lease {self._lease_file_path}: {e}"
+        if not status:
+            self._delete_lease()
+            self._lease = None
+            return False, msg
+
+        _logger.info("lease acquired for %s by %s", self._job, self._holder)
+
+        self._stop_renewal.clear()
+        self._renewal_thread = threading.Thread(
+            target=self._renew_until_released, daemon=True
+        )
+        self._renewal_thread.start()
+        return True, None
+
+    def _wait_for_turn(
+        self, deadline: float, on_wait: Callable[[str], None] | None
+    ) -> tuple[bool, str | None]:
+        while True:
+            self._write_lease()
+            ahead = self._leases_ahead()
+            if len(ahead) < self._max_heavy_jobs:
+                return True, None
+
+            msg = f"NAS busy with {', '.join(str(lease) for lease in ahead)}"
+            if time.time() >= deadline:
+                return False, msg
+
+            _logger.info("%s, waiting...", msg)
+            if on_wait:
+                on_wait(f"{msg}, waiting for its turn...")
+            # jitter avoids hosts waiting on each other to poll the NAS in lockstep
+            time.sleep(_POLL_INTERVAL_IN_SECONDS + random.uniform(0, 5))
+
+    def release(self):
+        if self._renewal_thread:
+            self._stop_renewal.set()
+            self._renewal_thread.join()
+            self._renewal_thread = None
+        if self._lease:
+            self._delete_lease()
+            _logger.info("lease released for %s by %s", self._job, self._holder)
+            self._lease = None
+
+    def _make_sure_lease_dir_exists(self) -> tuple[bool, str | None]:
+        if not self._lease_dir_path.parent.is_dir():
+            return False, f"{self._lease_dir_path.parent} is not a directory"
+        try:
+            self._lease_dir_path.mkdir(exist_ok=True)
+        except OSError as e:
+            return False, f"can't create {self._lease_dir_path}: {e}"
+        return True, None
+
+    def _leases_ahead(self) -> list[Lease]:
+        """
+        Leases which prevent this job to run: active or waiting leases requested before
+        this one, plus active leases requested after this one (holder won a race while
+        this job was not polling)
+        """
+        now = time.time()
+        ahead = []
+        for file_path in self._lease_dir_path.glob(f"*{_LEASE_FILE_SUFFIX}"):
+            if file_path == self._lease_file_path:
+                continue
+            lease = Lease.from_file(file_path)
+            if lease is None:
+                continue
+            if lease.is_expired(now):
+                _logger.info("deleting expired lease %s (%s)...", file_path, lease)
+                file_path.unlink(missing_ok=True)
+                continue
+            if (
+                lease.sort_key() < self._lease.sort_key()
+                or lease.state == _STATE_ACTIVE
+            ):
+                ahead.append(lease)
+        return ahead
+
+    def _renew_until_released(self):
+        while not self._stop_renewal.wait(self._lease_duration_s / 3):
+            try:
+                self._write_lease()
+            except OSError as e:
+                _logger.error("can't renew lease %s: %s", self._lease_file_path, e)
+
+    def _write_lease(self):
+        self._lease.expires_at = time.time() + self._lease_duration_s
+        # write then rename, so that other hosts never read a partial lease file
+        temp_path = self._lease_file_path.with_name(
+            f".{self._lease_file_path.name}.tmp"
+        )
+        with open(temp_path, "w") as f:
+            f.write(self._lease.to_json())
+        os.replace(temp_path, self._lease_file_path)
+
+    def _delete_lease(self):
+        try:
+            self._lease_file_path.unlink(missing_ok=True)
+        except OSError as e:
+            _logger.error("can't delete lease %s: %s", self._lease_file_path, e)
+
+
+def run_leased(
+    config,
+    job_id: str,
+    display_name: str,
+    on_nas: bool,
+    run: Callable[[], tuple[bool, str | None]],
+    on_wait: Callable[[str], None] | None = None,
+) -> tuple[bool, str | None]:
+    """
+    Runs a job on the NAS once the NAS is available for a heavy job. When it is not
+    available in time, the job is deferred to the next run, which is not a failure.
+    Jobs on other targets run right away.
+    """
+    if not on_nas:
+        return run()
+
+    lease = NasLease(config, job=job_id)
+    status, msg = lease.acquire(on_wait=on_wait)
+    if not status:
+        return True, f"{display_name} deferred to the next run: {msg}"
+    try:
+        return run()
+    finally:
+        lease.release()
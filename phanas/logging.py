@@ -1,5 +1,12 @@
+import atexit
+import contextlib
+import contextvars
+import json
 import logging
+import logging.handlers
+import queue
 import sys
+import threading
 
 from datetime import datetime, date, timedelta
 from pathlib import Path
@@ -7,31 +14,185 @@ from pathlib import Path
 __LOGGING_DATE_FORMAT = "%Y-%m-%d"
 __LOGGING_TIMESTAMP_FORMAT = "{}_%H-%M-%S".format(__LOGGING_DATE_FORMAT)
 __LOGGING_EXPIRATION_IN_DAYS = 60
+__LOGGING_CONFIG_JSON_OBJECT_NAME = "logging"
+__JSON_LINES_CONFIG_JSON_OBJECT_NAME = "json_lines"
 __script_dir_path = Path(sys.path[0])
 __log_dir_path = __script_dir_path / "logs"
+__timestamp = datetime.today().strftime(__LOGGING_TIMESTAMP_FORMAT)
+__log_writer = None
+
+# fields of the JSON lines, when logged with extra or within log_context
+CONTEXT_FIELDS = ("phase", "drive", "keyfile")
+_MAX_BATCH_SIZE = 500
+_log_context: contextvars.ContextVar[dict] = contextvars.ContextVar(
+    "log_context", default={}
+)
 
 
 def configure_logging():
-    timestamp = datetime.today().strftime(__LOGGING_TIMESTAMP_FORMAT)
-    logfile_path = __log_dir_path / "{}_phanas.log".format(timestamp)
+    """
+    Log records are queued by the logging threads and written by a single writer thread
+    to the log file and the console, so that logging never waits for the disk or the
+    terminal (eg. while reading the output of a script).
+    """
+    global __log_writer
+    logfile_path = __log_dir_path / "{}_phanas.log".format(__timestamp)
     # print("logging to {}".format(logfile_path))
 
     if not __log_dir_path.is_dir():
         __log_dir_path.mkdir()
 
-    logging.basicConfig(
-        level=logging.INFO,
-        format="[%(asctime)s][%(name)-9.9s][%(levelname)-4.4s] %(message)s",
-        handlers=[logging.FileHandler(logfile_path), logging.StreamHandler()],
+    formatter = logging.Formatter(
+        "[%(asctime)s][%(name)-9.9s][%(levelname)-4.4s] %(message)s"
     )
+    handlers = [_BatchedFileHandler(logfile_path), _BatchedStreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    __log_writer = _LogWriter(log_queue, handlers)
+    __log_writer.start()
+    atexit.register(__log_writer.stop)
+
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # records are queued with their message formatted, including the traceback of
+    # exceptions
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    queue_handler.addFilter(_ContextFilter())
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
 
     __purge_log_dir()
 
 
+def configure_json_lines(config):
+    """
+    Also writes logs as JSON lines, one object per record with its CONTEXT_FIELDS, when
+    enabled in config
+    """
+    logging_config = config.get(__LOGGING_CONFIG_JSON_OBJECT_NAME) if config else None
+    if not isinstance(logging_config, dict) or not logging_config.get(
+        __JSON_LINES_CONFIG_JSON_OBJECT_NAME
+    ):
+        return
+    if __log_writer is None:
+        return
+
+    handler = _BatchedFileHandler(
+        __log_dir_path / "{}_phanas.jsonl".format(__timestamp)
+    )
+    handler.setFormatter(JsonLinesFormatter())
+    __log_writer.add_handler(handler)
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """
+    Adds fields (see CONTEXT_FIELDS) to the records logged by the current thread, or
+    context
+    """
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class _ContextFilter(logging.Filter):
+    """
+    Copies the fields of log_context to records, in the logging thread. Fields given
+    with extra take precedence
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for field, value in _log_context.get().items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry)
+
+
+class _BatchedStreamHandler(logging.StreamHandler):
+    """Does not flush after each record: the writer thread flushes once per batch"""
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class _BatchedFileHandler(_BatchedStreamHandler, logging.FileHandler):
+    def __init__(self, file_path: Path):
+        logging.FileHandler.__init__(self, file_path)
+
+
+class _LogWriter(threading.Thread):
+    """
+    Writes the queued log records with the handlers, by batches of the records queued
+    meanwhile
+    """
+
+    def __init__(self, log_queue: queue.SimpleQueue, handlers: list[logging.Handler]):
+        super().__init__(name="log-writer", daemon=True)
+        self._queue = log_queue
+        self._handlers: list[logging.Handler] = list(handlers)
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def add_handler(self, handler: logging.Handler):
+        with self._lock:
+            self._handlers.append(handler)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < _MAX_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+
+            with self._lock:
+                for record in batch:
+                    if record is None:
+                        continue
+                    for handler in self._handlers:
+                        if record.levelno >= handler.level:
+                            handler.handle(record)
+                for handler in self._handlers:
+                    handler.flush()
+
+    def stop(self):
+        """Writes the records queued so far, then stops"""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(None)
+        self.join()
+
+
 def __purge_log_dir():
     rootLogger = logging.getLogger()
 
-    for file in __log_dir_path.glob("*.log"):
+    for file in [*__log_dir_path.glob("*.log"), *__log_dir_path.glob("*.jsonl")]:
         day = __read_day_from_backup_file(file)
         threshold_day = datetime.today() - timedelta(days=__LOGGING_EXPIRATION_IN_DAYS)
         if day < threshold_day:
@@ -4,21 +4,25 @@ import threading
 
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, GLib
+from phanas.events import Event, ItemProgress, PhaseEnded
 from phanas.phanas_desktop import Output, PhanasDesktop, PROGRAM_NAME
 
-class AskForPassword:
+
+class AskForPasswords:
     """
-    Implements the locking mechanism to show, from the worker thread, a dialog asking for a password and wait for the
-    user to provide it or press cancel.
+    Implements the locking mechanism to show, from the worker thread, a dialog asking
+    for one or more passwords and wait for the user to provide them or press cancel.
 
     Sources:
     * dialog code: https://python-gtk-3-tutorial.readthedocs.io/en/latest/dialogs.html#example
     * lock usage: https://stackoverflow.com/a/24796823
     """
-    def __init__(self, parent_window, prompt: str):
+
+    def __init__(self, parent_window, prompts: dict[str, str]):
         self._parent_window = parent_window
-        self._prompt = prompt
-        self._password: str | None = None
+        self._prompts = prompts
+        self._passwords: dict[str, str] = {}
+        self._done = False
         self._lock = threading.Condition()
 
     def show_dialog(self):
@@ -26,31 +30,42 @@ class AskForPassword:
             try:
                 self._show_dialog()
             finally:
+                self._done = True
                 self._lock.notify_all()
+        # return false to not be called again
+        return False
 
     def _show_dialog(self):
-        dialog = PasswordDialog(parent=self._parent_window, prompt=self._prompt)
+        dialog = PasswordDialog(parent=self._parent_window, prompts=self._prompts)
         response = dialog.run()
 
-        print("password:", dialog.password_entry.get_text())
         if response == Gtk.ResponseType.OK:
-            self._password = dialog.password_entry.get_text()
+            self._passwords = {
+                key: entry.get_text()
+                for key, entry in dialog.password_entries.items()
+                if entry.get_text()
+            }
             print("The OK button was clicked")
         elif response == Gtk.ResponseType.CANCEL:
             print("The Cancel button was clicked")
 
         dialog.destroy()
-
-    def wait_for_password(self) -> str | None:
+    def wait_for_passwords(self) -> dict[str, str]:
         with self._lock:
-            self._lock.wait()
+            # the dialog may be closed before the worker thread waits
+            self._lock.wait_for(lambda: self._done)
+
+        return self._passwords
 
-        return self._password
 
 class PasswordDialog(Gtk.Dialog):
 
-    def __init__(self, parent, prompt: str):
-        super().__init__(title="Provide a password", transient_for=parent, flags=0)
+    def __init__(self, parent, prompts: dict[str, str]):
+        super().__init__(
+            title="Provide a password" if len(prompts) == 1 else "Provide passwords",
+            transient_for=parent,
+            flags=0,
+        )
 
         self.add_buttons(
             Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, Gtk.STOCK_OK, Gtk.ResponseType.OK
@@ -60,12 +75,16 @@ class PasswordDialog(Gtk.Dialog):
         self.set_default_size(150, 100)
         self.set_default_response(Gtk.ResponseType.OK)
 
-        label = Gtk.Label(label=prompt)
         box = self.get_content_area()
-        box.add(label)
-        self.password_entry = Gtk.Entry()
-        self.password_entry.set_activates_default(True)
-        box.add(self.password_entry)
+        self.password_entries: dict[str, Gtk.Entry] = {}
+        for key, prompt in prompts.items():
+            label = Gtk.Label(label=prompt)
+            box.add(label)
+            password_entry = Gtk.Entry()
+            password_entry.set_visibility(False)
+            password_entry.set_activates_default(True)
+            box.add(password_entry)
+            self.password_entries[key] = password_entry
 
         self.show_all()
 
@@ -87,6 +106,10 @@ class MyWindow(Gtk.Window, Output):
         self.label = Gtk.Label("...")
         self.box.pack_start(self.label, True, True, 0)
 
+        self.progress_bar = Gtk.ProgressBar(show_text=True)
+        self.progress_bar.set_no_show_all(True)
+        self.box.pack_start(self.progress_bar, False, False, 0)
+
         self.connect("destroy", Gtk.main_quit)
         self.connect("show", self.on_window_show)
 
@@ -102,6 +125,31 @@ class MyWindow(Gtk.Window, Output):
     def _do_things(self):
         self.__phanasDesktop.do_things(input_provider=self, output=self)
 
+    def handle(self, event: Event) -> None:
+        if isinstance(event, ItemProgress):
+            # progress is shown in the progress bar, below the label describing the
+            # ongoing phase
+            GLib.idle_add(self.set_progress, event.fraction(), event.describe())
+            return
+        if isinstance(event, PhaseEnded):
+            GLib.idle_add(self.hide_progress)
+        super().handle(event)
+
+    def set_progress(self, fraction: float | None, text: str):
+        if fraction is None:
+            self.progress_bar.pulse()
+        else:
+            self.progress_bar.set_fraction(fraction)
+        self.progress_bar.set_text(text)
+        self.progress_bar.show()
+        # return false to not be called again
+        return False
+
+    def hide_progress(self):
+        self.progress_bar.hide()
+        # return false to not be called again
+        return False
+
     def failure(self, msg):
         self.info_label(msg)
 
@@ -124,12 +172,15 @@ class MyWindow(Gtk.Window, Output):
         # return false to not be called again
         return False
 
+
     def get_password(self, prompt: str) -> str | None:
-        ask_for_password = AskForPassword(parent_window=self, prompt=prompt)
-        GLib.idle_add(ask_for_password.show_dialog)
+        return self.get_passwords({prompt: prompt}).get(prompt)
 
-        return ask_for_password.wait_for_password()
+    def get_passwords(self, prompts: dict[str, str]) -> dict[str, str]:
+        ask_for_passwords = AskForPasswords(parent_window=self, prompts=prompts)
+        GLib.idle_add(ask_for_passwords.show_dialog)
 
+        return ask_for_passwords.wait_for_passwords()
 
     def close(self):
         GLib.idle_add(Gtk.main_quit)
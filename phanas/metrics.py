@@ -0,0 +1,343 @@
+import contextlib
+import fcntl
+import getpass
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Callable
+
+import phanas.backup
+from phanas.events import (
+    Event,
+    EventSink,
+    ItemDone,
+    PhaseEnded,
+    PhaseStarted,
+    PHASE_AUTOMOUNT,
+    PHASE_KEYFILE_SYNC,
+)
+
+_METRICS_CONFIG_JSON_OBJECT_NAME = "metrics"
+_TEXTFILE_DIRECTORY_NAME = "textfile_directory"
+
+_STATE_FILE_NAME = "metrics.phanas"
+_LOCK_FILE_NAME = ".metrics.lock"
+_METRIC_PREFIX = "phanas"
+
+_logger = logging.getLogger("metrics")
+
+
+class Metrics:
+    """
+    Outcome of the latest runs, persisted in the script directory so that it can be
+    reported at any time by `--status` and exported to a node-exporter textfile
+    collector directory (if configured).
+    """
+
+    def __init__(self, config):
+        self._linux_username: str = getpass.getuser()
+        self._hostname: str = socket.gethostname()
+        self._state_file_path: Path = Path(sys.path[0]) / _STATE_FILE_NAME
+        self._textfile_path: Path | None = None
+        self._config = config
+        self._load_textfile_path(config)
+        self._state: dict = self._load_state()
+
+    def _load_textfile_path(self, config):
+        metrics_config = (
+            config.get(_METRICS_CONFIG_JSON_OBJECT_NAME) if config else None
+        )
+        if not isinstance(metrics_config, dict):
+            return
+
+        textfile_directory = metrics_config.get(_TEXTFILE_DIRECTORY_NAME)
+        if not isinstance(textfile_directory, str) or not textfile_directory:
+            _logger.info("'%s' is not a string", _TEXTFILE_DIRECTORY_NAME)
+            return
+
+        self._textfile_path = (
+            Path(textfile_directory) / f"phanas_{self._linux_username}.prom"
+        )
+        _logger.info("metrics textfile: %s", self._textfile_path)
+
+    def _load_state(self) -> dict:
+        state = {}
+        if self._state_file_path.is_file():
+            try:
+                with open(self._state_file_path, "r") as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                _logger.error("can't read %s: %s", self._state_file_path, e)
+        state.setdefault("phases", {})
+        state.setdefault("drives", {})
+        return state
+
+    def record_phase(
+        self,
+        phase: str,
+        success: bool,
+        duration_s: float | None,
+        ended_at: float,
+        skipped: bool = False,
+    ):
+        phase_state = self._state["phases"].setdefault(phase, {})
+        phase_state["success"] = success
+        phase_state["duration_seconds"] = duration_s
+        phase_state["last_run_timestamp"] = ended_at
+        # a phase with nothing to do (eg. not configured) did not succeed at anything
+        if success and not skipped:
+            phase_state["last_success_timestamp"] = ended_at
+
+    def record_drive(self, drive: str, mounted: bool, latency_s: float | None):
+        self._state["drives"][drive] = {
+            "mounted": mounted,
+            "latency_seconds": latency_s,
+        }
+
+    def record_run(self, success: bool, ended_at: float):
+        self._state["last_run"] = {"success": success, "timestamp": ended_at}
+
+    def status(self) -> dict:
+        now = time.time()
+        backup_jobs = {}
+        for backup in phanas.backup.backups(self._config):
+            if backup.should_backup():
+                timestamp = backup.last_backup_timestamp()
+                backup_jobs[backup.name()] = (
+                    timestamp.timestamp() if timestamp else None
+                )
+        # the backup is as old as its oldest job
+        backup_timestamps = list(backup_jobs.values())
+        backup_timestamp = (
+            min(backup_timestamps)
+            if backup_timestamps and None not in backup_timestamps
+            else None
+        )
+        keyfile_sync_timestamp = (
+            self._state["phases"]
+            .get(PHASE_KEYFILE_SYNC, {})
+            .get("last_success_timestamp")
+        )
+
+        return {
+            "hostname": self._hostname,
+            "username": self._linux_username,
+            "last_run": self._state.get("last_run"),
+            "backup_last_success_timestamp": backup_timestamp,
+            "backup_age_seconds": now - backup_timestamp if backup_timestamp else None,
+            "backup_jobs": backup_jobs,
+            "keyfile_sync_last_success_timestamp": keyfile_sync_timestamp,
+            "keyfile_sync_age_seconds": (
+                now - keyfile_sync_timestamp if keyfile_sync_timestamp else None
+            ),
+            "phases": self._state["phases"],
+            "drives": self._state["drives"],
+        }
+
+    def save(self):
+        self._write_atomically(self._state_file_path, json.dumps(self._state, indent=2))
+        if self._textfile_path:
+            self._write_atomically(self._textfile_path, self.to_prometheus_text())
+
+    @staticmethod
+    def _write_atomically(file_path: Path, content: str):
+        # write to a temp file in the same directory and rename it, so that readers
+        # never see a partial file
+        fd, temp_path = tempfile.mkstemp(
+            dir=file_path.parent, prefix=f".{file_path.name}."
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def to_prometheus_text(self) -> str:
+        status = self.status()
+        lines = []
+
+        def gauge(name: str, help_text: str, samples: list[tuple[dict, float | None]]):
+            samples = [
+                (labels, value) for labels, value in samples if value is not None
+            ]
+            if not samples:
+                return
+            metric_name = f"{_METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {metric_name} {help_text}")
+            lines.append(f"# TYPE {metric_name} gauge")
+            for labels, value in samples:
+                all_labels = {"user": self._linux_username, **labels}
+                labels_str = ",".join(
+                    f'{k}="{_escape_label_value(v)}"' for k, v in all_labels.items()
+                )
+                lines.append(f"{metric_name}{{{labels_str}}} {float(value)}")
+
+        last_run = status["last_run"] or {}
+        phases = status["phases"].items()
+        drives = status["drives"].items()
+        gauge(
+            "last_run_timestamp_seconds",
+            "End of the latest run",
+            [({}, last_run.get("timestamp"))],
+        )
+        gauge(
+            "last_run_success",
+            "Whether the latest run succeeded",
+            [({}, last_run.get("success"))],
+        )
+        gauge(
+            "phase_duration_seconds",
+            "Duration of the latest run of a phase",
+            [({"phase": phase}, s.get("duration_seconds")) for phase, s in phases],
+        )
+        gauge(
+            "phase_success",
+            "Whether the latest run of a phase succeeded",
+            [({"phase": phase}, s.get("success")) for phase, s in phases],
+        )
+        gauge(
+            "phase_last_success_timestamp_seconds",
+            "End of the latest successful run of a phase",
+            [
+                ({"phase": phase}, s.get("last_success_timestamp"))
+                for phase, s in phases
+            ],
+        )
+        gauge(
+            "backup_last_success_timestamp_seconds",
+            "Date of the latest successful backup of a job",
+            [
+                ({"job": job}, timestamp)
+                for job, timestamp in status["backup_jobs"].items()
+            ],
+        )
+        gauge(
+            "keyfile_sync_age_seconds",
+            "Time since the latest successful keyfile synchronization",
+            [({}, status["keyfile_sync_age_seconds"])],
+        )
+        gauge(
+            "drive_mounted",
+            "Whether a NAS drive is mounted",
+            [({"drive": drive}, s.get("mounted")) for drive, s in drives],
+        )
+        gauge(
+            "drive_mount_latency_seconds",
+            "Time taken to check or mount a NAS drive",
+            [({"drive": drive}, s.get("latency_seconds")) for drive, s in drives],
+        )
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label_value(value) -> str:
+    # see https://prometheus.io/docs/instrumenting/exposition_formats/#text-format-details
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@contextlib.contextmanager
+def _locked_metrics(config):
+    """
+    Metrics loaded then saved with other processes locked out (eg. --keepass-watch
+    during a run), so that none of their updates is lost
+    """
+    with open(Path(sys.path[0]) / _LOCK_FILE_NAME, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        metrics = Metrics(config)
+        yield metrics
+        try:
+            metrics.save()
+        except OSError as e:
+            _logger.error("can't save metrics: %s", e)
+
+
+def record_phase(config, phase: str, success: bool, duration_s: float | None):
+    """
+    Records the outcome of a phase run on its own (eg. -k, -b, --backup-scheduler),
+    rather than by the desktop run
+    """
+    with _locked_metrics(config) as metrics:
+        metrics.record_phase(phase, success, duration_s, time.time())
+
+
+class MetricsSink(EventSink):
+    """
+    Records phase durations and drive mount status from events, and saves metrics each
+    time it is flushed.
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._phase_starts: dict[str, float] = {}
+        self._run_success: bool = True
+        # applied to the metrics as saved by then, when flushed
+        self._records: list[Callable[[Metrics], None]] = []
+
+    def handle(self, event: Event) -> None:
+        if isinstance(event, PhaseStarted):
+            self._phase_starts[event.phase] = event.timestamp
+        elif isinstance(event, PhaseEnded):
+            start = self._phase_starts.pop(event.phase, None)
+            duration_s = event.timestamp - start if start else None
+            self._records.append(
+                lambda m, e=event, d=duration_s: m.record_phase(
+                    e.phase, e.success, d, e.timestamp, skipped=e.skipped
+                )
+            )
+            self._run_success = self._run_success and event.success
+        elif isinstance(event, ItemDone) and event.phase == PHASE_AUTOMOUNT:
+            self._records.append(
+                lambda m, e=event: m.record_drive(e.item, e.success, e.duration_s)
+            )
+
+    def flush(self) -> None:
+        records, self._records = self._records, []
+        with _locked_metrics(self._config) as metrics:
+            for record in records:
+                record(metrics)
+            metrics.record_run(self._run_success, time.time())
+
+
+def print_status(config, as_json: bool):
+    status = Metrics(config).status()
+    if as_json:
+        print(json.dumps(status, indent=2))
+        return
+
+    def age(seconds: float | None) -> str:
+        return f"{seconds / 3600:.1f} hours ago" if seconds is not None else "never"
+
+    def outcome(success: bool | None) -> str:
+        return "success" if success else "FAILURE"
+
+    last_run = status["last_run"]
+    print(f"{status['username']}@{status['hostname']}")
+    if last_run:
+        print(
+            f"last run: {outcome(last_run['success'])}, {age(time.time() - last_run['timestamp'])}"
+        )
+    else:
+        print("last run: never")
+    print(f"last backup: {age(status['backup_age_seconds'])}")
+    if len(status["backup_jobs"]) > 1:
+        for job, timestamp in status["backup_jobs"].items():
+            print(
+                f"  backup {job}: {age(time.time() - timestamp if timestamp else None)}"
+            )
+    print(f"last keyfile synchronization: {age(status['keyfile_sync_age_seconds'])}")
+    for phase, phase_status in status["phases"].items():
+        print(
+            f"phase {phase}: {outcome(phase_status['success'])} ({phase_status['duration_seconds'] or 0:.1f}s)"
+        )
+    for drive, drive_status in status["drives"].items():
+        mounted = "mounted" if drive_status["mounted"] else "NOT MOUNTED"
+        print(f"drive {drive}: {mounted} ({drive_status['latency_seconds'] or 0:.2f}s)")
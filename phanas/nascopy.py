@@ -1,39 +1,92 @@
 import logging
 import os
+import re
 import subprocess
 import sys
+import time
 
 from pathlib import Path
+from typing import Callable
+
+import phanas.metrics
+from phanas.events import PHASE_NASCOPY, format_bytes
+from phanas.job_runner import Job, job_runner
+from phanas.lease import run_leased
+from phanas.nascopy_engine import NasCopyEngine
+from phanas.rsync_progress import (
+    RsyncProgress,
+    RsyncProgressParser,
+    append_run_totals,
+    is_progress2_line,
+)
+
+_NASCOPY_CONFIG_JSON_OBJECT_NAME = "nascopy"
+_JOBS_CONFIG_JSON_OBJECT_NAME = "jobs"
+_JOB_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+DEFAULT_TARGET = "nas"
 
 
 class NasCopy:
+    """
+    A NAS copy job: either the single copy configured in the "nascopy" object, or one of
+    its named "jobs".
+    """
+
     __logger = logging.getLogger("nascopy")
 
     __script_path = None
+    __nascopy_engine = None
+    __script_dir = Path(sys.path[0])
 
-    def __init__(self, config):
-        self.__load_nascopyscript_path(config)
+    def __init__(self, config, job: dict | None = None):
+        if job is not None:
+            nascopy_config = job
+            self.__job_name = job.get("name")
+            self.__target = job.get("target", DEFAULT_TARGET)
+        else:
+            nascopy_config = (
+                config.get(_NASCOPY_CONFIG_JSON_OBJECT_NAME) if config else None
+            )
+            self.__job_name = None
+            self.__target = DEFAULT_TARGET
 
-    def __load_nascopyscript_path(self, config):
-        nascopy_name = "nascopy"
-        script_path_name = "script_path"
+        if not isinstance(nascopy_config, dict):
+            self.__logger.info(
+                "config does not contain %s", _NASCOPY_CONFIG_JSON_OBJECT_NAME
+            )
+            return
+        suffix = f"_{self.__job_name}" if self.__job_name else ""
+        self.__manifest_file_path = (
+            self.__script_dir / ".index" / f"nascopy_manifest{suffix}.sqlite"
+        )
+        if not self.__load_native_engine(nascopy_config):
+            self.__load_nascopyscript_path(nascopy_config)
 
-        if not config:
-            self.__logger.info("no config")
-            return False
+    def name(self) -> str:
+        return self.__job_name or _NASCOPY_CONFIG_JSON_OBJECT_NAME
 
-        if not nascopy_name in config:
-            self.__logger.info("config does not contain %s", nascopy_name)
-            return False
+    def job_id(self) -> str:
+        """Identifies the job in run history and NAS leases"""
+        if self.__job_name:
+            return f"{_NASCOPY_CONFIG_JSON_OBJECT_NAME}_{self.__job_name}"
+        return _NASCOPY_CONFIG_JSON_OBJECT_NAME
 
-        nascopy_config = config[nascopy_name]
-        if (
-            not isinstance(nascopy_config, dict)
-            or not script_path_name in nascopy_config
-        ):
+    def display_name(self) -> str:
+        return f"NAS copy {self.__job_name}" if self.__job_name else "NAS copy"
+
+    def target(self) -> str:
+        """
+        Where the job writes to, jobs with the same target do not run at the same time
+        """
+        return self.__target
+
+    def __load_nascopyscript_path(self, nascopy_config):
+        script_path_name = "script_path"
+
+        if not script_path_name in nascopy_config:
             self.__logger.info(
-                "'%s' is not an object or does not contain name '%s'",
-                nascopy_name,
+                "'%s' does not contain name '%s'",
+                self.name(),
                 script_path_name,
             )
             return False
@@ -52,18 +105,78 @@ class NasCopy:
             self.__logger.error("script %s is not executable", script_path)
             return False
 
-        self.__logger.info("nascopy script: %s", script_path)
+        self.__logger.info("%s script: %s", self.name(), script_path)
         self.__script_path = script_path
 
         return True
 
+    def __load_native_engine(self, nascopy_config):
+        native_name = "native"
+        sources_name = "sources"
+        destination_name = "destination"
+
+        if not native_name in nascopy_config:
+            return False
+
+        native_config = nascopy_config[native_name]
+        if (
+            not isinstance(native_config, dict)
+            or not sources_name in native_config
+            or not destination_name in native_config
+        ):
+            self.__logger.info(
+                "'%s' is not an object or does not contain names '%s' and '%s'",
+                native_name,
+                sources_name,
+                destination_name,
+            )
+            return False
+
+        sources = native_config[sources_name]
+        if not isinstance(sources, list) or not sources:
+            self.__logger.info("%s is not a list", sources_name)
+            return False
+        source_paths = [
+            Path(s).expanduser() for s in sources if isinstance(s, str) and s
+        ]
+        for source_path in source_paths:
+            if not source_path.is_dir():
+                self.__logger.error("source %s is not a directory", source_path)
+                return False
+
+        destination = native_config[destination_name]
+        if not isinstance(destination, str) or not destination:
+            self.__logger.info("%s is not a string", destination_name)
+            return False
+
+        self.__logger.info(
+            "native NAS copy of %s to %s",
+            ", ".join(str(p) for p in source_paths),
+            destination,
+        )
+        self.__nascopy_engine = NasCopyEngine(
+            source_paths,
+            Path(destination),
+            self.__manifest_file_path,
+            excludes=native_config.get("excludes", []),
+            workers=native_config.get("workers", 4),
+            delete=native_config.get("delete", False),
+        )
+
+        return True
+
     def should_nascopy(self):
-        if self.__script_path:
+        if self.__script_path or self.__nascopy_engine:
             return True
 
         return False
 
-    def do_nascopy(self):
+    def do_nascopy(
+        self, progress_callback: Callable[[RsyncProgress], None] | None = None
+    ):
+        if self.__nascopy_engine:
+            return self.__do_native_nascopy(progress_callback)
+
         command = [self.__script_path]
 
         proc = subprocess.Popen(
@@ -74,11 +187,20 @@ class NasCopy:
             universal_newlines=True,
         )
 
+        parser = RsyncProgressParser()
+
         def check_std(std, loglevel):
             while True:
                 output = std.readline()
                 if output:
-                    self.__logger.log(loglevel, output.strip())
+                    line = output.strip()
+                    # progress lines are frequent and only relevant while the script
+                    # runs
+                    self.__logger.log(
+                        logging.DEBUG if is_progress2_line(line) else loglevel, line
+                    )
+                    if parser.parse_line(line) and progress_callback:
+                        progress_callback(parser.progress)
                 else:
                     break
 
@@ -89,23 +211,101 @@ class NasCopy:
             check_io()
             proc.wait()
 
+        append_run_totals(
+            self.job_id(), parser.progress.to_totals(proc.returncode == 0)
+        )
         if proc.returncode != 0:
-            return False, "nascopy script had an error. Check the logs"
+            return False, f"{self.name()} script had an error. Check the logs"
 
         return True, None
 
+    def __do_native_nascopy(self, progress_callback):
+        status, msg = self.__nascopy_engine.run(progress_callback=progress_callback)
+        progress = self.__nascopy_engine.progress
+        if progress:
+            totals = progress.to_totals(status)
+            append_run_totals(self.job_id(), totals)
+            if status and totals["files"]:
+                msg = f"{totals['files']} files copied ({format_bytes(totals['bytes'])}"
+                if totals["bytes_per_s"]:
+                    msg += f", {format_bytes(totals['bytes_per_s'])}/s"
+                msg += ")"
+        return status, msg
+
+
+def nascopies(config) -> list[NasCopy]:
+    """
+    NAS copy jobs of the config: the named jobs of nascopy.jobs if any, otherwise the
+    single NAS copy
+    """
+    logger = logging.getLogger("nascopy")
+    nascopy_config = config.get(_NASCOPY_CONFIG_JSON_OBJECT_NAME) if config else None
+    if (
+        not isinstance(nascopy_config, dict)
+        or not _JOBS_CONFIG_JSON_OBJECT_NAME in nascopy_config
+    ):
+        return [NasCopy(config)]
+
+    jobs = nascopy_config[_JOBS_CONFIG_JSON_OBJECT_NAME]
+    if not isinstance(jobs, list):
+        logger.error("%s is not a list", _JOBS_CONFIG_JSON_OBJECT_NAME)
+        return []
+
+    result = []
+    names = set()
+    for job in jobs:
+        name = job.get("name") if isinstance(job, dict) else None
+        if not isinstance(name, str) or not _JOB_NAME_PATTERN.match(name):
+            logger.error(
+                "nascopy job %s has no name, or a name with other than letters, digits, - and _",
+                job,
+            )
+            continue
+        if name in names:
+            logger.error("nascopy job %s is defined more than once", name)
+            continue
+        names.add(name)
+        result.append(NasCopy(config, job))
+
+    return result
+
 
 def run(config):
     logger = logging.getLogger("nascopy")
     logger.info("NAS Copy started")
 
-    nascopy = NasCopy(config)
+    jobs = []
+    for nascopy in nascopies(config):
+        if not nascopy.should_nascopy():
+            logger.info("%s is not configured", nascopy.display_name())
+            continue
+        jobs.append(
+            Job(
+                nascopy.name(),
+                nascopy.target(),
+                lambda n=nascopy: run_leased(
+                    config,
+                    n.job_id(),
+                    n.display_name(),
+                    n.target() == DEFAULT_TARGET,
+                    n.do_nascopy,
+                ),
+            )
+        )
 
-    if nascopy.should_nascopy():
-        status, msg = nascopy.do_nascopy()
-        if not status:
-            logger.error(msg)
-    else:
-        logger.info("NAS copy is not configured")
+    if jobs:
+        start = time.monotonic()
+        results = job_runner(config).run(jobs)
+        for result in results:
+            if not result.success:
+                logger.error(result.msg)
+            elif result.msg:
+                logger.info(result.msg)
+        phanas.metrics.record_phase(
+            config,
+            PHASE_NASCOPY,
+            all(result.success for result in results),
+            time.monotonic() - start,
+        )
 
     logger.info("NAS copy to Phanas done")
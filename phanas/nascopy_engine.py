@@ -0,0 +1,346 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import stat
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+import phanas.file_utils
+from phanas.events import format_bytes
+from phanas.rsync_progress import RsyncProgress
+from phanas.tree_index import scan_trees
+
+NAS_MANIFEST_FILE_NAME = ".phanas_nascopy_manifest.jsonl.gz"
+_TEMP_SUFFIX = ".phanas-tmp"
+_COPY_BUFFER_SIZE = 1024 * 1024
+_DEFAULT_WORKERS = 4
+
+_logger = logging.getLogger("nascopy_engine")
+
+# size, mtime_ns, sha256
+ManifestEntry = tuple[int, int, str]
+
+
+class NasCopyEngine:
+    """
+    Copies the source directories to the destination directory on the NAS, each source
+    into a directory of the same name. Only files new or changed since the previous run
+    are copied, by a pool of threads.
+
+    Copied files are recorded in a manifest (size, modification time and hash of each
+    file). The manifest is kept locally, so computing what changed does not touch the
+    NAS, and on the NAS next to the copy, from which the local manifest is restored when
+    it is missing or out of date (eg. copy last run from another clone directory). Files
+    are copied to a temp file renamed once complete, so an interrupted run never leaves
+    partial files. A file whose modification time changed but whose content did not (eg.
+    touched) is not copied again, only its modification time is updated.
+
+    Only regular files are copied: symbolic links and special files are skipped.
+    """
+
+    def __init__(
+        self,
+        source_paths: list[Path],
+        destination_path: Path,
+        manifest_path: Path,
+        excludes: list[str] | None = None,
+        workers: int = _DEFAULT_WORKERS,
+        delete: bool = False,
+    ):
+        self._source_paths = source_paths
+        self._destination_path = destination_path
+        self._manifest_path = manifest_path
+        self._nas_manifest_path = destination_path / NAS_MANIFEST_FILE_NAME
+        self._excludes = excludes or []
+        self._workers = workers
+        self._delete = delete
+        self._lock = threading.Lock()
+        self.progress: RsyncProgress | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        self._manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self._manifest_path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT) WITHOUT ROWID"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        return connection
+
+    def _target_of(self, source: str) -> Path | None:
+        for source_path in self._source_paths:
+            if Path(source).is_relative_to(source_path):
+                return (
+                    self._destination_path
+                    / source_path.name
+                    / Path(source).relative_to(source_path)
+                )
+        return None
+
+    def run(
+        self, progress_callback: Callable[[RsyncProgress], None] | None = None
+    ) -> tuple[bool, str | None]:
+        if not self._destination_path.is_dir():
+            return (
+                False,
+                f"NAS copy destination {self._destination_path} is not a directory",
+            )
+        names = [p.name for p in self._source_paths]
+        if len(set(names)) != len(names):
+            return (
+                False,
+                f"NAS copy sources must have distinct names: {', '.join(names)}",
+            )
+
+        manifest = self._load_manifest()
+        files = scan_trees(
+            self._source_paths, workers=self._workers * 2, excludes=self._excludes
+        )
+        changed = [
+            path
+            for path, (size, mtime_ns, _) in files.items()
+            if manifest.get(path, (None, None))[0:2] != (size, mtime_ns)
+        ]
+        # symbolic links and special files are never in the manifest, they are
+        # filtered out here rather than listed again by each run
+        not_regular = {path for path in changed if not _is_regular_file(path)}
+        to_copy = [path for path in changed if path not in not_regular]
+        # a copied file since replaced by a symbolic link is removed from the copy
+        to_delete = [
+            path for path in manifest.keys() if path not in files or path in not_regular
+        ]
+        _logger.info(
+            "%s files to copy (%s), %s removed from sources",
+            len(to_copy),
+            format_bytes(sum(files[path][0] for path in to_copy)),
+            len(to_delete),
+        )
+
+        progress = RsyncProgress()
+        self.progress = progress
+        progress.files_total = len(to_copy)
+        progress.bytes_total = sum(files[path][0] for path in to_copy)
+        copied: dict[str, ManifestEntry] = {}
+        skipped = []
+        errors = []
+
+        def copy(source: str):
+            target = self._target_of(source)
+            try:
+                if not stat.S_ISREG(os.lstat(source).st_mode):
+                    _logger.debug("%s is not a regular file, not copied", source)
+                    sha256 = None
+                else:
+                    sha256 = self._copy_if_changed(
+                        source, target, files[source][0], manifest.get(source)
+                    )
+            except OSError as e:
+                _logger.error("can't copy %s: %s", source, e)
+                with self._lock:
+                    errors.append(source)
+                return
+
+            with self._lock:
+                if sha256:
+                    copied[source] = (files[source][0], files[source][1], sha256)
+                else:
+                    skipped.append(source)
+                progress.files_done += 1
+                progress.current_file = source
+                progress.bytes_done += files[source][0]
+                elapsed_s = time.time() - progress.started_at
+                if elapsed_s > 0 and progress.bytes_done:
+                    progress.bytes_per_s = progress.bytes_done / elapsed_s
+                    progress.eta_s = (
+                        progress.bytes_total - progress.bytes_done
+                    ) / progress.bytes_per_s
+                if progress_callback:
+                    progress_callback(progress)
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            for _ in executor.map(copy, to_copy):
+                pass
+        if skipped:
+            # replaced by a symbolic link or special file since the scan
+            _logger.info("%s symbolic links or special files not copied", len(skipped))
+
+        deleted = self._delete_targets(to_delete) if self._delete else to_delete
+        progress.files_deleted = len(deleted) if self._delete else 0
+        # copied files are recorded even when others failed, so the next run only
+        # retries the failed ones
+        self._commit_manifest(copied, deleted)
+
+        if errors:
+            return (
+                False,
+                f"{len(errors)} files could not be copied to {self._destination_path}. Check the logs",
+            )
+        return True, None
+
+    def _copy_if_changed(
+        self, source: str, target: Path, size: int, entry: ManifestEntry | None
+    ) -> str:
+        """
+        Copies source to target, unless its content is the one in the manifest entry,
+        returns the hash of the content
+        """
+        if entry and entry[0] == size and entry[2]:
+            # reading the source locally is cheaper than writing it to the NAS
+            sha256 = phanas.file_utils.compute_hash(source)
+            if sha256 == entry[2] and target.is_file():
+                _logger.debug("%s did not change, not copied", source)
+                shutil.copystat(source, target)
+                return sha256
+        return self._copy(source, target)
+
+    @staticmethod
+    def _copy(source: str, target: Path) -> str:
+        """
+        Copies source to target through a temp file, returns the hash of the content
+        """
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = target.with_name(target.name + _TEMP_SUFFIX)
+        sha256 = hashlib.sha256()
+        try:
+            with open(source, "rb") as src, open(temp_path, "wb") as dst:
+                while chunk := src.read(_COPY_BUFFER_SIZE):
+                    sha256.update(chunk)
+                    dst.write(chunk)
+            shutil.copystat(source, temp_path)
+            os.replace(temp_path, target)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        return sha256.hexdigest()
+
+    def _delete_targets(self, sources: list[str]) -> list[str]:
+        deleted = []
+        for source in sources:
+            target = self._target_of(source)
+            try:
+                if target:
+                    target.unlink(missing_ok=True)
+                deleted.append(source)
+            except OSError as e:
+                _logger.error("can't delete %s: %s", target, e)
+        return deleted
+
+    def _load_manifest(self) -> dict[str, ManifestEntry]:
+        nas_label = self._read_nas_manifest_label()
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT value FROM meta WHERE key = 'label'"
+            ).fetchone()
+            local_label = row[0] if row else None
+            if local_label != nas_label:
+                _logger.info(
+                    "local manifest is not about the copy on the NAS, restoring it from %s",
+                    self._nas_manifest_path,
+                )
+                connection.execute("DELETE FROM files")
+                if nas_label:
+                    try:
+                        connection.executemany(
+                            "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                            self._read_nas_manifest_entries(),
+                        )
+                    except (OSError, ValueError, EOFError, KeyError) as e:
+                        _logger.error(
+                            "can't read %s, copying all files: %s",
+                            self._nas_manifest_path,
+                            e,
+                        )
+                        connection.execute("DELETE FROM files")
+                        nas_label = None
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('label', ?)",
+                    (nas_label,),
+                )
+            manifest = {
+                path: (size, mtime_ns, sha256)
+                for path, size, mtime_ns, sha256 in connection.execute(
+                    "SELECT path, size, mtime_ns, sha256 FROM files"
+                )
+            }
+        connection.close()
+        return manifest
+
+    def _commit_manifest(self, copied: dict[str, ManifestEntry], deleted: list[str]):
+        label = uuid.uuid4().hex
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                ((path, *entry) for path, entry in copied.items()),
+            )
+            connection.executemany(
+                "DELETE FROM files WHERE path = ?", ((path,) for path in deleted)
+            )
+            rows = connection.execute(
+                "SELECT path, size, mtime_ns, sha256 FROM files"
+            ).fetchall()
+            try:
+                self._write_nas_manifest(label, rows)
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('label', ?)",
+                    (label,),
+                )
+            except OSError as e:
+                # local manifest must keep describing the NAS manifest: files copied by
+                # this run are copied again
+                _logger.error(
+                    "can't write manifest to %s: %s", self._nas_manifest_path, e
+                )
+                connection.rollback()
+        connection.close()
+
+    def _write_nas_manifest(self, label: str, rows: list[tuple]):
+        temp_path = self._nas_manifest_path.with_name(
+            self._nas_manifest_path.name + _TEMP_SUFFIX
+        )
+        with gzip.open(temp_path, "wt") as f:
+            f.write(json.dumps({"label": label}) + "\n")
+            for path, size, mtime_ns, sha256 in rows:
+                f.write(
+                    json.dumps(
+                        {
+                            "path": path,
+                            "size": size,
+                            "mtime_ns": mtime_ns,
+                            "sha256": sha256,
+                        }
+                    )
+                    + "\n"
+                )
+        os.replace(temp_path, self._nas_manifest_path)
+
+    def _read_nas_manifest_label(self) -> str | None:
+        try:
+            with gzip.open(self._nas_manifest_path, "rt") as f:
+                return json.loads(f.readline()).get("label")
+        except (OSError, ValueError, EOFError):
+            return None
+
+    def _read_nas_manifest_entries(self):
+        with gzip.open(self._nas_manifest_path, "rt") as f:
+            f.readline()
+            for line in f:
+                entry = json.loads(line)
+                yield entry["path"], entry["size"], entry["mtime_ns"], entry["sha256"]
+
+
+def _is_regular_file(path: str) -> bool:
+    try:
+        return stat.S_ISREG(os.lstat(path).st_mode)
+    except OSError:
+        # eg. deleted since the scan, copy reports it
+        return True
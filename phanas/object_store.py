@@ -0,0 +1,74 @@
+import logging
+import os
+import tempfile
+
+from pathlib import Path
+
+import phanas.file_utils
+
+_logger = logging.getLogger("object_store")
+
+
+class ObjectStore:
+    """
+    Content-addressed store of files: each content is stored once, read-only, as
+    {root}/{hash[:2]}/{hash}{suffix} where hash is its SHA-256.
+    """
+
+    def __init__(self, root_path: Path, suffix: str = ""):
+        self._root_path = root_path
+        self._suffix = suffix
+
+    def path_of(self, sha256: str) -> Path:
+        return self._root_path / sha256[0:2] / f"{sha256}{self._suffix}"
+
+    def put(
+        self,
+        source_path: Path,
+        sha256: str | None = None,
+        source_stat: os.stat_result | None = None,
+    ) -> tuple[str, str | None]:
+        """
+        Stores the content of source_path, unless already stored. Returns its hash, and
+        how it was copied (see file_utils.copy_file) or None when already stored.
+
+        The hash is computed, unless given with source_stat, the stat of source_path
+        when it was hashed (eg. from a copy of it): then nothing is read when already
+        stored, and the copy can be made server-side. Stored files are not read back:
+        storing fails if the size or modification time of the source changes meanwhile.
+        """
+        if sha256 is None or source_stat is None:
+            source_stat = os.stat(source_path)
+            sha256 = phanas.file_utils.compute_hash(source_path)
+        object_path = self.path_of(sha256)
+        if object_path.exists():
+            _logger.debug("%s already stored as %s", source_path, object_path)
+            return sha256, None
+
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename, so that a partial object is never stored under its hash
+        fd, temp_path = tempfile.mkstemp(
+            dir=object_path.parent, prefix=f".{object_path.name}."
+        )
+        os.close(fd)
+        try:
+            copy_method = phanas.file_utils.copy_file(source_path, temp_path)
+            if not self._same_stat(os.stat(source_path), source_stat):
+                raise OSError(f"{source_path} changed while storing it")
+            phanas.file_utils.make_readonly(temp_path)
+            os.replace(temp_path, object_path)
+        except BaseException:
+            Path(temp_path).unlink(missing_ok=True)
+            raise
+        _logger.debug("%s stored as %s (%s)", source_path, object_path, copy_method)
+        return sha256, copy_method
+
+    @staticmethod
+    def _same_stat(stat_1: os.stat_result, stat_2: os.stat_result) -> bool:
+        return (stat_1.st_size, stat_1.st_mtime_ns) == (
+            stat_2.st_size,
+            stat_2.st_mtime_ns,
+        )
+
+    def delete(self, sha256: str):
+        self.path_of(sha256).unlink(missing_ok=True)
@@ -2,16 +2,67 @@ import logging
 import phanas.automount as automount
 import phanas.backup
 import phanas.keepass
+import phanas.lease
+import phanas.metrics
 import phanas.nascopy
 import time
 
+from typing import Callable
+
 from phanas.automount import AutoMountLogger
 from phanas.credentials import KeyringCredentialsProvider, InputProvider
+from phanas.job_runner import Job, JobResult, job_runner
+from phanas.logging import log_context
+from phanas.rsync_progress import RsyncProgress
+from phanas.events import (
+    CoalescingSink,
+    ErrorMessage,
+    Event,
+    EventBus,
+    EventSink,
+    ItemDone,
+    ItemProgress,
+    LogSink,
+    Message,
+    PhaseEnded,
+    PhaseStarted,
+    WarningMessage,
+    PHASE_AUTOMOUNT,
+    PHASE_BACKUP,
+    PHASE_KEYFILE_SYNC,
+    PHASE_NASCOPY,
+)
 
 PROGRAM_NAME = "PhanNas Desktop"
+_PHASE_DESKTOP = "desktop"
+
 
+class Output(EventSink):
+    """
+    Text based sink of events: renders events as a label and a list of persistent
+    messages.
+    """
+
+    def handle(self, event: Event) -> None:
+        if isinstance(event, PhaseStarted):
+            self.info_label(event.description)
+        elif isinstance(event, PhaseEnded):
+            if event.msg and event.success:
+                self.add_persistent_msg(event.msg)
+            elif event.msg:
+                self.failure(event.msg)
+        elif isinstance(event, Message):
+            if event.persistent:
+                self.add_persistent_msg(event.msg)
+            else:
+                self.info_label(event.msg)
+        elif isinstance(event, WarningMessage):
+            self.add_persistent_msg(event.msg)
+        elif isinstance(event, ErrorMessage):
+            self.failure(event.msg)
+        elif isinstance(event, ItemProgress):
+            self.info_label(event.describe())
 
-class Output:
     def failure(self, msg):
         pass
 
@@ -29,100 +80,262 @@ class PhanasDesktop:
     def __init__(self, config, logger: logging.Logger):
         self.__config = config
         self.__logger = logger
+        self._events = EventBus()
 
         self.autoMount = automount.AutoMount()
 
-    def _do_automount(self, output: Output):
-        class PersistentMsgAutoMountLogger(AutoMountLogger):
-            def __init__(self, phanas_desktop: PhanasDesktop):
-                self._phanas_desktop = phanas_desktop
+    def _do_automount(self):
+        class EventAutoMountLogger(AutoMountLogger):
+            def __init__(self, events: EventBus, drive_count: int):
+                self._events = events
+                self._drive_count = drive_count
+                self._done_count = 0
 
             def info(self, msg: str) -> None:
-                self._phanas_desktop.add_persistent_msg(output, msg)
+                self._events.emit(Message(PHASE_AUTOMOUNT, msg, persistent=True))
 
             def transient_info(self, msg: str) -> None:
-                self._phanas_desktop.info_label(output, msg)
+                self._events.emit(Message(PHASE_AUTOMOUNT, msg))
 
             def error(self, msg: str) -> None:
-                self._phanas_desktop.failure(output, msg)
+                self._events.emit(ErrorMessage(PHASE_AUTOMOUNT, msg))
+
+            def drive_done(
+                self, drive: str, success: bool, duration_s: float, msg: str | None
+            ) -> None:
+                self._done_count += 1
+                self._events.emit(
+                    ItemDone(
+                        PHASE_AUTOMOUNT, drive, success, duration_s=duration_s, msg=msg
+                    )
+                )
+                self._events.emit(
+                    ItemProgress(
+                        PHASE_AUTOMOUNT, drive, self._done_count, self._drive_count
+                    )
+                )
 
-        return self.autoMount.run(PersistentMsgAutoMountLogger(self))
+        self._events.emit(PhaseStarted(PHASE_AUTOMOUNT, "Connecting NAS drives..."))
+        status = self.autoMount.run(
+            EventAutoMountLogger(self._events, len(self.autoMount.nas.drives()))
+        )
+        self._events.emit(PhaseEnded(PHASE_AUTOMOUNT, status))
+        return status
 
-    def _do_keyfile_synchronization(self, input_provider: InputProvider, output: Output):
-        self.info_label(output, "Synchronizing keyfiles...")
-        keepass = phanas.keepass.KeePass(self.__config, credentials_provider=KeyringCredentialsProvider(input_provider=input_provider))
+    def _do_keyfile_synchronization(self, keepass: phanas.keepass.KeePass):
+        self._events.emit(PhaseStarted(PHASE_KEYFILE_SYNC, "Synchronizing keyfiles..."))
         if keepass.should_synch_keyfiles():
             status, msg = keepass.do_sync()
             if not status:
-                self.failure(output, msg)
+                self._events.emit(PhaseEnded(PHASE_KEYFILE_SYNC, False, msg))
                 return False
-            self.add_persistent_msg(output, "Keyfiles synchronized")
+            self._events.emit(
+                PhaseEnded(PHASE_KEYFILE_SYNC, True, "Keyfiles synchronized")
+            )
         else:
-            self.info_label(output, "Keyfile synchronization not configured")
+            self._events.emit(
+                Message(PHASE_KEYFILE_SYNC, "Keyfile synchronization not configured")
+            )
+            self._events.emit(PhaseEnded(PHASE_KEYFILE_SYNC, True, skipped=True))
 
         return True
 
-    def _do_nascopy(self, output):
-        self.info_label(output, "Synchronizing NAS copy... should be quick...")
-        nascopy = phanas.nascopy.NasCopy(self.__config)
-        if nascopy.should_nascopy():
-            status, msg = nascopy.do_nascopy()
+    def _do_nascopy(self):
+        self._events.emit(
+            PhaseStarted(PHASE_NASCOPY, "Synchronizing NAS copy... should be quick...")
+        )
+        nascopies = [
+            nascopy
+            for nascopy in phanas.nascopy.nascopies(self.__config)
+            if nascopy.should_nascopy()
+        ]
+        if not nascopies:
+            self._events.emit(Message(PHASE_NASCOPY, "NAS copy not configured"))
+            self._events.emit(PhaseEnded(PHASE_NASCOPY, True, skipped=True))
+            return True
+
+        jobs = [
+            Job(
+                nascopy.name(), nascopy.target(), lambda n=nascopy: self._run_nascopy(n)
+            )
+            for nascopy in nascopies
+        ]
+        return self._run_jobs(PHASE_NASCOPY, jobs)
+
+    def _run_nascopy(self, nascopy: phanas.nascopy.NasCopy) -> tuple[bool, str | None]:
+        def do_nascopy() -> tuple[bool, str | None]:
+            status, msg = nascopy.do_nascopy(
+                progress_callback=self._rsync_progress_callback(
+                    PHASE_NASCOPY, nascopy.name()
+                )
+            )
             if not status:
-                self.failure(output, msg)
-                return False
-            self.add_persistent_msg(output, "NAS copy done")
-        else:
-            self.info_label(output, "NAS copy not configured")
+                return False, msg
+            return True, (
+                f"{nascopy.display_name()} done: {msg}"
+                if msg
+                else f"{nascopy.display_name()} done"
+            )
 
-        return True
+        return phanas.lease.run_leased(
+            self.__config,
+            nascopy.job_id(),
+            nascopy.display_name(),
+            nascopy.target() == phanas.nascopy.DEFAULT_TARGET,
+            do_nascopy,
+            on_wait=lambda wait_msg: self._events.emit(
+                Message(PHASE_NASCOPY, wait_msg)
+            ),
+        )
 
-    def _do_backup(self, output) -> bool:
-        self.info_label(output, "Creating backup... can take a while!")
-        backup = phanas.backup.Backup(self.__config)
-        if backup.should_backup():
-            if backup.can_skip():
-                self.add_persistent_msg(output, "Backup done (skipped, recent enough)")
-            else:
-                status, msg = backup.do_backup()
-                if not status:
-                    self.failure(output, msg)
-                    return False
-                self.add_persistent_msg(output, "Backup done")
-        else:
-            self.info_label(output, "Backup not configured")
+    def _do_backup(self) -> bool:
+        self._events.emit(
+            PhaseStarted(PHASE_BACKUP, "Creating backup... can take a while!")
+        )
+        backups = [
+            backup
+            for backup in phanas.backup.backups(self.__config)
+            if backup.should_backup()
+        ]
+        if not backups:
+            self._events.emit(Message(PHASE_BACKUP, "Backup not configured"))
+            self._events.emit(PhaseEnded(PHASE_BACKUP, True, skipped=True))
+            return True
 
-        return True
+        jobs = [
+            Job(backup.name(), backup.target(), lambda b=backup: self._run_backup(b))
+            for backup in backups
+        ]
+        return self._run_jobs(PHASE_BACKUP, jobs)
 
-    def _do_things(self, input_provider: InputProvider, output: Output) -> bool:
-        if not self._do_automount(output):
-            return False
-        if not self._do_keyfile_synchronization(input_provider=input_provider, output=output):
-            return False
-        if not self._do_nascopy(output):
+    def _run_backup(self, backup: phanas.backup.Backup) -> tuple[bool, str | None]:
+        if backup.can_skip():
+            return True, f"{backup.display_name()} skipped ({backup.skip_reason()})"
+
+        changes = backup.change_summary()
+        if changes is not None:
+            self._events.emit(
+                Message(
+                    PHASE_BACKUP,
+                    f"Creating {backup.display_name().lower()} of {changes}... can take a while!",
+                )
+            )
+
+        def do_backup() -> tuple[bool, str | None]:
+            status, msg = backup.do_backup(
+                progress_callback=self._rsync_progress_callback(
+                    PHASE_BACKUP, backup.name()
+                )
+            )
+            if not status:
+                return False, msg
+            return True, f"{backup.display_name()} done"
+
+        return phanas.lease.run_leased(
+            self.__config,
+            backup.job_id(),
+            backup.display_name(),
+            backup.target() == phanas.backup.DEFAULT_TARGET,
+            do_backup,
+            on_wait=lambda wait_msg: self._events.emit(Message(PHASE_BACKUP, wait_msg)),
+        )
+
+    def _run_jobs(self, phase: str, jobs: list[Job]) -> bool:
+        """
+        Runs the jobs of a phase with the job runner. Each job reports its outcome as a
+        persistent message, the phase fails when any job failed.
+        """
+
+        def on_done(result: JobResult):
+            self._events.emit(
+                ItemDone(
+                    phase,
+                    result.job.name,
+                    result.success,
+                    result.duration_s,
+                    result.msg,
+                )
+            )
+            if result.success and result.msg:
+                self._events.emit(Message(phase, result.msg, persistent=True))
+
+        results = job_runner(self.__config).run(jobs, on_done=on_done)
+        failures = [result.msg for result in results if not result.success]
+        if failures:
+            self._events.emit(PhaseEnded(phase, False, "\n".join(failures)))
             return False
-        return self._do_backup(output)
 
-    def do_things(self, input_provider: InputProvider, output: Output):
-        success = self._do_things(input_provider=input_provider, output=output)
+        self._events.emit(PhaseEnded(phase, True))
+        return True
+
+    def _rsync_progress_callback(
+        self, phase: str, job_name: str
+    ) -> Callable[[RsyncProgress], None]:
+        def progress_callback(progress: RsyncProgress):
+            self._events.emit(
+                ItemProgress(
+                    phase,
+                    (
+                        f"{job_name}: {progress.current_file}"
+                        if progress.current_file
+                        else job_name
+                    ),
+                    progress.files_done,
+                    total_count=progress.files_total,
+                    done_bytes=progress.bytes_done,
+                    total_bytes=progress.bytes_total,
+                    bytes_per_s=progress.bytes_per_s,
+                    eta_s=progress.eta_s,
+                )
+            )
+
+        return progress_callback
+
+    def _do_things(self, input_provider: InputProvider) -> bool:
+        keepass = phanas.keepass.KeePass(
+            self.__config,
+            credentials_provider=KeyringCredentialsProvider(
+                input_provider=input_provider
+            ),
+        )
+        # missing keyfile passwords are asked for while drives are mounted
+        keepass.preload_credentials()
+        with log_context(phase=PHASE_AUTOMOUNT):
+            if not self._do_automount():
+                return False
+        with log_context(phase=PHASE_KEYFILE_SYNC):
+            if not self._do_keyfile_synchronization(keepass):
+                return False
+        with log_context(phase=PHASE_NASCOPY):
+            if not self._do_nascopy():
+                return False
+        with log_context(phase=PHASE_BACKUP):
+            return self._do_backup()
+
+    def do_things(
+        self,
+        input_provider: InputProvider,
+        output: Output,
+        sinks: list[EventSink] | None = None,
+    ):
+        metrics_sink = phanas.metrics.MetricsSink(self.__config)
+        self._events = EventBus(
+            [LogSink(self.__logger), CoalescingSink(output), metrics_sink]
+            + (sinks or [])
+        )
+
+        success = self._do_things(input_provider=input_provider)
 
         if success:
-            self.info_label(output, "\n     Closing in 3 seconds...")
+            self._events.emit(Message(_PHASE_DESKTOP, "\n     Closing in 3 seconds..."))
+            self._events.flush()
             time.sleep(3)
             self._close(output)
         else:
-            self.info_label(output, "\n     This window won't close automatically.")
-
-    def failure(self, output, msg):
-        self.__logger.error(msg)
-        output.add_persistent_msg(msg)
-
-    def info_label(self, output, text):
-        self.__logger.info(text)
-        output.info_label(text)
-
-    def add_persistent_msg(self, output, msg):
-        self.__logger.info(msg)
-        output.add_persistent_msg(msg)
+            self._events.emit(
+                Message(_PHASE_DESKTOP, "\n     This window won't close automatically.")
+            )
+            self._events.flush()
 
     def _close(self, output):
         self.__logger.info("closing...")
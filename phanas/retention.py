@@ -0,0 +1,65 @@
+from datetime import datetime
+
+_KEEP_ALL_DAYS_NAME = "keep_all_days"
+_KEEP_DAILY_DAYS_NAME = "keep_daily_days"
+_KEEP_MONTHLY_DAYS_NAME = "keep_monthly_days"
+
+
+class RetentionPolicy:
+    """
+    Tiered retention of dated backups: all backups younger than keep_all_days are kept,
+    then the latest backup of each day younger than keep_daily_days, then the latest
+    backup of each month younger than keep_monthly_days. The latest backup is always
+    kept.
+    """
+
+    def __init__(
+        self, keep_all_days: int, keep_daily_days: int = 0, keep_monthly_days: int = 0
+    ):
+        self.keep_all_days: int = keep_all_days
+        self.keep_daily_days: int = keep_daily_days
+        self.keep_monthly_days: int = keep_monthly_days
+
+    @staticmethod
+    def from_config(
+        retention_config: dict | None, default: "RetentionPolicy"
+    ) -> "RetentionPolicy":
+        if not isinstance(retention_config, dict):
+            return default
+        return RetentionPolicy(
+            keep_all_days=retention_config.get(
+                _KEEP_ALL_DAYS_NAME, default.keep_all_days
+            ),
+            keep_daily_days=retention_config.get(
+                _KEEP_DAILY_DAYS_NAME, default.keep_daily_days
+            ),
+            keep_monthly_days=retention_config.get(
+                _KEEP_MONTHLY_DAYS_NAME, default.keep_monthly_days
+            ),
+        )
+
+    def expired(self, timestamps: list[datetime], now: datetime) -> set[datetime]:
+        kept = set()
+        days = set()
+        months = set()
+        for timestamp in sorted(timestamps, reverse=True):
+            age_in_days = (now.date() - timestamp.date()).days
+            day = timestamp.date()
+            month = (timestamp.year, timestamp.month)
+            if not kept or age_in_days <= self.keep_all_days:
+                kept.add(timestamp)
+            elif age_in_days <= self.keep_daily_days and day not in days:
+                kept.add(timestamp)
+            elif age_in_days <= self.keep_monthly_days and month not in months:
+                kept.add(timestamp)
+            # a day or month is covered by its latest backup, whichever tier kept it
+            days.add(day)
+            months.add(month)
+
+        return set(timestamps) - kept
+
+    def __str__(self):
+        return (
+            f"RetentionPolicy(all={self.keep_all_days}d, daily={self.keep_daily_days}d, "
+            f"monthly={self.keep_monthly_days}d)"
+        )
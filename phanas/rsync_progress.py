@@ -0,0 +1,156 @@
+import json
+import logging
+import re
+import sys
+import time
+
+from pathlib import Path
+
+from phanas.events import format_bytes
+
+_RUN_HISTORY_FILE_NAME = "runs.phanas"
+
+# rsync --info=progress2 line, such as "  1,234,567  45%   12.34MB/s    0:01:23 (xfr#12,
+# to-chk=100/2000)"
+_PROGRESS2_PATTERN = re.compile(
+    r"^\s*(?P<bytes>[\d,.]+)\s+(?P<percent>\d+)%\s+(?P<rate>[\d.,]+)(?P<rate_unit>[kMGT]?B)/s\s+(?P<time>\d+:\d{2}:\d{2})"
+    r"(?:\s+\(xfr#(?P<xfr>\d+),\s+(?:to|ir)-chk=(?P<remaining>\d+)/(?P<total>\d+)\))?"
+)
+# rsync --itemize-changes line, such as ">f.st...... path/to/file" or "cd+++++++++
+# path/to/dir/"
+_ITEMIZE_PATTERN = re.compile(
+    r"^(?P<update>[<>ch.*])(?P<type>[fdLDS])[.+?cstTpoguax]{9,10}\s(?P<path>.+)$"
+)
+_DELETING_PREFIX = "*deleting "
+_RATE_UNITS = {"B": 1, "kB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4}
+
+_logger = logging.getLogger("rsync_progress")
+
+
+def is_progress2_line(line: str) -> bool:
+    return _PROGRESS2_PATTERN.match(line) is not None
+
+
+class RsyncProgress:
+    def __init__(self):
+        self.started_at: float = time.time()
+        self.files_done: int = 0
+        self.files_total: int | None = None
+        self.files_deleted: int = 0
+        self.bytes_done: int = 0
+        self.bytes_total: int | None = None
+        self.bytes_per_s: float | None = None
+        self.eta_s: float | None = None
+        self.current_file: str | None = None
+
+    def to_totals(self, success: bool) -> dict:
+        ended_at = time.time()
+        duration_s = ended_at - self.started_at
+        return {
+            "started_at": self.started_at,
+            "ended_at": ended_at,
+            "success": success,
+            "files": self.files_done,
+            "files_deleted": self.files_deleted,
+            "bytes": self.bytes_done,
+            "bytes_per_s": self.bytes_done / duration_s if duration_s > 0 else None,
+        }
+
+
+class RsyncProgressParser:
+    """
+    Turns the output of rsync based scripts (rsync-time-backup, nascopy) into progress:
+    files and bytes transferred, throughput and ETA.
+
+    Understands lines of rsync's --info=progress2 and --itemize-changes outputs, any
+    other line is ignored. Once a progress2 line is seen, it is the only source of the
+    counts of files and of the ETA: itemize lines only give the current file. When the
+    script does not use progress2, files are counted from itemize lines and bytes,
+    throughput and ETA are not known.
+    """
+
+    def __init__(self):
+        self.progress = RsyncProgress()
+        self._progress2_seen = False
+
+    def parse_line(self, line: str) -> bool:
+        """
+        Returns True when the line is an rsync progress or itemize line and progress was
+        updated
+        """
+        match = _PROGRESS2_PATTERN.match(line)
+        if match:
+            self._parse_progress2(match)
+            return True
+
+        if line.startswith(_DELETING_PREFIX):
+            self.progress.files_deleted += 1
+            return True
+
+        match = _ITEMIZE_PATTERN.match(line)
+        if match:
+            if match.group("type") == "f" and match.group("update") in "<>":
+                self.progress.current_file = match.group("path")
+                if not self._progress2_seen:
+                    self.progress.files_done += 1
+            return True
+
+        return False
+
+    def _parse_progress2(self, match: re.Match):
+        self._progress2_seen = True
+        progress = self.progress
+        progress.bytes_done = int(re.sub(r"[,.]", "", match.group("bytes")))
+        percent = int(match.group("percent"))
+        if percent > 0:
+            progress.bytes_total = int(progress.bytes_done * 100 / percent)
+
+        rate = float(match.group("rate").replace(",", "."))
+        progress.bytes_per_s = rate * _RATE_UNITS.get(match.group("rate_unit"), 1)
+
+        # time is the ETA while transferring, and the elapsed time on the last line of a
+        # transfer
+        hours, minutes, seconds = (int(s) for s in match.group("time").split(":"))
+        progress.eta_s = hours * 3600 + minutes * 60 + seconds if percent < 100 else 0
+
+        if match.group("total"):
+            total = int(match.group("total"))
+            progress.files_total = total
+            progress.files_done = total - int(match.group("remaining"))
+
+
+def append_run_totals(job: str, totals: dict):
+    """
+    Appends totals of a run to the history of runs, one JSON object per line, to compare
+    runs later on
+    """
+    run_history_path = Path(sys.path[0]) / _RUN_HISTORY_FILE_NAME
+    previous = last_run_totals(job)
+    if previous:
+        _logger.info(
+            "%s: %s files, %s (previous run: %s files, %s)",
+            job,
+            totals["files"],
+            format_bytes(totals["bytes"]),
+            previous["files"],
+            format_bytes(previous["bytes"]),
+        )
+    with open(run_history_path, "a") as f:
+        f.write(json.dumps({"job": job, **totals}) + "\n")
+
+
+def last_run_totals(job: str) -> dict | None:
+    run_history_path = Path(sys.path[0]) / _RUN_HISTORY_FILE_NAME
+    if not run_history_path.is_file():
+        return None
+
+    last = None
+    with open(run_history_path, "r") as f:
+        for line in f:
+            try:
+                totals = json.loads(line)
+            except ValueError:
+                continue
+            if totals.get("job") == job:
+                last = totals
+    return last
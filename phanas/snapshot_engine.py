@@ -0,0 +1,236 @@
+import logging
+import os
+import re
+import shutil
+import stat
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable
+
+from phanas.rsync_progress import RsyncProgress
+from phanas.tree_index import TreeIndex
+
+# same format as rsync-time-backup, so that both engines can share a destination
+SNAPSHOT_NAME_FORMAT = "%Y-%m-%d-%H%M%S"
+SNAPSHOT_NAME_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}-\d{6}$")
+_IN_PROGRESS_SUFFIX = ".inprogress"
+_DEFAULT_WORKERS = 4
+
+_logger = logging.getLogger("snapshot")
+
+
+def list_snapshots(destination_path: Path) -> list[str]:
+    """Names of the complete snapshots in destination, oldest first"""
+    if not destination_path.is_dir():
+        return []
+    return sorted(
+        p.name
+        for p in destination_path.iterdir()
+        if SNAPSHOT_NAME_PATTERN.match(p.name) and p.is_dir()
+    )
+
+
+class SnapshotEngine:
+    """
+    Creates a dated snapshot of the source directories in the destination directory.
+    Files which did not change since the previous snapshot are hard linked to it,
+    changed files are copied by a pool of threads.
+
+    Changed files are found from a local manifest of the sources as of the previous
+    snapshot, so deciding which files changed does not touch the NAS. A snapshot is
+    created in a ".inprogress" directory, renamed once complete. Each source is stored
+    in the snapshot under its absolute path, such as {snapshot}/home/donut for
+    /home/donut. Special files (FIFOs, sockets, devices), and files deleted between the
+    scan and their copy, are not backed up.
+
+    When expiration_days is set, snapshots older than this are deleted after a snapshot
+    is created, except the latest one.
+    """
+
+    def __init__(
+        self,
+        source_paths: list[Path],
+        destination_path: Path,
+        manifest_path: Path,
+        excludes: list[str] | None = None,
+        workers: int = _DEFAULT_WORKERS,
+        expiration_days: int | None = None,
+    ):
+        self._source_paths = source_paths
+        self._destination_path = destination_path
+        self._manifest = TreeIndex(manifest_path, source_paths, excludes=excludes)
+        self._workers = workers
+        self._expiration_days = expiration_days
+        self._lock = threading.Lock()
+        self.progress: RsyncProgress | None = None
+
+    def run(
+        self, progress_callback: Callable[[RsyncProgress], None] | None = None
+    ) -> tuple[bool, str | None]:
+        if not self._destination_path.is_dir():
+            return (
+                False,
+                f"backup destination {self._destination_path} is not a directory",
+            )
+
+        self._delete_incomplete_snapshots()
+
+        snapshots = list_snapshots(self._destination_path)
+        previous = snapshots[-1] if snapshots else None
+        self._manifest.scan(workers=self._workers * 2)
+        if not previous or self._manifest.label() != previous:
+            # manifest does not describe the previous snapshot (first run, or snapshot
+            # made by another engine)
+            _logger.info(
+                "manifest is not about previous snapshot %s, copying all files",
+                previous,
+            )
+            changed_paths = set(self._manifest.files().keys())
+        else:
+            changed_paths = self._manifest.changed_paths()
+        previous_path = self._destination_path / previous if previous else None
+
+        name = self._new_snapshot_name()
+        snapshot_path = self._destination_path / name
+        in_progress_path = self._destination_path / f"{name}{_IN_PROGRESS_SUFFIX}"
+        _logger.info(
+            "creating snapshot %s: %s files to copy, %s to link to %s",
+            name,
+            len(changed_paths),
+            len(self._manifest.files()) - len(changed_paths),
+            previous,
+        )
+
+        progress = RsyncProgress()
+        self.progress = progress
+        progress.files_total = len(self._manifest.files())
+        progress.bytes_total = sum(
+            self._manifest.files()[path][0] for path in changed_paths
+        )
+        errors = []
+        vanished = []
+
+        def process(source: str):
+            target = in_progress_path / source.lstrip("/")
+            copied = False
+            try:
+                if source in changed_paths or not self._link(
+                    previous_path / source.lstrip("/"), target
+                ):
+                    mode = os.lstat(source).st_mode
+                    if stat.S_ISLNK(mode):
+                        # not with copy2, which fails on links to special files
+                        os.symlink(os.readlink(source), target)
+                        shutil.copystat(source, target, follow_symlinks=False)
+                        copied = True
+                    elif stat.S_ISREG(mode):
+                        shutil.copy2(source, target)
+                        copied = True
+                    else:
+                        _logger.warning("%s is a special file, not backed up", source)
+            except FileNotFoundError as e:
+                if os.path.lexists(source):
+                    self._record_error(errors, source, e)
+                    return
+                # deleted since the scan, not an error (as rsync's exit code 24)
+                _logger.debug("%s vanished, not backed up", source)
+                with self._lock:
+                    vanished.append(source)
+            except OSError as e:
+                self._record_error(errors, source, e)
+                return
+
+            with self._lock:
+                progress.files_done += 1
+                if copied:
+                    progress.current_file = source
+                    progress.bytes_done += self._manifest.files()[source][0]
+                    elapsed_s = time.time() - progress.started_at
+                    if elapsed_s > 0 and progress.bytes_done:
+                        progress.bytes_per_s = progress.bytes_done / elapsed_s
+                        progress.eta_s = (
+                            progress.bytes_total - progress.bytes_done
+                        ) / progress.bytes_per_s
+                if progress_callback:
+                    progress_callback(progress)
+
+        self._make_directories(in_progress_path)
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            for _ in executor.map(process, self._manifest.files().keys()):
+                pass
+
+        if errors:
+            return (
+                False,
+                f"{len(errors)} files could not be backed up to {in_progress_path}. Check the logs",
+            )
+
+        if vanished:
+            _logger.info("%s files vanished while creating the snapshot", len(vanished))
+            self._manifest.forget(vanished)
+
+        try:
+            in_progress_path.rename(snapshot_path)
+        except OSError as e:
+            return False, f"can't rename {in_progress_path} to {snapshot_path}: {e}"
+        self._manifest.commit(label=name)
+        _logger.info("snapshot %s created", snapshot_path)
+
+        self._expire_snapshots()
+
+        return True, None
+
+    def _record_error(self, errors: list[str], source: str, e: OSError):
+        _logger.error("can't back up %s: %s", source, e)
+        with self._lock:
+            errors.append(source)
+
+    def _new_snapshot_name(self) -> str:
+        # names have a precision of one second: waits for the next one when the previous
+        # snapshot was created during the same second
+        while True:
+            name = datetime.today().strftime(SNAPSHOT_NAME_FORMAT)
+            if not (self._destination_path / name).exists():
+                return name
+            time.sleep(1 - time.time() % 1)
+
+    def _make_directories(self, in_progress_path: Path):
+        # every directory, so that empty ones are also part of the snapshot
+        for directory in sorted(self._manifest.directories()):
+            (in_progress_path / directory.lstrip("/")).mkdir(
+                parents=True, exist_ok=True
+            )
+
+    @staticmethod
+    def _link(previous: Path, target: Path) -> bool:
+        try:
+            os.link(previous, target, follow_symlinks=False)
+            return True
+        except OSError as e:
+            # missing in previous snapshot, or hard links not supported: file is copied
+            # instead
+            _logger.debug("can't link %s: %s", previous, e)
+            return False
+
+    def _expire_snapshots(self):
+        if self._expiration_days is None:
+            return
+
+        threshold = datetime.today() - timedelta(days=self._expiration_days)
+        for snapshot in list_snapshots(self._destination_path)[:-1]:
+            if datetime.strptime(snapshot, SNAPSHOT_NAME_FORMAT) >= threshold:
+                break
+            _logger.info("deleting expired snapshot %s...", snapshot)
+            try:
+                shutil.rmtree(self._destination_path / snapshot)
+            except OSError as e:
+                _logger.error("can't delete expired snapshot %s: %s", snapshot, e)
+
+    def _delete_incomplete_snapshots(self):
+        for path in self._destination_path.glob(f"*{_IN_PROGRESS_SUFFIX}"):
+            _logger.info("deleting incomplete snapshot %s...", path)
+            shutil.rmtree(path)
@@ -0,0 +1,285 @@
+import bisect
+import logging
+import os
+import shutil
+import sqlite3
+
+from datetime import datetime
+from pathlib import Path
+
+from phanas.events import format_bytes
+from phanas.snapshot_engine import list_snapshots
+from phanas.tree_index import scan_trees
+
+_DEFAULT_WORKERS = 8
+_FIND_LIMIT = 1000
+
+_logger = logging.getLogger("snapshot_history")
+
+
+class FileVersion:
+    """
+    A version of a file, identical (size and modification time) in a range of
+    consecutive snapshots
+    """
+
+    def __init__(
+        self, path: str, size: int, mtime_ns: int, inode: int, snapshots: list[str]
+    ):
+        self.path: str = path
+        self.size: int = size
+        self.mtime_ns: int = mtime_ns
+        self.inode: int = inode
+        self.snapshots: list[str] = snapshots
+
+    def __str__(self):
+        mtime = datetime.fromtimestamp(self.mtime_ns / 1e9).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+        if len(self.snapshots) == 1:
+            snapshots = self.snapshots[0]
+        else:
+            snapshots = f"{self.snapshots[0]} .. {self.snapshots[-1]} ({len(self.snapshots)} snapshots)"
+        return f"{self.path}  {format_bytes(self.size)}  {mtime}  {snapshots}"
+
+
+class SnapshotHistory:
+    """
+    Local index of the files of the dated snapshots of a backup destination
+    (rsync-time-backup or native engine), to find which snapshots contain a version of a
+    file without walking the backup share.
+
+    A version is stored once for the range of consecutive snapshots it appears unchanged
+    in (with its inode, shared by the hard links of these snapshots), so the index grows
+    with changes rather than with snapshots. update() only scans snapshots created since
+    it last ran, and forgets snapshots which expired.
+    """
+
+    def __init__(
+        self,
+        destination_path: Path,
+        index_file_path: Path,
+        workers: int = _DEFAULT_WORKERS,
+    ):
+        self._destination_path = destination_path
+        self._index_file_path = index_file_path
+        self._workers = workers
+
+    def _connect(self) -> sqlite3.Connection:
+        self._index_file_path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self._index_file_path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS versions (id INTEGER PRIMARY KEY, path TEXT, size INTEGER, mtime_ns INTEGER, "
+            "inode INTEGER, first_snapshot TEXT, last_snapshot TEXT)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS versions_path ON versions (path)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS versions_last_snapshot ON versions (last_snapshot)"
+        )
+        return connection
+
+    def update(self) -> int:
+        """Indexes snapshots created since the last update, returns how many"""
+        snapshots = list_snapshots(self._destination_path)
+        indexed_count = 0
+        with self._connect() as connection:
+            indexed = [
+                row[0]
+                for row in connection.execute(
+                    "SELECT name FROM snapshots ORDER BY name"
+                )
+            ]
+            expired = [s for s in indexed if s not in snapshots]
+            if expired:
+                self._forget(connection, expired)
+                indexed = [s for s in indexed if s not in expired]
+
+            last = indexed[-1] if indexed else None
+            for snapshot in snapshots:
+                if last and snapshot <= last:
+                    if snapshot not in indexed:
+                        _logger.info(
+                            "snapshot %s is older than the indexed ones, not indexed",
+                            snapshot,
+                        )
+                    continue
+                self._index(connection, snapshot, last)
+                connection.commit()
+                last = snapshot
+                indexed_count += 1
+        connection.close()
+        return indexed_count
+
+    def _index(
+        self, connection: sqlite3.Connection, snapshot: str, previous: str | None
+    ):
+        snapshot_path = self._destination_path / snapshot
+        files = scan_trees([snapshot_path], workers=self._workers)
+        open_versions = {}
+        if previous:
+            open_versions = {
+                path: (version_id, size, mtime_ns)
+                for version_id, path, size, mtime_ns in connection.execute(
+                    "SELECT id, path, size, mtime_ns FROM versions WHERE last_snapshot = ?",
+                    (previous,),
+                )
+            }
+
+        extended = []
+        added = []
+        for path, (size, mtime_ns, inode) in files.items():
+            relative_path = os.path.relpath(path, snapshot_path)
+            version_id, *version_stat = open_versions.get(
+                relative_path, (None, None, None)
+            )
+            if version_id is not None and version_stat == [size, mtime_ns]:
+                extended.append((snapshot, version_id))
+            else:
+                added.append((relative_path, size, mtime_ns, inode, snapshot, snapshot))
+
+        connection.executemany(
+            "UPDATE versions SET last_snapshot = ? WHERE id = ?", extended
+        )
+        connection.executemany(
+            "INSERT INTO versions (path, size, mtime_ns, inode, first_snapshot, last_snapshot) VALUES (?, ?, ?, ?, ?, ?)",
+            added,
+        )
+        connection.execute("INSERT INTO snapshots (name) VALUES (?)", (snapshot,))
+        _logger.info(
+            "snapshot %s indexed: %s files, %s new versions",
+            snapshot,
+            len(files),
+            len(added),
+        )
+
+    @staticmethod
+    def _forget(connection: sqlite3.Connection, expired: list[str]):
+        connection.executemany(
+            "DELETE FROM snapshots WHERE name = ?", ((s,) for s in expired)
+        )
+        connection.execute(
+            "DELETE FROM versions WHERE NOT EXISTS "
+            "(SELECT 1 FROM snapshots WHERE name BETWEEN versions.first_snapshot AND versions.last_snapshot)"
+        )
+        _logger.info("%s expired snapshots removed from index", len(expired))
+
+    def find(self, pattern: str, limit: int = _FIND_LIMIT) -> list[FileVersion]:
+        """
+        Versions of files whose path matches pattern, a glob pattern on the path
+        relative to the snapshot, or part of the path when it has no wildcard
+        """
+        if not any(c in pattern for c in "*?["):
+            pattern = f"*{pattern}*"
+        return self._versions("path GLOB ?", (pattern,), limit)
+
+    def versions(self, path: str) -> list[FileVersion]:
+        """
+        Versions of the file, or of files under the directory, at path relative to the
+        snapshot
+        """
+        path = path.strip("/")
+        return self._versions("path = ? OR path GLOB ?", (path, f"{path}/*"), None)
+
+    def _versions(
+        self, where: str, parameters: tuple, limit: int | None
+    ) -> list[FileVersion]:
+        with self._connect() as connection:
+            snapshots = [
+                row[0]
+                for row in connection.execute(
+                    "SELECT name FROM snapshots ORDER BY name"
+                )
+            ]
+            query = (
+                f"SELECT path, size, mtime_ns, inode, first_snapshot, last_snapshot FROM versions WHERE {where} "
+                "ORDER BY path, first_snapshot"
+            )
+            if limit:
+                query += f" LIMIT {int(limit)}"
+            rows = connection.execute(query, parameters).fetchall()
+        connection.close()
+
+        versions = []
+        for path, size, mtime_ns, inode, first, last in rows:
+            in_range = snapshots[
+                bisect.bisect_left(snapshots, first) : bisect.bisect_right(
+                    snapshots, last
+                )
+            ]
+            if in_range:
+                versions.append(FileVersion(path, size, mtime_ns, inode, in_range))
+        return versions
+
+    def restore(
+        self, path: str, target_path: Path, snapshot: str | None = None
+    ) -> tuple[bool, str | None]:
+        """
+        Copies the file or directory at path relative to the snapshot to target_path,
+        from the given snapshot or the latest snapshot containing it
+        """
+        path = path.strip("/")
+        versions = self.versions(path)
+        if snapshot:
+            versions = [v for v in versions if snapshot in v.snapshots]
+        if not versions:
+            return False, f"{path} not found in backup snapshots" + (
+                f" {snapshot}" if snapshot else ""
+            )
+        snapshot = snapshot or max(v.snapshots[-1] for v in versions)
+
+        source_path = self._destination_path / snapshot / path
+        if target_path.exists():
+            return False, f"{target_path} already exists"
+        try:
+            if source_path.is_dir():
+                shutil.copytree(source_path, target_path, symlinks=True)
+            else:
+                target_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(source_path, target_path, follow_symlinks=False)
+        except OSError as e:
+            return False, f"can't restore {source_path}: {e}"
+
+        return True, f"{path} restored from snapshot {snapshot} to {target_path}"
+
+
+def find(config, pattern: str):
+    import phanas.backup
+
+    for backup in phanas.backup.backups(config):
+        history = backup.snapshot_history()
+        if not history:
+            continue
+        versions = history.find(pattern)
+        if not versions:
+            print(f"{backup.display_name()}: no file matching {pattern}")
+        for version in versions:
+            print(f"{backup.name()}: {version}")
+        if len(versions) >= _FIND_LIMIT:
+            print(
+                f"{backup.display_name()}: only the first {_FIND_LIMIT} versions are listed"
+            )
+
+
+def restore(config, path: str, snapshot: str | None, restore_to: str | None):
+    import phanas.backup
+
+    logger = logging.getLogger("snapshot_history")
+    target_path = (
+        Path(restore_to) if restore_to else Path.cwd() / Path(path.rstrip("/")).name
+    )
+    for backup in phanas.backup.backups(config):
+        history = backup.snapshot_history()
+        if not history:
+            continue
+        status, msg = history.restore(path, target_path, snapshot)
+        if status:
+            logger.info(msg)
+            return
+        logger.info("%s: %s", backup.display_name(), msg)
+
+    logger.error("%s could not be restored", path)
@@ -0,0 +1,249 @@
+import fnmatch
+import json
+import logging
+import os
+import sqlite3
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from phanas.events import format_bytes
+
+_DEFAULT_SCAN_WORKERS = 8
+
+_logger = logging.getLogger("tree_index")
+
+# size, mtime_ns, inode
+FileStat = tuple[int, int, int]
+
+
+def scan_trees(
+    root_paths: list[Path],
+    workers: int = _DEFAULT_SCAN_WORKERS,
+    excludes: list[str] | None = None,
+    directories: set[str] | None = None,
+) -> dict[str, FileStat]:
+    """
+    Walks directory trees with a pool of threads, each listing one directory at a time
+    with os.scandir, which saves a stat call per entry and releases the GIL during
+    system calls. Symbolic links are not followed. Entries whose name matches one of the
+    excludes patterns are ignored. The paths of the directories walked are added to
+    directories, when given.
+    """
+    excludes = excludes or []
+    entries: dict[str, FileStat] = {}
+
+    def scan_dir(dir_path: str) -> tuple[dict[str, FileStat], list[str]]:
+        files = {}
+        sub_dirs = []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if any(
+                        fnmatch.fnmatch(entry.name, pattern) for pattern in excludes
+                    ):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_dirs.append(entry.path)
+                    else:
+                        stats = entry.stat(follow_symlinks=False)
+                        files[entry.path] = (
+                            stats.st_size,
+                            stats.st_mtime_ns,
+                            stats.st_ino,
+                        )
+        except OSError as e:
+            # unreadable directory or entry deleted while scanning
+            _logger.debug("can't scan %s: %s", dir_path, e)
+        return files, sub_dirs
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(scan_dir, str(root_path)) for root_path in root_paths
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, sub_dirs = future.result()
+                entries.update(files)
+                if directories is not None:
+                    directories.update(sub_dirs)
+                pending |= {executor.submit(scan_dir, sub_dir) for sub_dir in sub_dirs}
+
+    return entries
+
+
+class ChangeSummary:
+    def __init__(self):
+        self.added_count: int = 0
+        self.changed_count: int = 0
+        self.removed_count: int = 0
+        self.changed_bytes: int = 0
+        self.total_count: int = 0
+        self.total_bytes: int = 0
+
+    def changed_files(self) -> int:
+        return self.added_count + self.changed_count + self.removed_count
+
+    def __str__(self):
+        if not self.changed_files():
+            return "no change"
+        return (
+            f"{self.added_count} added, {self.changed_count} changed, {self.removed_count} removed "
+            f"({format_bytes(self.changed_bytes)})"
+        )
+
+
+class TreeIndex:
+    """
+    Persistent index of the files of one or more directory trees, used to detect changes
+    since the index was last committed.
+
+    scan() computes the changes between the trees on disk and the index. commit()
+    applies these changes to the index, typically once they have been taken care of (eg.
+    backed up), so that changes accumulate until then.
+    """
+
+    def __init__(
+        self,
+        index_file_path: Path,
+        root_paths: list[Path],
+        excludes: list[str] | None = None,
+    ):
+        self._index_file_path = index_file_path
+        self._root_paths = root_paths
+        self._excludes = excludes or []
+        self._has_baseline: bool = False
+        self._label: str | None = None
+        self._current: dict[str, FileStat] = {}
+        self._directories: set[str] = set()
+        self._upserts: dict[str, FileStat] = {}
+        self._deletes: list[str] = []
+
+    def _connect(self) -> sqlite3.Connection:
+        self._index_file_path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self._index_file_path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER) WITHOUT ROWID"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        return connection
+
+    def _configuration(self) -> str:
+        return json.dumps(
+            {"roots": [str(p) for p in self._root_paths], "excludes": self._excludes}
+        )
+
+    def has_baseline(self) -> bool:
+        return self._has_baseline
+
+    def label(self) -> str | None:
+        """Label given to the index when it was last committed"""
+        return self._label
+
+    def files(self) -> dict[str, FileStat]:
+        """Files found by the last scan"""
+        return self._current
+
+    def directories(self) -> set[str]:
+        """Directories found by the last scan, including the roots"""
+        return self._directories
+
+    def changed_paths(self) -> set[str]:
+        """
+        Files added or changed since the index was last committed, as of the last scan
+        """
+        return set(self._upserts.keys())
+
+    def forget(self, paths: list[str]):
+        """
+        Files of the last scan not taken care of (eg. deleted since): they are removed
+        from the index on commit
+        """
+        for path in paths:
+            self._current.pop(path, None)
+            self._upserts.pop(path, None)
+        self._deletes.extend(paths)
+
+    def scan(self, workers: int = _DEFAULT_SCAN_WORKERS) -> ChangeSummary:
+        directories = {str(p) for p in self._root_paths}
+        current = scan_trees(
+            self._root_paths,
+            workers=workers,
+            excludes=self._excludes,
+            directories=directories,
+        )
+        self._current = current
+        self._directories = directories
+
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT value FROM meta WHERE key = 'configuration'"
+            ).fetchone()
+            self._has_baseline = row is not None and row[0] == self._configuration()
+            row = connection.execute(
+                "SELECT value FROM meta WHERE key = 'label'"
+            ).fetchone()
+            self._label = row[0] if row and self._has_baseline else None
+            indexed = {}
+            if self._has_baseline:
+                indexed = {
+                    path: (size, mtime_ns, inode)
+                    for path, size, mtime_ns, inode in connection.execute(
+                        "SELECT path, size, mtime_ns, inode FROM files"
+                    )
+                }
+        connection.close()
+
+        summary = ChangeSummary()
+        self._upserts = {}
+        for path, file_stat in current.items():
+            summary.total_count += 1
+            summary.total_bytes += file_stat[0]
+            indexed_stat = indexed.pop(path, None)
+            if indexed_stat == file_stat:
+                continue
+            if indexed_stat is None:
+                summary.added_count += 1
+            else:
+                summary.changed_count += 1
+            summary.changed_bytes += file_stat[0]
+            self._upserts[path] = file_stat
+        self._deletes = list(indexed.keys())
+        summary.removed_count = len(self._deletes)
+
+        _logger.info(
+            "%s files (%s) scanned: %s",
+            summary.total_count,
+            format_bytes(summary.total_bytes),
+            summary,
+        )
+        return summary
+
+    def commit(self, label: str | None = None):
+        with self._connect() as connection:
+            if not self._has_baseline:
+                connection.execute("DELETE FROM files")
+            connection.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)",
+                ((path, *file_stat) for path, file_stat in self._upserts.items()),
+            )
+            connection.executemany(
+                "DELETE FROM files WHERE path = ?", ((path,) for path in self._deletes)
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('configuration', ?)",
+                (self._configuration(),),
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('label', ?)", (label,)
+            )
+        connection.close()
+        _logger.info("index %s updated", self._index_file_path)
+
+        self._has_baseline = True
+        self._label = label
+        self._upserts = {}
+        self._deletes = []
@@ -22,6 +22,11 @@ def main():
         help="generate sudoers commands for current linux and nas user",
         action="store_true",
     )
+    parser.add_argument(
+        "--keepass-watch",
+        help="synchronize keyfiles in the background as they change",
+        action="store_true",
+    )
     parser.add_argument(
         "-k", "--keepass-sync", help="run keepass synchronization", action="store_true"
     )
@@ -31,13 +36,48 @@ def main():
     parser.add_argument(
         "-n", "--nascopy", help="call NAS copy script", action="store_true"
     )
+    parser.add_argument(
+        "--backup-scheduler",
+        help="run backups in the background when the session is idle and backup is due",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify-backup",
+        help="verify latest backup snapshot against its checksum index and sources",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--backup-find",
+        metavar="PATTERN",
+        help="list versions of backed up files matching PATTERN, and the snapshots containing them",
+    )
+    parser.add_argument(
+        "--backup-restore",
+        metavar="PATH",
+        help="restore a file or directory (path as listed by --backup-find) from the latest snapshot containing it",
+    )
+    parser.add_argument(
+        "--snapshot", help="snapshot to restore from (with --backup-restore)"
+    )
+    parser.add_argument(
+        "--restore-to",
+        metavar="PATH",
+        help="where to restore (with --backup-restore), defaults to the current directory",
+    )
     parser.add_argument("-ng", "--no-gui", help="do not use a GUI", action="store_true")
     parser.add_argument(
         "-m", "--automount", help="mount NAS drives (Linux only)", action="store_true"
     )
+    parser.add_argument(
+        "-s", "--status", help="print status of the latest runs", action="store_true"
+    )
+    parser.add_argument(
+        "--json", help="print status as JSON (with --status)", action="store_true"
+    )
     args = parser.parse_args()
 
     config = phanas.file_utils.read_config_file()
+    phanas.logging.configure_json_lines(config)
     if args.generate_sudoers:
         import phanas.sudoers as sudoers
 
@@ -50,6 +90,28 @@ def main():
         import phanas.backup as backup
 
         backup.run(config)
+    elif args.backup_scheduler:
+        import phanas.backup_scheduler as backup_scheduler
+
+        backup_scheduler.run(config)
+    elif args.keepass_watch:
+        import phanas.keyfile_watcher as keyfile_watcher
+
+        keyfile_watcher.run(config)
+    elif args.verify_backup:
+        import phanas.backup_verify as backup_verify
+
+        backup_verify.run(config)
+    elif args.backup_find:
+        import phanas.snapshot_history as snapshot_history
+
+        snapshot_history.find(config, args.backup_find)
+    elif args.backup_restore:
+        import phanas.snapshot_history as snapshot_history
+
+        snapshot_history.restore(
+            config, args.backup_restore, args.snapshot, args.restore_to
+        )
     elif args.nascopy:
         import phanas.nascopy as nascopy
 
@@ -58,6 +120,10 @@ def main():
         from phanas.automount import AutoMount
 
         AutoMount().run()
+    elif args.status:
+        import phanas.metrics as metrics
+
+        metrics.print_status(config, as_json=args.json)
     elif args.no_gui:
         from phanas.phanas_desktop import PhanasDesktop, Output, PROGRAM_NAME
         import logging
@@ -0,0 +1,6 @@
+import sys
+
+from pathlib import Path
+
+# tests import the phanas package from the root of the repository
+sys.path.insert(1, str(Path(__file__).resolve().parents[1]))
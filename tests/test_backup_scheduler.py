@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from phanas.backup_scheduler import BackupScheduler
+from phanas.tree_index import ChangeSummary
+
+_GIB = 1024 * 1024 * 1024
+
+
+class _Conditions:
+    def __init__(
+        self,
+        idle_s: float | None = 3600,
+        on_ac_power: bool | None = True,
+        metered: bool | None = False,
+    ):
+        self._idle_s = idle_s
+        self._on_ac_power = on_ac_power
+        self._metered = metered
+
+    def idle_seconds(self) -> float | None:
+        return self._idle_s
+
+    def on_ac_power(self) -> bool | None:
+        return self._on_ac_power
+
+    def is_metered(self) -> bool | None:
+        return self._metered
+
+
+def _changes(changed_bytes: int, changed_count: int = 1) -> ChangeSummary:
+    changes = ChangeSummary()
+    changes.changed_count = changed_count
+    changes.changed_bytes = changed_bytes
+    return changes
+
+
+def _ago(**kwargs) -> datetime:
+    return datetime.now() - timedelta(**kwargs)
+
+
+@pytest.mark.parametrize(
+    "changes, interval",
+    [
+        (None, timedelta(days=4)),
+        (_changes(0, changed_count=0), timedelta(days=14)),
+        (_changes(_GIB), timedelta(days=4)),
+        (_changes(4 * _GIB), timedelta(days=2)),
+        (_changes(_GIB // 4), timedelta(days=8)),
+        (_changes(10000 * _GIB), timedelta(hours=12)),
+        (_changes(1), timedelta(days=14)),
+    ],
+)
+def test_interval_depends_on_changed_bytes(changes, interval: timedelta):
+    assert BackupScheduler({}, _Conditions()).interval(changes) == interval
+
+
+def test_decide_without_previous_backup():
+    scheduler = BackupScheduler({}, _Conditions(idle_s=0))
+
+    assert scheduler.decide(None, None) == (True, "no previous backup")
+
+
+def test_decide_not_due():
+    status, reason = BackupScheduler({}, _Conditions()).decide(
+        _ago(days=3), _changes(_GIB)
+    )
+
+    assert not status
+    assert reason.startswith("0 added, 1 changed, 0 removed (1.0 GB), next backup due")
+
+
+def test_decide_due_sooner_when_a_lot_changed():
+    scheduler = BackupScheduler({}, _Conditions())
+
+    assert scheduler.decide(_ago(days=3), _changes(4 * _GIB)) == (True, "backup due")
+
+
+@pytest.mark.parametrize(
+    "conditions, schedule_config, reason",
+    [
+        (_Conditions(idle_s=60), {}, "waiting for the session to be idle"),
+        (_Conditions(on_ac_power=False), {}, "waiting for AC power"),
+        (_Conditions(metered=True), {}, "waiting for a non metered network"),
+        (_Conditions(on_ac_power=False), {"require_ac_power": False}, None),
+        (_Conditions(metered=True), {"allow_metered": True}, None),
+        (_Conditions(idle_s=None, on_ac_power=None, metered=None), {}, None),
+    ],
+)
+def test_decide_due_waits_for_conditions(
+    conditions: _Conditions, schedule_config: dict, reason: str | None
+):
+    scheduler = BackupScheduler(schedule_config, conditions)
+
+    status, msg = scheduler.decide(_ago(days=5), None)
+
+    if reason:
+        assert (status, msg) == (False, f"backup due, {reason}")
+    else:
+        assert (status, msg) == (True, "backup due")
+
+
+def test_decide_runs_regardless_of_conditions_when_too_old():
+    scheduler = BackupScheduler({}, _Conditions(idle_s=0, on_ac_power=False))
+
+    assert scheduler.decide(_ago(days=15), _changes(0, changed_count=0)) == (
+        True,
+        "last backup older than 14 days",
+    )
+
+
+def test_may_run():
+    scheduler = BackupScheduler({}, _Conditions(idle_s=0))
+
+    assert scheduler.may_run(None) == (True, None)
+    assert scheduler.may_run(_ago(days=15)) == (True, None)
+    assert not scheduler.may_run(_ago(hours=1))[0]
+    assert scheduler.may_run(_ago(days=1)) == (
+        False,
+        "waiting for the session to be idle",
+    )
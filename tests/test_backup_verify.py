@@ -0,0 +1,131 @@
+import os
+import shutil
+
+from pathlib import Path
+
+import pytest
+
+from phanas.backup_verify import BackupVerifier
+
+
+@pytest.fixture
+def source(tmp_path: Path) -> Path:
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "a.txt").write_text("a")
+    (source / "b.txt").write_text("b")
+    (source / "link").symlink_to("a.txt")
+    return source
+
+
+def _snapshot(tmp_path: Path, source: Path, name: str, previous: str | None = None):
+    """Snapshot of source in the layout of rsync-time-backup, hard linked to previous"""
+    snapshot_path = tmp_path / "destination" / name
+    snapshot_path.mkdir(parents=True)
+    for path in source.iterdir():
+        if path.is_symlink():
+            (snapshot_path / path.name).symlink_to(os.readlink(path))
+        elif previous:
+            os.link(
+                tmp_path / "destination" / previous / path.name,
+                snapshot_path / path.name,
+            )
+        else:
+            shutil.copy2(path, snapshot_path / path.name)
+    return snapshot_path
+
+
+def _verifier(tmp_path: Path, source: Path) -> BackupVerifier:
+    return BackupVerifier(
+        tmp_path / "destination",
+        tmp_path / "checksums.sqlite",
+        source_root=source,
+        native_layout=False,
+    )
+
+
+def _corrupt(file_path: Path, content: str):
+    """Changes the content of file_path, keeping its size and modification time"""
+    file_stat = file_path.stat()
+    file_path.write_text(content)
+    os.utime(file_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+
+
+def test_verifies_new_files_then_samples_verified_ones(tmp_path: Path, source: Path):
+    _snapshot(tmp_path, source, "2024-01-01-000000")
+
+    verifier = _verifier(tmp_path, source)
+    assert verifier.verify() == (True, None)
+    assert verifier.verified_count == 2
+
+    verifier = _verifier(tmp_path, source)
+    assert verifier.verify() == (True, None)
+    assert verifier.verified_count == 2
+
+
+def test_file_differing_from_unchanged_source_is_corrupted(
+    tmp_path: Path, source: Path
+):
+    snapshot_path = _snapshot(tmp_path, source, "2024-01-01-000000")
+    _corrupt(snapshot_path / "a.txt", "x")
+    (snapshot_path / "link").unlink()
+    (snapshot_path / "link").symlink_to("b.txt")
+    os.utime(
+        snapshot_path / "link",
+        ns=(0, (source / "link").lstat().st_mtime_ns),
+        follow_symlinks=False,
+    )
+
+    verifier = _verifier(tmp_path, source)
+    status, msg = verifier.verify()
+
+    assert not status
+    assert msg == "2 corrupted files in backup snapshot 2024-01-01-000000"
+    assert sorted(c.reason for c in verifier.corruptions) == [
+        f"content differs from {source / 'a.txt'}",
+        f"link target differs from {source / 'link'}",
+    ]
+
+
+def test_changed_source_is_not_compared(tmp_path: Path, source: Path):
+    _snapshot(tmp_path, source, "2024-01-01-000000")
+    (source / "a.txt").write_text("changed since the backup")
+
+    assert _verifier(tmp_path, source).verify() == (True, None)
+
+
+def test_silent_corruption_of_verified_file_is_detected(tmp_path: Path, source: Path):
+    snapshot_path = _snapshot(tmp_path, source, "2024-01-01-000000")
+    _verifier(tmp_path, source).verify()
+    _corrupt(snapshot_path / "b.txt", "x")
+
+    verifier = _verifier(tmp_path, source)
+    assert not verifier.verify()[0]
+
+    assert [(c.path, c.reason) for c in verifier.corruptions] == [
+        (snapshot_path / "b.txt", "content changed since last verification")
+    ]
+
+
+def test_files_of_expired_snapshot_are_sampled_in_latest_one(
+    tmp_path: Path, source: Path
+):
+    _snapshot(tmp_path, source, "2024-01-01-000000")
+    _verifier(tmp_path, source).verify()
+    snapshot_path = _snapshot(
+        tmp_path, source, "2024-01-02-000000", "2024-01-01-000000"
+    )
+    shutil.rmtree(tmp_path / "destination" / "2024-01-01-000000")
+    _corrupt(snapshot_path / "a.txt", "x")
+
+    verifier = _verifier(tmp_path, source)
+    assert not verifier.verify()[0]
+
+    assert [c.path for c in verifier.corruptions] == [snapshot_path / "a.txt"]
+
+
+def test_no_snapshot(tmp_path: Path, source: Path):
+    assert _verifier(tmp_path, source).verify() == (
+        False,
+        f"no backup snapshot found in {tmp_path / 'destination'}",
+    )
@@ -0,0 +1,122 @@
+import pytest
+
+from phanas.events import (
+    CoalescingSink,
+    EventBus,
+    EventSink,
+    ItemProgress,
+    Message,
+    PhaseEnded,
+    format_bytes,
+)
+
+
+class _ListSink(EventSink):
+    def __init__(self):
+        self.events = []
+        self.flushed = 0
+
+    def handle(self, event):
+        self.events.append(event)
+
+    def flush(self):
+        self.flushed += 1
+
+
+class _FailingSink(EventSink):
+    def handle(self, event):
+        raise RuntimeError("failing sink")
+
+
+def _progress(phase: str, done_count: int) -> ItemProgress:
+    return ItemProgress(phase, f"file {done_count}", done_count, total_count=10)
+
+
+def test_coalescing_sink_keeps_most_recent_progress_until_next_event():
+    sink = _ListSink()
+    coalescing_sink = CoalescingSink(sink, min_interval_s=3600)
+
+    for done_count in range(1, 5):
+        coalescing_sink.handle(_progress("backup", done_count))
+    assert [e.done_count for e in sink.events] == [1]
+
+    coalescing_sink.handle(PhaseEnded("backup", True))
+    assert [type(e).__name__ for e in sink.events] == [
+        "ItemProgress",
+        "ItemProgress",
+        "PhaseEnded",
+    ]
+    assert sink.events[1].done_count == 4
+
+
+def test_coalescing_sink_throttles_each_phase_separately():
+    sink = _ListSink()
+    coalescing_sink = CoalescingSink(sink, min_interval_s=3600)
+
+    coalescing_sink.handle(_progress("backup", 1))
+    coalescing_sink.handle(_progress("nascopy", 1))
+    coalescing_sink.handle(_progress("backup", 2))
+    coalescing_sink.handle(_progress("nascopy", 2))
+    coalescing_sink.flush()
+
+    assert [(e.phase, e.done_count) for e in sink.events] == [
+        ("backup", 1),
+        ("nascopy", 1),
+        ("backup", 2),
+        ("nascopy", 2),
+    ]
+    assert sink.flushed == 1
+
+
+def test_coalescing_sink_forwards_all_progress_without_interval():
+    sink = _ListSink()
+    coalescing_sink = CoalescingSink(sink, min_interval_s=0)
+
+    for done_count in range(1, 5):
+        coalescing_sink.handle(_progress("backup", done_count))
+
+    assert [e.done_count for e in sink.events] == [1, 2, 3, 4]
+
+
+def test_event_bus_isolates_failing_sink():
+    sink = _ListSink()
+    bus = EventBus([_FailingSink()])
+    bus.add_sink(sink)
+
+    bus.emit(Message("backup", "started"))
+
+    assert [e.msg for e in sink.events] == ["started"]
+
+
+@pytest.mark.parametrize(
+    "progress, fraction, description",
+    [
+        (ItemProgress("backup", None, 3), None, "3"),
+        (ItemProgress("backup", "a.jpg", 3, total_count=4), 0.75, "3/4 a.jpg"),
+        (
+            ItemProgress(
+                "backup",
+                None,
+                3,
+                total_count=4,
+                done_bytes=1024,
+                total_bytes=4096,
+                bytes_per_s=2 * 1024 * 1024,
+                eta_s=3725,
+            ),
+            0.25,
+            "3/4 (1.0 KB), 2.0 MB/s, ETA 1:02:05",
+        ),
+    ],
+)
+def test_item_progress(progress: ItemProgress, fraction, description: str):
+    assert progress.fraction() == fraction
+    assert progress.describe() == description
+
+
+@pytest.mark.parametrize(
+    "size, text",
+    [(0, "0 B"), (1023, "1023 B"), (1536, "1.5 KB"), (5 * 1024**5, "5120.0 TB")],
+)
+def test_format_bytes(size: int, text: str):
+    assert format_bytes(size) == text
@@ -0,0 +1,133 @@
+import errno
+import os
+
+from pathlib import Path
+
+import pytest
+
+import phanas.file_utils
+import phanas.hash_cache
+from phanas.file_utils import compare_files, compute_hash
+from phanas.hash_cache import HashCache
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    """Files of a few bytes span several blocks"""
+    monkeypatch.setattr(phanas.file_utils, "_COMPARE_BLOCK_SIZE", 4)
+
+
+def _file(tmp_path: Path, name: str, content: bytes) -> Path:
+    file_path = tmp_path / name
+    file_path.write_bytes(content)
+    return file_path
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+@pytest.mark.parametrize(
+    "content_1, content_2, same",
+    [
+        (b"", b"", True),
+        (b"0123456789", b"0123456789", True),
+        (b"0123456789", b"0123456780", False),
+        (b"x123456789", b"0123456789", False),
+    ],
+)
+def test_compare_blocks(
+    tmp_path: Path,
+    small_blocks,
+    concurrent: bool,
+    content_1: bytes,
+    content_2: bytes,
+    same: bool,
+):
+    file_1_path = _file(tmp_path, "1", content_1)
+    file_2_path = _file(tmp_path, "2", content_2)
+
+    assert (
+        phanas.file_utils._compare_blocks(
+            file_1_path, file_2_path, concurrent, (None, None)
+        )
+        == same
+    )
+    assert compare_files(file_1_path, file_2_path) == same
+
+
+def test_compare_files_from_metadata(tmp_path: Path, monkeypatch):
+    file_path = _file(tmp_path, "1", b"content")
+    os.link(file_path, tmp_path / "link")
+    longer_file_path = _file(tmp_path, "2", b"longer content")
+    monkeypatch.setattr(phanas.file_utils, "_compare_blocks", None)
+
+    assert compare_files(file_path, tmp_path / "link")
+    assert not compare_files(file_path, longer_file_path)
+
+
+def test_compare_files_caches_hashes_of_same_files(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(phanas.hash_cache, "_MIN_AGE_S", 0)
+    hash_cache = HashCache(tmp_path / "hash_cache.sqlite")
+    file_1_path = _file(tmp_path, "1", b"content")
+    file_2_path = _file(tmp_path, "2", b"content")
+    file_3_path = _file(tmp_path, "3", b"CONTENT")
+
+    assert compare_files(file_1_path, file_2_path, hash_cache=hash_cache)
+    sha256 = compute_hash(file_1_path)
+    for file_path in (file_1_path, file_2_path):
+        assert hash_cache.lookup(file_path, os.stat(file_path)) == sha256
+
+    # hash of file 1 cached: only file 3 is read, and its hash cached
+    monkeypatch.setattr(phanas.file_utils, "_compare_blocks", None)
+    assert not compare_files(file_1_path, file_3_path, hash_cache=hash_cache)
+    assert hash_cache.lookup(file_3_path, os.stat(file_3_path)) == compute_hash(
+        file_3_path
+    )
+
+    # hashes of both files cached: neither is read
+    monkeypatch.setattr(phanas.file_utils, "compute_hash", None)
+    assert compare_files(file_1_path, file_2_path, hash_cache=hash_cache)
+
+
+def test_copy_file_on_same_filesystem(tmp_path: Path):
+    source_path = _file(tmp_path, "source", b"content" * 1000)
+    target_path = _file(tmp_path, "target", b"previous longer content" * 1000)
+
+    method = phanas.file_utils.copy_file(source_path, target_path)
+
+    assert method in (
+        phanas.file_utils.COPY_METHOD_REFLINK,
+        phanas.file_utils.COPY_METHOD_COPY_FILE_RANGE,
+    )
+    assert target_path.read_bytes() == source_path.read_bytes()
+
+
+def test_copy_file_streamed_when_copy_file_range_unsupported(
+    tmp_path: Path, monkeypatch
+):
+    def copy_file_range(source, target, count, offset_src, offset_dst):
+        # partial copy, then failure such as between filesystems
+        if offset_src:
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        return os.pwrite(target, b"partial copy", offset_dst)
+
+    monkeypatch.setattr(phanas.file_utils, "_reflink", lambda source, target: False)
+    monkeypatch.setattr(os, "copy_file_range", copy_file_range)
+    source_path = _file(tmp_path, "source", b"content")
+    target_path = tmp_path / "target"
+
+    method = phanas.file_utils.copy_file(source_path, target_path)
+
+    assert method == phanas.file_utils.COPY_METHOD_STREAM
+    assert target_path.read_bytes() == b"content"
+
+
+def test_copy_file_range_error_is_raised(tmp_path: Path, monkeypatch):
+    def copy_file_range(source, target, count, offset_src, offset_dst):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(phanas.file_utils, "_reflink", lambda source, target: False)
+    monkeypatch.setattr(os, "copy_file_range", copy_file_range)
+
+    with pytest.raises(OSError):
+        phanas.file_utils.copy_file(
+            _file(tmp_path, "source", b"content"), tmp_path / "target"
+        )
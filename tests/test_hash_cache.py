@@ -0,0 +1,78 @@
+from pathlib import Path
+
+import pytest
+
+import phanas.hash_cache
+from phanas.file_utils import compute_hash
+from phanas.hash_cache import HashCache
+
+
+class _CountingHash:
+    def __init__(self):
+        self.paths = []
+
+    def __call__(self, file_path: Path) -> str:
+        self.paths.append(file_path)
+        return compute_hash(file_path)
+
+
+@pytest.fixture
+def no_min_age(monkeypatch):
+    """Files just written are old enough to be cached"""
+    monkeypatch.setattr(phanas.hash_cache, "_MIN_AGE_S", 0)
+
+
+def _file(tmp_path: Path, name: str, content: str) -> Path:
+    file_path = tmp_path / name
+    file_path.write_text(content)
+    return file_path
+
+
+def test_hash_is_computed_once_while_file_unchanged(tmp_path: Path, no_min_age):
+    index_file_path = tmp_path / "index" / "hash_cache.sqlite"
+    cache = HashCache(index_file_path)
+    file_path = _file(tmp_path, "a.txt", "a")
+    compute = _CountingHash()
+
+    sha256 = cache.get_hash(file_path, compute)
+    assert HashCache(index_file_path).get_hash(file_path, compute) == sha256
+    assert len(compute.paths) == 1
+
+    file_path.write_text("b")
+    assert cache.get_hash(file_path, compute) == compute_hash(file_path)
+    assert len(compute.paths) == 2
+
+
+def test_recently_modified_file_is_not_cached(tmp_path: Path):
+    cache = HashCache(tmp_path / "hash_cache.sqlite")
+    file_path = _file(tmp_path, "a.txt", "a")
+    compute = _CountingHash()
+
+    cache.get_hash(file_path, compute)
+    cache.get_hash(file_path, compute)
+
+    assert len(compute.paths) == 2
+
+
+def test_least_recently_used_hashes_are_evicted(tmp_path: Path, no_min_age):
+    cache = HashCache(tmp_path / "hash_cache.sqlite", max_entries=2)
+    file_paths = [_file(tmp_path, f"{name}.txt", name) for name in "abc"]
+    compute = _CountingHash()
+
+    for file_path in file_paths:
+        cache.get_hash(file_path, compute)
+    cache.get_hash(file_paths[1], compute)
+    cache.get_hash(file_paths[2], compute)
+    assert compute.paths == file_paths
+
+    cache.get_hash(file_paths[0], compute)
+    assert compute.paths == [*file_paths, file_paths[0]]
+
+
+def test_unreadable_cache_is_not_an_error(tmp_path: Path, no_min_age):
+    index_file_path = _file(tmp_path, "hash_cache.sqlite", "not a database")
+    file_path = _file(tmp_path, "a.txt", "a")
+
+    assert HashCache(index_file_path).get_hash(file_path, compute_hash) == compute_hash(
+        file_path
+    )
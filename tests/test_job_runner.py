@@ -0,0 +1,122 @@
+import contextvars
+import threading
+import time
+
+from collections import Counter
+
+import pytest
+
+from phanas.job_runner import Job, JobRunner, job_runner
+
+_phase = contextvars.ContextVar("phase", default=None)
+
+
+class _Recorder:
+    """Jobs recording how many run at once, overall and per target"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = Counter()
+        self.max_running = 0
+        self.max_running_per_target = Counter()
+        self.started = []
+
+    def job(self, name: str, target: str) -> Job:
+        def run() -> tuple[bool, str | None]:
+            with self._lock:
+                self.started.append(name)
+                self._running[target] += 1
+                self.max_running = max(self.max_running, self._running.total())
+                self.max_running_per_target[target] = max(
+                    self.max_running_per_target[target], self._running[target]
+                )
+            time.sleep(0.05)
+            with self._lock:
+                self._running[target] -= 1
+            return True, f"{name} done"
+
+        return Job(name, target, run)
+
+
+@pytest.mark.parametrize(
+    "max_parallel, max_per_target, max_running, max_running_on_nas",
+    [(1, 1, 1, 1), (2, 1, 2, 1), (3, 2, 3, 2), (4, 4, 4, 3)],
+)
+def test_jobs_run_within_limits(
+    max_parallel: int, max_per_target: int, max_running: int, max_running_on_nas: int
+):
+    recorder = _Recorder()
+    jobs = [
+        recorder.job("home", "nas"),
+        recorder.job("photos", "nas"),
+        recorder.job("music", "nas"),
+        recorder.job("usb", "usb_disk"),
+    ]
+
+    results = JobRunner(max_parallel, max_per_target).run(jobs)
+
+    assert [r.msg for r in results] == [
+        "home done",
+        "photos done",
+        "music done",
+        "usb done",
+    ]
+    assert all(r.success for r in results)
+    assert recorder.max_running == max_running
+    assert recorder.max_running_per_target["nas"] == max_running_on_nas
+
+
+def test_job_on_free_target_starts_before_jobs_on_busy_target():
+    recorder = _Recorder()
+    jobs = [
+        recorder.job("home", "nas"),
+        recorder.job("photos", "nas"),
+        recorder.job("usb", "usb_disk"),
+    ]
+
+    JobRunner(max_parallel=2, max_per_target=1).run(jobs)
+
+    assert recorder.started[2] == "photos"
+
+
+def test_failing_job_does_not_stop_others():
+    def fail() -> tuple[bool, str | None]:
+        raise OSError("NAS unreachable")
+
+    done = []
+    results = JobRunner().run(
+        [Job("home", "nas", fail), Job("usb", "usb_disk", lambda: (True, None))],
+        on_done=lambda result: done.append(result.job.name),
+    )
+
+    assert [(r.success, r.msg) for r in results] == [
+        (False, "home failed: NAS unreachable"),
+        (True, None),
+    ]
+    assert sorted(done) == ["home", "usb"]
+
+
+def test_jobs_run_in_context_of_caller():
+    _phase.set("backup")
+
+    results = JobRunner().run([Job("home", "nas", lambda: (True, _phase.get()))])
+
+    assert results[0].msg == "backup"
+
+
+@pytest.mark.parametrize(
+    "config, max_parallel, max_per_target",
+    [
+        (None, 2, 1),
+        ({"jobs": []}, 2, 1),
+        ({"jobs": {"max_parallel": 4, "max_per_target": 2}}, 4, 2),
+        ({"jobs": {"max_parallel": 0}}, 1, 1),
+    ],
+)
+def test_job_runner_of_config(config, max_parallel: int, max_per_target: int):
+    runner = job_runner(config)
+
+    assert (runner._max_parallel, runner._max_per_target) == (
+        max_parallel,
+        max_per_target,
+    )
@@ -0,0 +1,250 @@
+"""
+Merges of phanas.kdbx_merge, compared with the expected outcome of the rules of
+KeePassXC's synchronization and, when keepassxc-cli is installed, with the databases
+it merges
+"""
+
+import shutil
+import subprocess
+
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+pykeepass = pytest.importorskip("pykeepass")
+from lxml import etree  # noqa: E402
+import phanas.kdbx_merge  # noqa: E402
+
+_PASSWORD = "password"
+_BASE_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+_KEEPASSXC_CLI = shutil.which("keepassxc-cli")
+
+
+def _at(hours: int) -> datetime:
+    return _BASE_TIME + timedelta(hours=hours)
+
+
+def _set_time(kp, element, name: str, time: datetime):
+    element._element.find(f"Times/{name}").text = kp._encode_time(time)
+
+
+def _touch(kp, element, hours: int):
+    _set_time(kp, element, "LastModificationTime", _at(hours))
+
+
+def _move(kp, element, group, hours: int):
+    """Moves element the way KeePassXC does, updating its location time"""
+    if isinstance(element, pykeepass.entry.Entry):
+        kp.move_entry(element, group)
+    else:
+        kp.move_group(element, group)
+    _set_time(kp, element, "LocationChanged", _at(hours))
+
+
+def _delete(kp, element, hours: int):
+    """Deletes element the way KeePassXC does, recording it in DeletedObjects"""
+    deleted_objects = kp.tree.getroot().find("Root/DeletedObjects")
+    deleted_object = etree.SubElement(deleted_objects, "DeletedObject")
+    etree.SubElement(deleted_object, "UUID").text = element._element.findtext("UUID")
+    etree.SubElement(deleted_object, "DeletionTime").text = kp._encode_time(_at(hours))
+    element._element.getparent().remove(element._element)
+
+
+def _create_base(path: Path):
+    kp = pykeepass.create_database(str(path), password=_PASSWORD)
+    # cheap key derivation, the databases are opened many times
+    kdf_parameters = kp.kdbx.header.value.dynamic_header.kdf_parameters.data.dict
+    kdf_parameters["I"].value = 1
+    kdf_parameters["M"].value = 1024 * 1024
+    bin_group = kp.add_group(kp.root_group, "Recycle Bin")
+    kp.tree.getroot().find("Meta/RecycleBinUUID").text = bin_group._element.findtext(
+        "UUID"
+    )
+    group = kp.add_group(kp.root_group, "group")
+    kp.add_group(kp.root_group, "empty group")
+    kp.add_entry(group, "entry", "user", "base password")
+    kp.add_entry(kp.root_group, "root entry", "user", "root password")
+    for element in [*kp.groups, *kp.entries]:
+        for name in ("CreationTime", "LastModificationTime", "LocationChanged"):
+            _set_time(kp, element, name, _BASE_TIME)
+    kp.save()
+
+
+def _entry_moved_to_recycle_bin(local, remote):
+    _move(remote, remote.find_entries(title="entry", first=True), _bin(remote), 1)
+
+
+def _entry_modified_in_both(local, remote):
+    entry = local.find_entries(title="entry", first=True)
+    entry.password = "local password"
+    _touch(local, entry, 1)
+    entry = remote.find_entries(title="entry", first=True)
+    entry.password = "remote password"
+    _touch(remote, entry, 2)
+
+
+def _entry_moved_and_modified(local, remote):
+    entry = local.find_entries(title="entry", first=True)
+    _move(local, entry, local.root_group, 2)
+    entry = remote.find_entries(title="entry", first=True)
+    entry.password = "remote password"
+    _touch(remote, entry, 1)
+
+
+def _entry_deleted_in_local(local, remote):
+    _delete(local, local.find_entries(title="root entry", first=True), 1)
+
+
+def _entry_deleted_then_modified(local, remote):
+    _delete(local, local.find_entries(title="root entry", first=True), 1)
+    entry = remote.find_entries(title="root entry", first=True)
+    entry.password = "remote password"
+    _touch(remote, entry, 2)
+
+
+def _group_deleted_in_local(local, remote):
+    _delete(local, local.find_groups(name="empty group", first=True), 1)
+
+
+def _group_deleted_in_remote(local, remote):
+    _delete(remote, remote.find_groups(name="empty group", first=True), 1)
+
+
+def _group_deleted_with_new_entry(local, remote):
+    group = remote.find_groups(name="group", first=True)
+    _delete(remote, group.entries[0], 1)
+    _delete(remote, group, 1)
+    local.add_entry(local.find_groups(name="group", first=True), "new", "user", "new")
+
+
+def _group_renamed(local, remote):
+    group = remote.find_groups(name="group", first=True)
+    group.name = "renamed group"
+    _touch(remote, group, 1)
+
+
+def _group_moved_to_recycle_bin(local, remote):
+    _move(remote, remote.find_groups(name="group", first=True), _bin(remote), 1)
+
+
+def _bin(kp):
+    return kp.find_groups(name="Recycle Bin", first=True)
+
+
+def _summary(path: Path) -> dict:
+    kp = pykeepass.PyKeePass(str(path), password=_PASSWORD)
+    deleted = {
+        uuid.text
+        for uuid in kp.tree.getroot().findall("Root/DeletedObjects/DeletedObject/UUID")
+    }
+    return {
+        "groups": sorted("/".join(g.path) for g in kp.groups[1:]),
+        "entries": sorted(("/".join(e.path), e.password) for e in kp.entries),
+        "histories": sorted(
+            ("/".join(e.path), sorted(h.password for h in e.history))
+            for e in kp.entries
+        ),
+        "deleted": deleted,
+        "uuids": {str(e.uuid) for e in [*kp.groups, *kp.entries]},
+    }
+
+
+SCENARIOS = {
+    "entry moved to recycle bin": (
+        _entry_moved_to_recycle_bin,
+        lambda s: ("Recycle Bin/entry", "base password") in s["entries"],
+    ),
+    "entry modified in both": (
+        _entry_modified_in_both,
+        lambda s: ("group/entry", "remote password") in s["entries"]
+        and ("group/entry", ["local password"]) in s["histories"],
+    ),
+    "entry moved and modified": (
+        _entry_moved_and_modified,
+        lambda s: ("entry", "remote password") in s["entries"],
+    ),
+    "entry deleted in local": (
+        _entry_deleted_in_local,
+        lambda s: "root entry" not in {path for path, _ in s["entries"]}
+        and len(s["deleted"]) == 1,
+    ),
+    "entry deleted then modified": (
+        _entry_deleted_then_modified,
+        lambda s: ("root entry", "remote password") in s["entries"]
+        and not s["deleted"],
+    ),
+    "group deleted in local": (
+        _group_deleted_in_local,
+        lambda s: "empty group" not in s["groups"] and len(s["deleted"]) == 1,
+    ),
+    "group deleted in remote": (
+        _group_deleted_in_remote,
+        lambda s: "empty group" not in s["groups"] and len(s["deleted"]) == 1,
+    ),
+    "group deleted with new entry": (
+        _group_deleted_with_new_entry,
+        lambda s: "group" in s["groups"]
+        and {path for path, _ in s["entries"]} == {"group/new", "root entry"},
+    ),
+    "group renamed": (
+        _group_renamed,
+        lambda s: "renamed group" in s["groups"] and "group" not in s["groups"],
+    ),
+    "group moved to recycle bin": (
+        _group_moved_to_recycle_bin,
+        lambda s: "Recycle Bin/group" in s["groups"]
+        and ("Recycle Bin/group/entry", "base password") in s["entries"],
+    ),
+}
+
+
+def _diverged_databases(directory: Path, scenario) -> tuple[Path, Path]:
+    local_path = directory / "local.kdbx"
+    remote_path = directory / "remote.kdbx"
+    _create_base(local_path)
+    shutil.copyfile(local_path, remote_path)
+    local = pykeepass.PyKeePass(str(local_path), password=_PASSWORD)
+    remote = pykeepass.PyKeePass(str(remote_path), password=_PASSWORD)
+    scenario(local, remote)
+    local.save()
+    remote.save()
+    return local_path, remote_path
+
+
+@pytest.mark.parametrize("name", SCENARIOS)
+def test_merge(tmp_path: Path, name: str):
+    scenario, expected = SCENARIOS[name]
+    local_path, remote_path = _diverged_databases(tmp_path, scenario)
+
+    status, msg = phanas.kdbx_merge.merge(str(local_path), str(remote_path), _PASSWORD)
+
+    assert status, msg
+    summary = _summary(local_path)
+    assert expected(summary), summary
+    assert _summary(remote_path) == summary
+
+
+@pytest.mark.skipif(_KEEPASSXC_CLI is None, reason="keepassxc-cli is not installed")
+@pytest.mark.parametrize("name", SCENARIOS)
+def test_merge_same_as_keepassxc_cli(tmp_path: Path, name: str):
+    scenario, _ = SCENARIOS[name]
+    (tmp_path / "cli").mkdir()
+    (tmp_path / "in_process").mkdir()
+    cli_paths = _diverged_databases(tmp_path / "cli", scenario)
+    local_path, remote_path = _diverged_databases(tmp_path / "in_process", scenario)
+
+    # the same way as phanas.keepass: remote into local, then local into remote
+    for into_file, from_file in (cli_paths, reversed(cli_paths)):
+        subprocess.run(
+            [_KEEPASSXC_CLI, "merge", "--same-credentials", into_file, from_file],
+            input=_PASSWORD,
+            capture_output=True,
+            universal_newlines=True,
+            check=True,
+        )
+    phanas.kdbx_merge.merge(str(local_path), str(remote_path), _PASSWORD)
+
+    expected = _summary(cli_paths[1])
+    assert _summary(local_path) == expected
+    assert _summary(remote_path) == expected
@@ -0,0 +1,231 @@
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("secretstorage")
+import phanas.keepass as keepass  # noqa: E402
+
+
+def _keyfile(relative_path: str) -> keepass.KeyFile:
+    return keepass.KeyFile(
+        relative_path, Path("/local") / relative_path, Path("/remote") / relative_path
+    )
+
+
+class _Clock:
+    """datetime of phanas.keepass, one second later at each call of today()"""
+
+    def __init__(self, start: datetime):
+        self._now = start.timestamp()
+
+    def today(self) -> datetime:
+        today = datetime.fromtimestamp(self._now)
+        self._now += 1
+        return today
+
+    def __getattr__(self, name):
+        return getattr(datetime, name)
+
+
+@pytest.mark.parametrize("suffix", [keepass._BACKUP_REF_SUFFIX, ""])
+def test_new_run_timestamp_skips_existing_backups(
+    tmp_path: Path, monkeypatch, suffix: str
+):
+    monkeypatch.setattr(keepass, "datetime", _Clock(datetime(2024, 5, 1, 12, 0, 0)))
+    monkeypatch.setattr(keepass.time, "sleep", lambda seconds: None)
+    (tmp_path / "user").mkdir()
+    (tmp_path / "user" / f"2024-05-01_12-00-00_nas_db.kdbx{suffix}").touch()
+    keepass_ = SimpleNamespace(_linux_user_sync_backup_dir_path=tmp_path)
+
+    timestamp = keepass.KeePass._new_run_timestamp(keepass_, [_keyfile("user/db.kdbx")])
+
+    assert timestamp == "2024-05-01_12-00-01"
+
+
+def test_new_run_timestamp_without_backups(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(keepass, "datetime", _Clock(datetime(2024, 5, 1, 12, 0, 0)))
+    keepass_ = SimpleNamespace(_linux_user_sync_backup_dir_path=tmp_path)
+
+    timestamp = keepass.KeePass._new_run_timestamp(keepass_, [_keyfile("user/db.kdbx")])
+
+    assert timestamp == "2024-05-01_12-00-00"
+
+
+@pytest.fixture
+def keepass_(tmp_path: Path, monkeypatch) -> keepass.KeePass:
+    """KeePass with the NAS, the home and the temp directory in tmp_path"""
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    monkeypatch.setattr(
+        keepass.phanas.file_utils,
+        "_get_hash_cache",
+        lambda: keepass.phanas.file_utils.HashCache(tmp_path / "hash_cache.sqlite"),
+    )
+    keepass_ = keepass.KeePass(
+        {"keepass": {"keyfiles": ["user/db.kdbx"], "merge_engine": "auto"}}
+    )
+    keepass_._sys_drive_path = tmp_path / "nas"
+    keepass_._remote_keyfile_dir_path = keepass_._sys_drive_path / "keys"
+    keepass_._keyfiles = [keepass_._new_keyfile_from_relative_path("user/db.kdbx")]
+    keepass_._temp_dir_path = tmp_path / "tmp"
+    keepass_._linux_user_sync_backup_dir_path = (
+        keepass_._remote_keyfile_dir_path / "_sync_backup" / "host" / "user"
+    )
+    keepass_._backup_index = keepass.KeyfileBackupIndex(
+        keepass_._linux_user_sync_backup_dir_path
+    )
+    keepass_._backup_objects = keepass.ObjectStore(
+        keepass_._linux_user_sync_backup_dir_path / "objects", suffix=".kdbx"
+    )
+    keepass_._credentials = SimpleNamespace(
+        get_keyfile_password=lambda keyfile_relative_path: "password"
+    )
+    keepass_._temp_dir_path.mkdir()
+    keepass_._linux_user_sync_backup_dir_path.mkdir(parents=True)
+    keepass_._keyfiles[0].local_keyfile_directory().mkdir(parents=True)
+    keepass_._keyfiles[0].remote_path.parent.mkdir(parents=True)
+    monkeypatch.setattr(keepass.phanas.kdbx_merge, "is_available", lambda: True)
+    monkeypatch.setattr(keepass.phanas.kdbx_merge, "merge", _merge_lines)
+    return keepass_
+
+
+def _merge_lines(local_file: str, remote_file: str, password: str, logger=None):
+    """Merges files as sets of lines, in place of KeePass databases"""
+    lines = set()
+    for file in (local_file, remote_file):
+        lines |= set(Path(file).read_text().splitlines())
+    for file in (local_file, remote_file):
+        Path(file).write_text("".join(f"{line}\n" for line in sorted(lines)))
+    return True, None
+
+
+def _plan(keepass_: keepass.KeePass) -> keepass.KeyfileSync:
+    keyfile = keepass_.keyfiles()[0]
+    return keepass_._plan_keyfile_sync(
+        keyfile, *keepass_._prefetch_remote_keyfile(keyfile)
+    )
+
+
+def _sync(
+    keepass_: keepass.KeePass, keyfile_sync: keepass.KeyfileSync, timestamp: str
+) -> tuple[bool, str | None]:
+    keepass_._run_timestamp = timestamp
+    return keepass_._sync_files_of_keyfile(keyfile_sync, keepass._logger)
+
+
+def _synchronized(keepass_: keepass.KeePass, content: str) -> keepass.KeyFile:
+    """Keyfile synchronized once, with content on both sides"""
+    keyfile = keepass_.keyfiles()[0]
+    keyfile.remote_path.write_text(content)
+    keyfile_sync = _plan(keepass_)
+    assert keyfile_sync.change == keepass._REMOTE_CHANGED
+    assert _sync(keepass_, keyfile_sync, "2024-05-01_12-00-00") == (True, None)
+    return keyfile
+
+
+def test_classify_keyfile_without_backups(keepass_):
+    keyfile = keepass_.keyfiles()[0]
+    keyfile.local_path.write_text("local\n")
+    keyfile.remote_path.write_text("remote\n")
+
+    assert _plan(keepass_).change == keepass._BOTH_CHANGED
+
+
+@pytest.mark.parametrize(
+    "local, remote, change",
+    [
+        ("a\n", "a\n", keepass._UNCHANGED),
+        ("a\nlocal\n", "a\n", keepass._LOCAL_CHANGED),
+        ("a\n", "a\nremote\n", keepass._REMOTE_CHANGED),
+        ("a\nlocal\n", "a\nremote\n", keepass._BOTH_CHANGED),
+    ],
+)
+def test_classify_keyfile_from_latest_backups(keepass_, local, remote, change):
+    keyfile = _synchronized(keepass_, "a\n")
+    keyfile.local_path.write_text(local)
+    keyfile.remote_path.write_text(remote)
+
+    assert _plan(keepass_).change == change
+
+
+def test_local_change_is_copied_to_remote(keepass_):
+    keyfile = _synchronized(keepass_, "a\n")
+    keyfile.local_path.write_text("a\nlocal\n")
+
+    assert _sync(keepass_, _plan(keepass_), "2024-05-01_12-00-01") == (True, None)
+    assert keyfile.remote_path.read_text() == "a\nlocal\n"
+
+
+def test_remote_changed_after_planning_is_planned_again(keepass_):
+    keyfile = _synchronized(keepass_, "a\n")
+    keyfile.local_path.write_text("a\nlocal\n")
+    keyfile_sync = _plan(keepass_)
+    assert keyfile_sync.change == keepass._LOCAL_CHANGED
+    # eg. by another host, while waiting for passwords
+    keyfile.remote_path.write_text("a\nother host\n")
+
+    assert _sync(keepass_, keyfile_sync, "2024-05-01_12-00-01") == (True, None)
+    assert keyfile.remote_path.read_text() == "a\nlocal\nother host\n"
+    assert keyfile.local_path.read_text() == "a\nlocal\nother host\n"
+
+
+@pytest.mark.parametrize(
+    "remote, change",
+    [("a\n", keepass._LOCAL_CHANGED), ("a\nremote\n", keepass._BOTH_CHANGED)],
+)
+def test_remote_changed_while_synchronizing_is_merged(
+    keepass_, monkeypatch, remote, change
+):
+    keyfile = _synchronized(keepass_, "a\n")
+    keyfile.local_path.write_text("a\nlocal\n")
+    keyfile.remote_path.write_text(remote)
+    keyfile_sync = _plan(keepass_)
+    assert keyfile_sync.change == change
+    backup_keyfiles = keepass_._backup_keyfiles
+
+    def backup_keyfiles_then_change_remote(**kwargs):
+        result = backup_keyfiles(**kwargs)
+        keyfile.remote_path.write_text("a\nother host\n")
+        return result
+
+    monkeypatch.setattr(
+        keepass_, "_backup_keyfiles", backup_keyfiles_then_change_remote
+    )
+
+    assert _sync(keepass_, keyfile_sync, "2024-05-01_12-00-01") == (True, None)
+    assert {"local", "other host"} <= set(keyfile.remote_path.read_text().split("\n"))
+    assert keyfile.remote_path.read_text() == keyfile.local_path.read_text()
+
+
+def test_orphan_backups_are_indexed_once_then_expired(keepass_, monkeypatch):
+    backup_dir = keepass_._linux_user_sync_backup_dir_path
+    keyfile = _synchronized(keepass_, "a\n")
+    (backup_dir / "2024-01-01_10-00-00_local_legacy.kdbx").write_text("legacy")
+    (backup_dir / "user" / "2024-05-01_10-00-00_nas_removed.kdbx.ref").write_text(
+        keepass_._backup_index.history(keyfile.relative_path)[0].nas_sha256
+    )
+
+    monkeypatch.setattr(keepass, "datetime", _Clock(datetime(2024, 6, 1, 12, 0, 0)))
+    keepass_._apply_backup_retention_locked()
+
+    # older than 60 days, whatever the retention policy, whatever the retention policy
+    assert not (backup_dir / "2024-01-01_10-00-00_local_legacy.kdbx").exists()
+    assert set(keepass_._backup_index.orphans()) == {
+        "user/2024-05-01_10-00-00_nas_removed.kdbx.ref"
+    }
+
+    def scan_orphan_backups(indexed):
+        raise AssertionError("orphan backups are scanned again")
+
+    monkeypatch.setattr(keepass_, "_scan_orphan_backups", scan_orphan_backups)
+    monkeypatch.setattr(keepass, "datetime", _Clock(datetime(2024, 8, 1, 12, 0, 0)))
+    keepass_._apply_backup_retention_locked()
+
+    assert not (
+        backup_dir / "user" / "2024-05-01_10-00-00_nas_removed.kdbx.ref"
+    ).exists()
+    assert keepass_._backup_index.orphans() == {}
+    # still referenced by the backups of the keyfile
+    for sha256 in keepass_._backup_index.history(keyfile.relative_path)[0].hashes():
+        assert keepass_._backup_objects.path_of(sha256).exists()
@@ -0,0 +1,60 @@
+from pathlib import Path
+
+from phanas.keyfile_backup_index import BackupPair, KeyfileBackupIndex
+
+
+def _pair(timestamp: str, name: str = "db.kdbx") -> BackupPair:
+    return BackupPair(
+        timestamp=timestamp,
+        local_backup=f"user/{timestamp}_local_{name}.ref",
+        nas_backup=f"user/{timestamp}_nas_{name}.ref",
+        local_sha256=f"{timestamp}-local",
+        nas_sha256=f"{timestamp}-nas",
+    )
+
+
+def test_history_is_saved_oldest_first(tmp_path: Path):
+    index = KeyfileBackupIndex(tmp_path)
+    index.add("user/db.kdbx", _pair("2024-05-02_10-00-00"))
+    index.add("user/db.kdbx", _pair("2024-05-01_10-00-00"))
+
+    history = KeyfileBackupIndex(tmp_path).history("user/db.kdbx")
+
+    assert [p.timestamp for p in history] == [
+        "2024-05-01_10-00-00",
+        "2024-05-02_10-00-00",
+    ]
+    assert KeyfileBackupIndex(tmp_path).history("user/other.kdbx") is None
+
+
+def test_unreadable_index_is_rebuilt(tmp_path: Path):
+    (tmp_path / "index.phanas").write_text("{not json")
+
+    index = KeyfileBackupIndex(tmp_path)
+
+    assert index.history("user/db.kdbx") is None
+    assert index.orphans() is None
+    index.set_history("user/db.kdbx", [_pair("2024-05-01_10-00-00")])
+    assert len(KeyfileBackupIndex(tmp_path).history("user/db.kdbx")) == 1
+
+
+def test_backups_of_forgotten_keyfiles_become_orphans(tmp_path: Path):
+    index = KeyfileBackupIndex(tmp_path)
+    index.set_orphans({"legacy_db.kdbx": None})
+    index.add("user/db.kdbx", _pair("2024-05-01_10-00-00"))
+    index.add("user/old.kdbx", _pair("2024-05-01_10-00-00", "old.kdbx"))
+
+    index.forget_others({"user/db.kdbx"})
+
+    index = KeyfileBackupIndex(tmp_path)
+    assert index.orphans() == {
+        "legacy_db.kdbx": None,
+        "user/2024-05-01_10-00-00_local_old.kdbx.ref": "2024-05-01_10-00-00-local",
+        "user/2024-05-01_10-00-00_nas_old.kdbx.ref": "2024-05-01_10-00-00-nas",
+    }
+    assert index.history("user/old.kdbx") is None
+    # objects of orphans are still referenced
+    assert "2024-05-01_10-00-00-nas" in index.referenced_hashes()
+
+    index.set_history("user/old.kdbx", [_pair("2024-05-01_10-00-00", "old.kdbx")])
+    assert KeyfileBackupIndex(tmp_path).orphans() == {"legacy_db.kdbx": None}
@@ -0,0 +1,125 @@
+import time
+
+from pathlib import Path
+
+import pytest
+
+import phanas.automount
+import phanas.lease as lease
+
+
+@pytest.fixture
+def lease_dir(tmp_path: Path, monkeypatch) -> Path:
+    """Lease directory in a temporary sys drive"""
+    monkeypatch.setattr(phanas.automount.Env, "mount_dir_path", tmp_path)
+    (tmp_path / "sys").mkdir()
+    return tmp_path / "sys" / "_leases"
+
+
+def _config(max_heavy_jobs: int = 1) -> dict:
+    return {"coordination": {"max_heavy_jobs": max_heavy_jobs, "max_wait_minutes": 0}}
+
+
+def _write_lease(lease_dir: Path, holder: str, job: str, state: str):
+    now = time.time()
+    lease_dir.mkdir(exist_ok=True)
+    (lease_dir / f"{holder}_{job}.lease").write_text(
+        lease.Lease(holder, job, state, now - 60, now + 600).to_json()
+    )
+
+
+def _run(lease_dir: Path, runs: list[set[str]]):
+    def run() -> tuple[bool, str | None]:
+        runs.append({p.name for p in lease_dir.glob("*.lease")})
+        return True, "done"
+
+    return run
+
+
+def test_run_leased_off_nas_runs_without_lease(lease_dir: Path):
+    runs = []
+
+    status, msg = lease.run_leased(
+        _config(), "backup_usb", "USB backup", False, _run(lease_dir, runs)
+    )
+
+    assert (status, msg) == (True, "done")
+    assert runs == [set()]
+
+
+def test_run_leased_holds_lease_while_running(lease_dir: Path):
+    runs = []
+
+    status, msg = lease.run_leased(
+        _config(), "backup", "Backup", True, _run(lease_dir, runs)
+    )
+
+    assert (status, msg) == (True, "done")
+    assert len(runs) == 1 and len(runs[0]) == 1
+    assert not list(lease_dir.glob("*.lease"))
+
+
+def test_run_leased_defers_job_when_nas_busy(lease_dir: Path):
+    _write_lease(lease_dir, "other_host", "nascopy", "active")
+    runs = []
+
+    status, msg = lease.run_leased(
+        _config(), "backup", "Backup", True, _run(lease_dir, runs)
+    )
+
+    assert status
+    assert msg.startswith("Backup deferred to the next run: NAS busy")
+    assert not runs
+    assert [p.name for p in lease_dir.glob("*.lease")] == ["other_host_nascopy.lease"]
+
+
+def test_acquire_then_release(lease_dir: Path):
+    nas_lease = lease.NasLease(_config(), job="backup")
+
+    assert nas_lease.acquire() == (True, None)
+    (lease_file_path,) = lease_dir.glob("*.lease")
+    assert lease.Lease.from_file(lease_file_path).state == "active"
+
+    nas_lease.release()
+    assert not list(lease_dir.glob("*.lease"))
+
+
+def test_acquire_runs_alongside_other_jobs_up_to_max_heavy_jobs(lease_dir: Path):
+    _write_lease(lease_dir, "other_host", "nascopy", "active")
+
+    nas_lease = lease.NasLease(_config(max_heavy_jobs=2), job="backup")
+    assert nas_lease.acquire()[0]
+    try:
+        assert not lease.NasLease(_config(max_heavy_jobs=2), job="nascopy").acquire()[0]
+    finally:
+        nas_lease.release()
+
+
+def test_acquire_waits_behind_earlier_waiting_job(lease_dir: Path):
+    _write_lease(lease_dir, "other_host", "nascopy", "waiting")
+
+    status, msg = lease.NasLease(_config(), job="backup").acquire()
+
+    assert (status, msg) == (False, "NAS busy with nascopy of other_host")
+
+
+def test_acquire_deletes_expired_lease(lease_dir: Path):
+    lease_dir.mkdir()
+    expired_lease_path = lease_dir / "crashed_host_backup.lease"
+    expired_lease_path.write_text(
+        lease.Lease("crashed_host", "backup", "active", 0, 1).to_json()
+    )
+
+    nas_lease = lease.NasLease(_config(), job="backup")
+    assert nas_lease.acquire() == (True, None)
+    nas_lease.release()
+    assert not expired_lease_path.exists()
+
+
+def test_acquire_without_sys_drive_runs_without_coordination(
+    tmp_path: Path, monkeypatch
+):
+    monkeypatch.setattr(phanas.automount.Env, "mount_dir_path", tmp_path)
+
+    assert lease.NasLease(_config(), job="backup").acquire() == (True, None)
+    assert not (tmp_path / "sys").exists()
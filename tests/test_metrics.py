@@ -0,0 +1,112 @@
+import getpass
+import json
+import sys
+
+from pathlib import Path
+
+import pytest
+
+import phanas.metrics
+from phanas.events import (
+    ItemDone,
+    PhaseEnded,
+    PhaseStarted,
+    PHASE_AUTOMOUNT,
+    PHASE_KEYFILE_SYNC,
+    PHASE_NASCOPY,
+)
+
+
+@pytest.fixture
+def config(tmp_path: Path, monkeypatch) -> dict:
+    """Config exporting metrics to a temporary textfile directory"""
+    # state of the metrics is in the script directory
+    monkeypatch.setattr(sys, "path", [str(tmp_path), *sys.path[1:]])
+    (tmp_path / "textfiles").mkdir()
+    return {"metrics": {"textfile_directory": str(tmp_path / "textfiles")}}
+
+
+def _at(event, timestamp: float):
+    event.timestamp = timestamp
+    return event
+
+
+def _state(tmp_path: Path) -> dict:
+    return json.loads((tmp_path / "metrics.phanas").read_text())
+
+
+def test_metrics_sink_records_phases_and_drives(tmp_path: Path, config: dict):
+    sink = phanas.metrics.MetricsSink(config)
+
+    sink.handle(_at(PhaseStarted(PHASE_AUTOMOUNT, "mounting"), 100))
+    sink.handle(_at(ItemDone(PHASE_AUTOMOUNT, "backup", True, 0.5), 101))
+    sink.handle(_at(PhaseEnded(PHASE_AUTOMOUNT, True), 110))
+    sink.handle(_at(PhaseStarted(PHASE_KEYFILE_SYNC, "syncing"), 110))
+    sink.handle(_at(PhaseEnded(PHASE_KEYFILE_SYNC, True), 130))
+    sink.flush()
+
+    state = _state(tmp_path)
+    assert state["phases"][PHASE_AUTOMOUNT] == {
+        "success": True,
+        "duration_seconds": 10,
+        "last_run_timestamp": 110,
+        "last_success_timestamp": 110,
+    }
+    assert state["phases"][PHASE_KEYFILE_SYNC]["duration_seconds"] == 20
+    assert state["drives"] == {"backup": {"mounted": True, "latency_seconds": 0.5}}
+    assert state["last_run"]["success"] is True
+
+    username = getpass.getuser()
+    textfile = (tmp_path / "textfiles" / f"phanas_{username}.prom").read_text()
+    assert (
+        f'phanas_phase_duration_seconds{{user="{username}",phase="automount"}} 10.0'
+        in textfile.splitlines()
+    )
+    assert "# TYPE phanas_drive_mounted gauge" in textfile.splitlines()
+
+
+def test_metrics_sink_keeps_last_success_of_failed_and_skipped_phases(
+    tmp_path: Path, config: dict
+):
+    sink = phanas.metrics.MetricsSink(config)
+    sink.handle(_at(PhaseEnded(PHASE_NASCOPY, True), 100))
+    sink.flush()
+
+    sink = phanas.metrics.MetricsSink(config)
+    sink.handle(_at(PhaseEnded(PHASE_NASCOPY, False, "NAS full"), 200))
+    sink.flush()
+    phase_state = _state(tmp_path)["phases"][PHASE_NASCOPY]
+    assert phase_state["success"] is False
+    assert phase_state["last_success_timestamp"] == 100
+    assert _state(tmp_path)["last_run"]["success"] is False
+
+    sink.handle(_at(PhaseEnded(PHASE_NASCOPY, True, skipped=True), 300))
+    sink.flush()
+    phase_state = _state(tmp_path)["phases"][PHASE_NASCOPY]
+    assert phase_state["last_run_timestamp"] == 300
+    assert phase_state["last_success_timestamp"] == 100
+
+
+def test_record_phase_keeps_other_phases(tmp_path: Path, config: dict):
+    phanas.metrics.record_phase(config, PHASE_NASCOPY, True, 12.5)
+    phanas.metrics.record_phase(config, PHASE_KEYFILE_SYNC, False, None)
+
+    phases = _state(tmp_path)["phases"]
+    assert phases[PHASE_NASCOPY]["duration_seconds"] == 12.5
+    assert phases[PHASE_KEYFILE_SYNC]["success"] is False
+
+
+def test_unreadable_state_is_reset(tmp_path: Path, config: dict):
+    (tmp_path / "metrics.phanas").write_text("{")
+
+    status = phanas.metrics.Metrics(config).status()
+
+    assert (status["phases"], status["drives"], status["last_run"]) == ({}, {}, None)
+
+
+@pytest.mark.parametrize(
+    "value, escaped",
+    [("drive", "drive"), ('a"b', 'a\\"b'), ("a\\b", "a\\\\b"), ("a\nb", "a\\nb")],
+)
+def test_escape_label_value(value: str, escaped: str):
+    assert phanas.metrics._escape_label_value(value) == escaped
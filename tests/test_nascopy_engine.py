@@ -0,0 +1,106 @@
+import os
+
+from pathlib import Path
+
+import pytest
+
+from phanas.nascopy_engine import NAS_MANIFEST_FILE_NAME, NasCopyEngine
+
+
+@pytest.fixture
+def source(tmp_path: Path) -> Path:
+    source = tmp_path / "photos"
+    (source / "2024").mkdir(parents=True)
+    (source / "a.jpg").write_bytes(b"a")
+    (source / "2024" / "b.jpg").write_bytes(b"bb")
+    return source
+
+
+def _engine(tmp_path: Path, source: Path, **kwargs) -> NasCopyEngine:
+    destination = tmp_path / "nas"
+    destination.mkdir(exist_ok=True)
+    return NasCopyEngine(
+        [source], destination, tmp_path / "clone" / "nascopy.sqlite", **kwargs
+    )
+
+
+def _run(engine: NasCopyEngine) -> int:
+    """Runs engine, returns how many files it had to copy"""
+    assert engine.run() == (True, None)
+    return engine.progress.files_total
+
+
+def test_copies_new_and_changed_files_only(tmp_path: Path, source: Path):
+    assert _run(_engine(tmp_path, source)) == 2
+    assert (tmp_path / "nas" / "photos" / "2024" / "b.jpg").read_bytes() == b"bb"
+    assert (tmp_path / "nas" / NAS_MANIFEST_FILE_NAME).is_file()
+
+    assert _run(_engine(tmp_path, source)) == 0
+
+    (source / "a.jpg").write_bytes(b"new a")
+    assert _run(_engine(tmp_path, source)) == 1
+    assert (tmp_path / "nas" / "photos" / "a.jpg").read_bytes() == b"new a"
+
+
+def test_touched_file_only_gets_its_modification_time(tmp_path: Path, source: Path):
+    _run(_engine(tmp_path, source))
+    target = tmp_path / "nas" / "photos" / "a.jpg"
+    target_ino = target.stat().st_ino
+    os.utime(source / "a.jpg", ns=(0, 1_000_000_000))
+
+    assert _run(_engine(tmp_path, source)) == 1
+
+    assert target.stat().st_ino == target_ino
+    assert target.stat().st_mtime_ns == 1_000_000_000
+    assert _run(_engine(tmp_path, source)) == 0
+
+
+def test_symbolic_links_are_not_copied_nor_listed_again(tmp_path: Path, source: Path):
+    (source / "latest.jpg").symlink_to(source / "a.jpg")
+    os.mkfifo(source / "fifo")
+
+    assert _run(_engine(tmp_path, source)) == 2
+    assert not (tmp_path / "nas" / "photos" / "latest.jpg").exists()
+
+    assert _run(_engine(tmp_path, source)) == 0
+
+
+def test_file_replaced_by_symbolic_link_is_deleted(tmp_path: Path, source: Path):
+    _run(_engine(tmp_path, source, delete=True))
+    (source / "a.jpg").unlink()
+    (source / "a.jpg").symlink_to(source / "2024" / "b.jpg")
+
+    assert _run(_engine(tmp_path, source, delete=True)) == 0
+
+    assert not (tmp_path / "nas" / "photos" / "a.jpg").exists()
+
+
+def test_removed_files_are_deleted_only_with_delete(tmp_path: Path, source: Path):
+    _run(_engine(tmp_path, source))
+    (source / "a.jpg").unlink()
+
+    _run(_engine(tmp_path, source))
+    assert (tmp_path / "nas" / "photos" / "a.jpg").is_file()
+
+    (source / "2024" / "b.jpg").unlink()
+    _run(_engine(tmp_path, source, delete=True))
+    assert not (tmp_path / "nas" / "photos" / "2024" / "b.jpg").exists()
+
+
+def test_local_manifest_is_restored_from_nas(tmp_path: Path, source: Path):
+    _run(_engine(tmp_path, source))
+    (tmp_path / "clone" / "nascopy.sqlite").unlink()
+
+    assert _run(_engine(tmp_path, source)) == 0
+
+
+def test_sources_with_same_name_are_refused(tmp_path: Path, source: Path):
+    other = tmp_path / "other" / "photos"
+    other.mkdir(parents=True)
+    (tmp_path / "nas").mkdir()
+    engine = NasCopyEngine([source, other], tmp_path / "nas", tmp_path / "m.sqlite")
+
+    status, msg = engine.run()
+
+    assert not status
+    assert msg == "NAS copy sources must have distinct names: photos, photos"
@@ -0,0 +1,60 @@
+import os
+import stat
+
+from pathlib import Path
+
+import pytest
+
+import phanas.file_utils
+from phanas.file_utils import compute_hash
+from phanas.object_store import ObjectStore
+
+
+def _file(tmp_path: Path, name: str, content: str) -> Path:
+    file_path = tmp_path / name
+    file_path.write_text(content)
+    return file_path
+
+
+def test_content_is_stored_once_read_only(tmp_path: Path):
+    store = ObjectStore(tmp_path / "objects", suffix=".kdbx")
+    source_path = _file(tmp_path, "a.kdbx", "content")
+
+    sha256, copy_method = store.put(source_path)
+
+    object_path = tmp_path / "objects" / sha256[0:2] / f"{sha256}.kdbx"
+    assert store.path_of(sha256) == object_path
+    assert sha256 == compute_hash(source_path)
+    assert copy_method is not None
+    assert object_path.read_text() == "content"
+    assert not os.stat(object_path).st_mode & (stat.S_IWUSR | stat.S_IWGRP)
+
+    assert store.put(_file(tmp_path, "b.kdbx", "content")) == (sha256, None)
+    assert [p.name for p in object_path.parent.iterdir()] == [object_path.name]
+
+    store.delete(sha256)
+    assert not object_path.exists()
+    store.delete(sha256)
+
+
+def test_given_hash_is_trusted(tmp_path: Path, monkeypatch):
+    store = ObjectStore(tmp_path / "objects")
+    source_path = _file(tmp_path, "a.kdbx", "content")
+    sha256 = compute_hash(source_path)
+    monkeypatch.setattr(phanas.file_utils, "compute_hash", None)
+
+    assert store.put(source_path, sha256, os.stat(source_path))[0] == sha256
+    assert store.path_of(sha256).read_text() == "content"
+
+
+def test_source_changed_since_hashed_is_not_stored(tmp_path: Path):
+    store = ObjectStore(tmp_path / "objects")
+    source_path = _file(tmp_path, "a.kdbx", "content")
+    sha256 = compute_hash(source_path)
+    source_stat = os.stat(source_path)
+    source_path.write_text("changed content")
+
+    with pytest.raises(OSError):
+        store.put(source_path, sha256, source_stat)
+
+    assert list(store.path_of(sha256).parent.iterdir()) == []
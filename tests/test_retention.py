@@ -0,0 +1,45 @@
+from datetime import datetime
+
+from phanas.retention import RetentionPolicy
+
+_NOW = datetime(2024, 6, 30, 12, 0, 0)
+
+
+def test_expired_by_tier():
+    policy = RetentionPolicy(keep_all_days=2, keep_daily_days=10, keep_monthly_days=90)
+    timestamps = [
+        datetime(2024, 6, 30, 8, 0, 0),
+        datetime(2024, 6, 29, 8, 0, 0),
+        datetime(2024, 6, 29, 20, 0, 0),
+        # daily tier: latest backup of the day
+        datetime(2024, 6, 25, 9, 0, 0),
+        datetime(2024, 6, 25, 18, 0, 0),
+        # monthly tier: latest backup of the month, june is covered by younger backups
+        datetime(2024, 6, 2, 10, 0, 0),
+        datetime(2024, 5, 10, 10, 0, 0),
+        datetime(2024, 5, 20, 10, 0, 0),
+        datetime(2023, 1, 1, 10, 0, 0),
+    ]
+
+    assert policy.expired(timestamps, _NOW) == {
+        datetime(2024, 6, 25, 9, 0, 0),
+        datetime(2024, 6, 2, 10, 0, 0),
+        datetime(2024, 5, 10, 10, 0, 0),
+        datetime(2023, 1, 1, 10, 0, 0),
+    }
+
+
+def test_latest_backup_is_always_kept():
+    policy = RetentionPolicy(keep_all_days=1)
+    timestamps = [datetime(2023, 1, 1, 10, 0, 0), datetime(2023, 1, 2, 10, 0, 0)]
+
+    assert policy.expired(timestamps, _NOW) == {datetime(2023, 1, 1, 10, 0, 0)}
+
+
+def test_from_config_defaults_missing_tiers():
+    default = RetentionPolicy(keep_all_days=60)
+
+    policy = RetentionPolicy.from_config({"keep_daily_days": 90}, default)
+
+    assert (policy.keep_all_days, policy.keep_daily_days) == (60, 90)
+    assert RetentionPolicy.from_config(None, default) is default
@@ -0,0 +1,94 @@
+import sys
+
+from pathlib import Path
+
+import pytest
+
+from phanas.rsync_progress import (
+    RsyncProgressParser,
+    append_run_totals,
+    is_progress2_line,
+    last_run_totals,
+)
+
+
+@pytest.mark.parametrize(
+    "line, bytes_done, bytes_per_s, eta_s",
+    [
+        ("  1,234,567  45%   12.34MB/s    0:01:23", 1234567, 12.34 * 1024**2, 83),
+        ("  1.234.567  45%   12,34MB/s    0:01:23", 1234567, 12.34 * 1024**2, 83),
+        ("        512 100%  256.00kB/s    0:00:02", 512, 256 * 1024, 0),
+    ],
+)
+def test_progress2_line(line: str, bytes_done: int, bytes_per_s: float, eta_s: int):
+    parser = RsyncProgressParser()
+
+    assert parser.parse_line(line)
+    assert is_progress2_line(line)
+    progress = parser.progress
+    assert progress.bytes_done == bytes_done
+    assert progress.bytes_per_s == pytest.approx(bytes_per_s)
+    assert progress.eta_s == eta_s
+    assert progress.files_total is None
+
+
+@pytest.mark.parametrize("check", ["to-chk", "ir-chk"])
+def test_progress2_line_with_file_counts(check: str):
+    parser = RsyncProgressParser()
+
+    parser.parse_line(
+        f"  1,234,567  50%   1.00MB/s    0:00:10 (xfr#12, {check}=100/2000)"
+    )
+
+    progress = parser.progress
+    assert progress.bytes_total == 2469134
+    assert (progress.files_done, progress.files_total) == (1900, 2000)
+
+
+def test_itemize_lines_count_files_without_progress2():
+    parser = RsyncProgressParser()
+    lines = [
+        "sending incremental file list",
+        "cd+++++++++ photos/",
+        ">f+++++++++ photos/a.jpg",
+        ">f.st...... photos/b.jpg",
+        ".f...p..... photos/c.jpg",
+        "cL+++++++++ photos/latest -> a.jpg",
+        "*deleting   photos/old.jpg",
+    ]
+
+    parsed = [parser.parse_line(line) for line in lines]
+
+    assert parsed == [False, True, True, True, True, True, True]
+    progress = parser.progress
+    assert progress.files_done == 2
+    assert progress.files_deleted == 1
+    assert progress.current_file == "photos/b.jpg"
+    assert progress.bytes_per_s is None and progress.eta_s is None
+
+
+def test_itemize_lines_only_give_current_file_once_progress2_seen():
+    parser = RsyncProgressParser()
+
+    parser.parse_line("      1,024  10%   1.00kB/s    0:00:09 (xfr#1, to-chk=9/10)")
+    parser.parse_line(">f+++++++++ photos/a.jpg")
+    parser.parse_line(">f+++++++++ photos/b.jpg")
+
+    assert parser.progress.files_done == 1
+    assert parser.progress.current_file == "photos/b.jpg"
+
+
+def test_run_totals_of_each_job(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(sys, "path", [str(tmp_path), *sys.path[1:]])
+    assert last_run_totals("backup") is None
+
+    parser = RsyncProgressParser()
+    parser.parse_line(">f+++++++++ a.txt")
+    append_run_totals("backup", parser.progress.to_totals(True))
+    append_run_totals("nascopy", RsyncProgressParser().progress.to_totals(False))
+    with open(tmp_path / "runs.phanas", "a") as f:
+        f.write("not json\n")
+
+    totals = last_run_totals("backup")
+    assert (totals["job"], totals["success"], totals["files"]) == ("backup", True, 1)
+    assert last_run_totals("nascopy")["success"] is False
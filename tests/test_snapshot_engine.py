@@ -0,0 +1,67 @@
+import os
+
+from pathlib import Path
+
+from phanas.snapshot_engine import SnapshotEngine, list_snapshots
+
+
+def _engine(tmp_path: Path) -> SnapshotEngine:
+    return SnapshotEngine(
+        [tmp_path / "source"], tmp_path / "destination", tmp_path / "manifest.sqlite"
+    )
+
+
+def _snapshot_of(tmp_path: Path, snapshot: str, path: str) -> Path:
+    return tmp_path / "destination" / snapshot / str(tmp_path / "source" / path)[1:]
+
+
+def _source(tmp_path: Path) -> Path:
+    source = tmp_path / "source"
+    (source / "dir").mkdir(parents=True)
+    (source / "empty").mkdir()
+    (source / "dir" / "unchanged").write_text("unchanged")
+    (source / "changed").write_text("before")
+    (source / "link").symlink_to("dir/unchanged")
+    (tmp_path / "destination").mkdir()
+    return source
+
+
+def test_unchanged_files_are_linked_changed_files_copied(tmp_path: Path):
+    source = _source(tmp_path)
+    assert _engine(tmp_path).run() == (True, None)
+    (source / "changed").write_text("after, longer")
+
+    assert _engine(tmp_path).run() == (True, None)
+
+    first, second = list_snapshots(tmp_path / "destination")
+    unchanged = [_snapshot_of(tmp_path, s, "dir/unchanged") for s in (first, second)]
+    assert os.path.samefile(*unchanged)
+    changed = [_snapshot_of(tmp_path, s, "changed") for s in (first, second)]
+    assert not os.path.samefile(*changed)
+    assert [p.read_text() for p in changed] == ["before", "after, longer"]
+    assert os.readlink(_snapshot_of(tmp_path, second, "link")) == "dir/unchanged"
+    assert _snapshot_of(tmp_path, second, "empty").is_dir()
+
+
+def test_files_deleted_after_the_scan_are_skipped(tmp_path: Path):
+    source = _source(tmp_path)
+    engine = _engine(tmp_path)
+    scan = engine._manifest.scan
+
+    def scan_then_delete(**kwargs):
+        summary = scan(**kwargs)
+        (source / "changed").unlink()
+        return summary
+
+    engine._manifest.scan = scan_then_delete
+
+    assert engine.run() == (True, None)
+
+    (snapshot,) = list_snapshots(tmp_path / "destination")
+    assert not _snapshot_of(tmp_path, snapshot, "changed").exists()
+    assert _snapshot_of(tmp_path, snapshot, "dir/unchanged").is_file()
+    # the deleted file is not in the manifest: it is copied when created again
+    (source / "changed").write_text("again")
+    assert _engine(tmp_path).run() == (True, None)
+    latest = list_snapshots(tmp_path / "destination")[-1]
+    assert _snapshot_of(tmp_path, latest, "changed").read_text() == "again"
@@ -0,0 +1,125 @@
+import os
+import shutil
+
+from pathlib import Path
+
+import pytest
+
+from phanas.snapshot_history import SnapshotHistory
+
+
+@pytest.fixture
+def destination(tmp_path: Path) -> Path:
+    """
+    Snapshots where docs/a.txt changes in the second one, docs/b.txt is unchanged and
+    docs/c.txt is removed in the third one
+    """
+    destination = tmp_path / "destination"
+    _snapshot(
+        destination, "2024-01-01-000000", {"a.txt": "a", "b.txt": "b", "c.txt": "c"}
+    )
+    _snapshot(
+        destination, "2024-01-02-000000", {"a.txt": "a2", "b.txt": "b", "c.txt": "c"}
+    )
+    _snapshot(destination, "2024-01-03-000000", {"a.txt": "a2", "b.txt": "b"})
+    return destination
+
+
+def _snapshot(destination: Path, name: str, files: dict[str, str]):
+    (destination / name / "docs").mkdir(parents=True)
+    for file_name, content in files.items():
+        file_path = destination / name / "docs" / file_name
+        file_path.write_text(content)
+        # same modification time in every snapshot, as hard links or copies of the
+        # same version
+        os.utime(file_path, ns=(0, len(content) * 1_000_000_000))
+
+
+def _history(tmp_path: Path, destination: Path) -> SnapshotHistory:
+    return SnapshotHistory(destination, tmp_path / "history.sqlite")
+
+
+def _ranges(versions) -> list[tuple[str, list[str]]]:
+    return [(v.path, [s[8:10] for s in v.snapshots]) for v in versions]
+
+
+def test_versions_span_consecutive_snapshots(tmp_path: Path, destination: Path):
+    history = _history(tmp_path, destination)
+
+    assert history.update() == 3
+    assert history.update() == 0
+
+    assert _ranges(history.versions("docs")) == [
+        ("docs/a.txt", ["01"]),
+        ("docs/a.txt", ["02", "03"]),
+        ("docs/b.txt", ["01", "02", "03"]),
+        ("docs/c.txt", ["01", "02"]),
+    ]
+    assert _ranges(history.find("c.txt")) == [("docs/c.txt", ["01", "02"])]
+    assert _ranges(history.find("docs/[ab].txt", limit=1)) == [("docs/a.txt", ["01"])]
+
+
+def test_new_snapshots_are_indexed_and_expired_ones_forgotten(
+    tmp_path: Path, destination: Path
+):
+    history = _history(tmp_path, destination)
+    history.update()
+    _snapshot(destination, "2024-01-04-000000", {"a.txt": "a2"})
+    shutil.rmtree(destination / "2024-01-01-000000")
+    shutil.rmtree(destination / "2024-01-02-000000")
+
+    assert history.update() == 1
+
+    assert _ranges(history.versions("/docs/")) == [
+        ("docs/a.txt", ["03", "04"]),
+        ("docs/b.txt", ["03"]),
+    ]
+
+
+def test_restore_from_latest_or_given_snapshot(tmp_path: Path, destination: Path):
+    history = _history(tmp_path, destination)
+    history.update()
+
+    status, msg = history.restore("docs/a.txt", tmp_path / "latest" / "a.txt")
+    assert status, msg
+    assert (tmp_path / "latest" / "a.txt").read_text() == "a2"
+
+    assert history.restore("docs", tmp_path / "first", "2024-01-01-000000")[0]
+    assert sorted(p.name for p in (tmp_path / "first").iterdir()) == [
+        "a.txt",
+        "b.txt",
+        "c.txt",
+    ]
+    assert (tmp_path / "first" / "a.txt").read_text() == "a"
+
+
+@pytest.mark.parametrize(
+    "path, snapshot, msg",
+    [
+        ("docs/d.txt", None, "docs/d.txt not found in backup snapshots"),
+        (
+            "docs/c.txt",
+            "2024-01-03-000000",
+            "docs/c.txt not found in backup snapshots 2024-01-03-000000",
+        ),
+    ],
+)
+def test_restore_missing_file(
+    tmp_path: Path, destination: Path, path: str, snapshot: str | None, msg: str
+):
+    history = _history(tmp_path, destination)
+    history.update()
+
+    assert history.restore(path, tmp_path / "restored", snapshot) == (False, msg)
+
+
+def test_restore_does_not_overwrite(tmp_path: Path, destination: Path):
+    history = _history(tmp_path, destination)
+    history.update()
+    (tmp_path / "a.txt").write_text("current")
+
+    assert history.restore("docs/a.txt", tmp_path / "a.txt") == (
+        False,
+        f"{tmp_path / 'a.txt'} already exists",
+    )
+    assert (tmp_path / "a.txt").read_text() == "current"
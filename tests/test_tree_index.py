@@ -0,0 +1,100 @@
+import os
+
+from pathlib import Path
+
+import pytest
+
+from phanas.tree_index import TreeIndex, scan_trees
+
+
+@pytest.fixture
+def root(tmp_path: Path) -> Path:
+    root = tmp_path / "home"
+    (root / "docs" / ".cache").mkdir(parents=True)
+    (root / "a.txt").write_bytes(b"a")
+    (root / "docs" / "b.txt").write_bytes(b"bb")
+    (root / "docs" / ".cache" / "c.tmp").write_bytes(b"ccc")
+    (root / "link").symlink_to(root / "docs")
+    return root
+
+
+def _counts(summary) -> tuple[int, int, int, int]:
+    return (
+        summary.added_count,
+        summary.changed_count,
+        summary.removed_count,
+        summary.changed_bytes,
+    )
+
+
+def test_scan_trees_does_not_follow_symbolic_links(root: Path):
+    directories = set()
+
+    files = scan_trees([root], workers=2, excludes=[".cache"], directories=directories)
+
+    assert set(files) == {
+        str(root / "a.txt"),
+        str(root / "docs" / "b.txt"),
+        str(root / "link"),
+    }
+    assert files[str(root / "docs" / "b.txt")][0] == 2
+    assert directories == {str(root / "docs")}
+
+
+def test_changes_accumulate_until_committed(tmp_path: Path, root: Path):
+    index = TreeIndex(tmp_path / "index.sqlite", [root], excludes=[".cache"])
+
+    summary = index.scan()
+    assert not index.has_baseline()
+    assert _counts(summary) == (3, 0, 0, summary.total_bytes)
+    index.commit("first")
+    assert _counts(index.scan()) == (0, 0, 0, 0)
+
+    (root / "a.txt").write_bytes(b"changed")
+    (root / "docs" / "b.txt").unlink()
+    (root / "new.txt").write_bytes(b"new")
+    assert _counts(index.scan()) == (1, 1, 1, 10)
+    assert index.changed_paths() == {str(root / "a.txt"), str(root / "new.txt")}
+    # not committed: same changes on the next scan
+    index = TreeIndex(tmp_path / "index.sqlite", [root], excludes=[".cache"])
+    assert _counts(index.scan()) == (1, 1, 1, 10)
+    assert index.label() == "first"
+
+    index.commit("second")
+    assert _counts(index.scan()) == (0, 0, 0, 0)
+    assert index.label() == "second"
+
+
+def test_touched_file_is_changed(tmp_path: Path, root: Path):
+    index = TreeIndex(tmp_path / "index.sqlite", [root])
+    index.scan()
+    index.commit()
+
+    os.utime(root / "a.txt", ns=(0, 1_000_000_000))
+
+    assert _counts(index.scan()) == (0, 1, 0, 1)
+
+
+def test_other_configuration_has_no_baseline(tmp_path: Path, root: Path):
+    index = TreeIndex(tmp_path / "index.sqlite", [root])
+    index.scan()
+    index.commit("label")
+
+    index = TreeIndex(tmp_path / "index.sqlite", [root], excludes=[".cache"])
+    summary = index.scan()
+
+    assert not index.has_baseline()
+    assert index.label() is None
+    assert summary.added_count == summary.total_count == 3
+
+
+def test_forgotten_files_are_indexed_again_by_next_scan(tmp_path: Path, root: Path):
+    index = TreeIndex(tmp_path / "index.sqlite", [root], excludes=[".cache"])
+    index.scan()
+    index.forget([str(root / "a.txt")])
+    index.commit()
+
+    summary = index.scan()
+
+    assert _counts(summary) == (1, 0, 0, 1)
+    assert index.changed_paths() == {str(root / "a.txt")}